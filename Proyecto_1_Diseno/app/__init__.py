@@ -25,7 +25,9 @@ def create_app():
         database.create_rutas_table()
         database.migrate_add_segment_fields()
         database.migrate_add_completed_at()
+        database.migrate_add_ts_column()
         database.create_segments_cache_table()
+        database.create_segment_registry_table()
 
     @app.context_processor
     def utility_processor():
@@ -0,0 +1,70 @@
+# app/cache.py
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Caché en memoria thread-safe con desalojo LRU y expiración por TTL.
+
+    `max_size` limita la cantidad de entradas (0 desactiva la caché).
+    Con `ttl_seconds` una entrada deja de servirse pasado ese tiempo
+    desde que se guardó.
+    """
+
+    def __init__(self, max_size, ttl_seconds=None):
+        self.max_size = max(0, max_size)
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._data = OrderedDict()    # llave → (valor, expira_en)
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        if not self.max_size:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['size'] = len(self._data)
+        lookups = s['hits'] + s['misses']
+        s['max_size'] = self.max_size
+        s['ttl_seconds'] = self.ttl
+        s['hit_ratio'] = round(s['hits'] / lookups, 4) if lookups else 0
+        return s
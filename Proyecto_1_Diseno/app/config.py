@@ -11,6 +11,12 @@ DB_NAME = os.getenv('DB_NAME')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 
+# Pool de conexiones (compartido por el listener UDP y Flask)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # segundos esperando una conexión libre
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv('DB_POOL_HEALTHCHECK_IDLE', '30'))  # segundos inactiva antes de verificar con SELECT 1
+
 # Configuración de la Aplicación
 NAME = os.getenv('NAME', 'Default')
 BRANCH_NAME = os.getenv('BRANCH_NAME', 'main')
@@ -19,7 +25,92 @@ IS_TEST_MODE = os.getenv('TEST_MODE', 'false').lower() == 'true'
 # Configuración UDP
 UDP_IP = "0.0.0.0"
 UDP_PORT = 5049
+# Zona horaria de los timestamps de los dispositivos (Colombia, sin horario de verano).
+# Se usa para convertir la hora epoch de las tramas binarias al formato DD/MM/YYYY HH:MM:SS
+# y para llenar la columna coordinates.ts (TIMESTAMPTZ) a partir del texto.
+DEVICE_UTC_OFFSET_HOURS = int(os.getenv('DEVICE_UTC_OFFSET_HOURS', '-5'))
+
+# Buffer de ingesta: las coordenadas se escriben en lotes de N filas o cada T ms
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '200'))
+INGEST_FLUSH_MS = int(os.getenv('INGEST_FLUSH_MS', '500'))
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', '10000'))  # tope antes de aplicar backpressure
+INGEST_PUT_TIMEOUT_MS = int(os.getenv('INGEST_PUT_TIMEOUT_MS', '100'))  # espera máxima por espacio antes de descartar
+INGEST_MAX_RETRIES = int(os.getenv('INGEST_MAX_RETRIES', '30'))  # reintentos de un lote si la BD no responde
+
+# Pool de workers de snap-to-road entre la recepción UDP y el buffer de escritura
+SNAP_WORKERS = int(os.getenv('SNAP_WORKERS', '4'))
+SNAP_QUEUE_SIZE = int(os.getenv('SNAP_QUEUE_SIZE', '5000'))
+
+# Ajuste de trayectorias: 'nearest' (cada fix por separado) o 'match' (ventanas por usuario a /match)
+SNAP_MODE = os.getenv('SNAP_MODE', 'nearest')
+MATCH_WINDOW = int(os.getenv('MATCH_WINDOW', '10'))  # fixes por ventana
+MATCH_MAX_WAIT_MS = int(os.getenv('MATCH_MAX_WAIT_MS', '3000'))  # espera máxima de un fix antes de enviar la ventana
+MATCH_CONTEXT_S = int(os.getenv('MATCH_CONTEXT_S', '30'))  # el último fix de la ventana anterior da contexto si es así de reciente
+
+# Servidor UDP asyncio (run.py --udp-mode async)
+ASYNC_MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', '1000'))  # paquetes procesándose a la vez
+ASYNC_OSRM_CONNECTIONS = int(os.getenv('ASYNC_OSRM_CONNECTIONS', '64'))  # conexiones keep-alive hacia OSRM
+
+# Modo multiproceso (run.py --udp-mode multiprocess): cada cuántos segundos reporta métricas cada worker
+UDP_WORKER_STATS_INTERVAL = float(os.getenv('UDP_WORKER_STATS_INTERVAL', '2'))
+
+# Registro en memoria de la última posición por usuario (endpoints en tiempo real)
+POSITION_TTL_SECONDS = int(os.getenv('POSITION_TTL_SECONDS', '30'))  # sin datos por más tiempo = inactivo
+POSITION_TOMBSTONES = int(os.getenv('POSITION_TOMBSTONES', '10000'))  # bajas recordadas para ?since= de /coordenadas/all
+# Congestión en memoria: ventanas de hasta N segundos se responden sin consultar la BD
+CONGESTION_MAX_WINDOW_S = int(os.getenv('CONGESTION_MAX_WINDOW_S', '300'))
+
+# Stream de posiciones (SSE): latido, eventos guardados para reconexión, cola por cliente
+STREAM_HEARTBEAT_S = float(os.getenv('STREAM_HEARTBEAT_S', '15'))
+STREAM_REPLAY_SIZE = int(os.getenv('STREAM_REPLAY_SIZE', '1000'))   # eventos para Last-Event-ID
+STREAM_CLIENT_QUEUE = int(os.getenv('STREAM_CLIENT_QUEUE', '256'))  # eventos pendientes antes de cortar al cliente
+STREAM_POLL_S = float(os.getenv('STREAM_POLL_S', '1'))              # consulta compartida si la ingesta está en otro proceso
+STREAM_RETRY_MS = int(os.getenv('STREAM_RETRY_MS', '3000'))         # espera del navegador antes de reconectar
+STREAM_GRID_DEG = float(os.getenv('STREAM_GRID_DEG', '0.01'))       # celda del índice de viewports (~1.1 km)
+STREAM_EMPRESA_REFRESH_S = float(os.getenv('STREAM_EMPRESA_REFRESH_S', '60'))  # recarga de usuario → empresa
+
+# Migración de coordinates.ts: filas por lote del backfill y pausa entre lotes
+TS_BACKFILL_CHUNK = int(os.getenv('TS_BACKFILL_CHUNK', '5000'))
+TS_BACKFILL_PAUSE_MS = int(os.getenv('TS_BACKFILL_PAUSE_MS', '50'))
 
 
 # Configuración OSRM
-OSRM_HOST = "http://localhost:5001"
\ No newline at end of file
+OSRM_HOST = os.getenv('OSRM_HOST', "http://localhost:5001")
+OSRM_POOL_SIZE = int(os.getenv('OSRM_POOL_SIZE', '32'))  # conexiones keep-alive del cliente compartido
+OSRM_TIMEOUT = float(os.getenv('OSRM_TIMEOUT', '2'))  # segundos de lectura por llamada
+OSRM_CONNECT_TIMEOUT = float(os.getenv('OSRM_CONNECT_TIMEOUT', '0.5'))
+# Circuit breaker: tras N fallos seguidos no se llama a OSRM durante T segundos
+OSRM_BREAKER_FAILURES = int(os.getenv('OSRM_BREAKER_FAILURES', '5'))
+OSRM_BREAKER_RESET_S = float(os.getenv('OSRM_BREAKER_RESET_S', '10'))
+OSRM_HEALTH_INTERVAL_S = float(os.getenv('OSRM_HEALTH_INTERVAL_S', '5'))  # cada cuánto se verifica OSRM en segundo plano
+
+# Motor de snap-to-road: 'osrm' (HTTP) o 'local' (en el proceso, desde un extracto .osm o .geojson)
+SNAP_ENGINE = os.getenv('SNAP_ENGINE', 'osrm')
+LOCAL_SNAP_FILE = os.getenv('LOCAL_SNAP_FILE', 'barranquilla-oficial.osm')  # un .pbf se convierte con: osmium cat x.osm.pbf -o x.osm
+LOCAL_SNAP_MAX_DISTANCE_M = float(os.getenv('LOCAL_SNAP_MAX_DISTANCE_M', '30'))  # más lejos de una calle = sin ajuste local
+LOCAL_SNAP_FALLBACK = os.getenv('LOCAL_SNAP_FALLBACK', 'true').lower() == 'true'  # sin ajuste local, preguntar a OSRM
+LOCAL_SNAP_VALIDATE_RATE = float(os.getenv('LOCAL_SNAP_VALIDATE_RATE', '0'))  # fracción de fixes comparados contra OSRM
+
+# Caché de snap-to-road por celda de cuadrícula: fixes a menos de una celda reusan el resultado
+SNAP_CACHE_SIZE = int(os.getenv('SNAP_CACHE_SIZE', '50000'))  # celdas en memoria (0 desactiva)
+SNAP_CACHE_TTL = float(os.getenv('SNAP_CACHE_TTL', '600'))  # segundos
+SNAP_CACHE_CELL_M = float(os.getenv('SNAP_CACHE_CELL_M', '5'))  # lado de la celda en metros
+# Rumbo/longitud por arista de OSRM (par de nodos); /route se consulta una vez por arista nueva
+OSRM_EDGE_CACHE_SIZE = int(os.getenv('OSRM_EDGE_CACHE_SIZE', '100000'))
+
+# Registro de segmentos (id entero estable por arista de OSRM)
+SEGMENT_MIN_GROWTH_M = float(os.getenv('SEGMENT_MIN_GROWTH_M', '2'))  # la geometría se reescribe si crece al menos esto
+SEGMENT_REGISTRY_RETRY_S = float(os.getenv('SEGMENT_REGISTRY_RETRY_S', '30'))  # reintento de carga si la BD falló
+SEGMENT_CACHE_SIZE = int(os.getenv('SEGMENT_CACHE_SIZE', '20000'))  # segmentos de segments_cache en memoria (0 desactiva)
+SEGMENT_CACHE_TTL = float(os.getenv('SEGMENT_CACHE_TTL', '3600'))  # segundos
+SEGMENT_BATCH_MAX = int(os.getenv('SEGMENT_BATCH_MAX', '1000'))  # segmentos por consulta en /api/segments/batch
+
+# Exportación de históricos: filas por viaje del cursor del lado del servidor
+HISTORY_STREAM_CHUNK = int(os.getenv('HISTORY_STREAM_CHUNK', '2000'))
+# Cada exportación usa su propia conexión (fuera del pool), con un tope de exportaciones simultáneas
+HISTORY_STREAM_MAX = int(os.getenv('HISTORY_STREAM_MAX', '4'))
+HISTORY_STATEMENT_TIMEOUT_MS = int(os.getenv('HISTORY_STATEMENT_TIMEOUT_MS', '60000'))
+HISTORY_IDLE_TIMEOUT_MS = int(os.getenv('HISTORY_IDLE_TIMEOUT_MS', '60000'))  # cliente que deja de leer la descarga
+# Paginación de históricos (?page_size=, ?cursor=): tamaño por defecto y máximo
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '5000'))
+HISTORY_PAGE_MAX = int(os.getenv('HISTORY_PAGE_MAX', '50000'))
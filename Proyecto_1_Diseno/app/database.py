@@ -1,128 +1,650 @@
 # app/database.py
 import psycopg2
-from app.config import DB_HOST, DB_NAME, DB_USER, DB_PASSWORD
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+from app.config import (
+    DB_HOST, DB_NAME, DB_USER, DB_PASSWORD,
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE,
+    DEVICE_UTC_OFFSET_HOURS, TS_BACKFILL_CHUNK, TS_BACKFILL_PAUSE_MS,
+    SEGMENT_CACHE_SIZE, SEGMENT_CACHE_TTL, HISTORY_STREAM_CHUNK, HISTORY_PAGE_SIZE,
+    HISTORY_STREAM_MAX, HISTORY_STATEMENT_TIMEOUT_MS, HISTORY_IDLE_TIMEOUT_MS
+)
+from app.cache import LRUCache
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import json
+import os
+import threading
+import time
 import logging
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+
+# ===== POOL DE CONEXIONES =====
+
+class ConnectionPool:
+    """
+    Pool de conexiones psycopg2 thread-safe.
+
+    Lo comparten el thread del listener UDP y los handlers de Flask.
+    Al pedir una conexión se verifica que siga viva (y con SELECT 1 si
+    estuvo inactiva más de `healthcheck_idle` segundos). Si el pool está
+    lleno, el llamador espera hasta `timeout` segundos.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_idle, **dsn):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._dsn = dsn
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, ultimo_uso)]
+        self._in_use = set()
+        self._opening = 0        # conexiones reservadas que se están abriendo
+        self._closed = False
+        self._stats = {
+            'created': 0,
+            'discarded': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'healthcheck_failures': 0
+        }
+
+        for _ in range(self.minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._dsn)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        """Verifica una conexión antes de entregarla."""
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """Obtiene una conexión sana del pool, esperando si está lleno."""
+        start = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("El pool de conexiones está cerrado")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if len(self._in_use) + self._opening < self.maxconn:
+                    conn, last_used = None, None
+                    break
+
+                if start is None:
+                    start = time.monotonic()
+                    self._stats['waits'] += 1
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._record_wait(start)
+                    raise PoolError(
+                        f"Timeout esperando conexión libre ({self.maxconn} en uso)"
+                    )
+                self._cond.wait(remaining)
+
+            # Reservar el cupo mientras se verifica/abre fuera del lock
+            self._opening += 1
+            if start is not None:
+                self._record_wait(start)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._stats['healthcheck_failures'] += 1
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._opening -= 1
+            self._in_use.add(conn)
+            self._stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn):
+        """Devuelve una conexión al pool (o la descarta si quedó inutilizable)."""
+        reusable = not conn.closed
+        if reusable and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                reusable = False
+
+        with self._cond:
+            self._in_use.discard(conn)
+            keep = reusable and not self._closed
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+        if not keep:
+            self._discard(conn)
+
+    def closeall(self):
+        """Cierra las conexiones inactivas; las que están en uso se cierran al devolverse."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            self._cond.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _record_wait(self, start):
+        waited = time.monotonic() - start
+        self._stats['wait_time_total'] += waited
+        self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+    def stats(self):
+        """Estadísticas del pool para monitoreo."""
+        with self._cond:
+            s = dict(self._stats)
+            in_use = len(self._in_use)
+            idle = len(self._idle)
+        return {
+            'min': self.minconn,
+            'max': self.maxconn,
+            'size': in_use + idle,
+            'in_use': in_use,
+            'idle': idle,
+            'checkouts': s['checkouts'],
+            'waits': s['waits'],
+            'wait_time_total_ms': round(s['wait_time_total'] * 1000, 2),
+            'wait_time_avg_ms': round(s['wait_time_total'] * 1000 / s['waits'], 2) if s['waits'] else 0,
+            'wait_time_max_ms': round(s['wait_time_max'] * 1000, 2),
+            'timeouts': s['timeouts'],
+            'created': s['created'],
+            'discarded': s['discarded'],
+            'healthcheck_failures': s['healthcheck_failures']
+        }
+
+
+class PooledConnection:
+    """
+    Envoltura de una conexión del pool.
+
+    Se comporta como la conexión de psycopg2, pero close() la devuelve al
+    pool. Usada con `with get_db() as conn:` hace rollback si hubo una
+    excepción y siempre la devuelve al salir (el commit sigue siendo explícito).
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("La conexión ya fue devuelta al pool")
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self._conn is not None and not self._conn.closed:
+            try:
+                self._conn.rollback()
+            except Exception:
+                pass
+        self.close()
+        return False
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_inherited_pools = []
+
+
+def get_pool():
+    """Retorna el pool global, creándolo en el primer uso (y de nuevo tras un fork)."""
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is not None and _pool_pid != os.getpid():
+                # Proceso hijo: las conexiones heredadas son del padre. No se cierran
+                # (cerrarlas enviaría Terminate por su socket); solo se conservan
+                # referenciadas para que el GC tampoco las cierre.
+                _inherited_pools.append(_pool)
+                _pool = None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_pid = os.getpid()
+                _pool = ConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE,
+                    host=DB_HOST,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD
+                )
+                log.info(f"✓ Pool de conexiones creado (min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return _pool
+
+
+def get_pool_stats():
+    """Estadísticas del pool de conexiones (vacío si aún no se creó en este proceso)."""
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    return _pool.stats()
+
 def create_segments_cache_table():
     """
     Crea una tabla para cachear información de segmentos de red.
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS segments_cache (
-            segment_id TEXT PRIMARY KEY,
-            street_name TEXT NOT NULL,
-            segment_length REAL DEFAULT 0,
-            bearing INTEGER DEFAULT 0,
-            start_lat REAL NOT NULL,
-            start_lon REAL NOT NULL,
-            end_lat REAL NOT NULL,
-            end_lon REAL NOT NULL,
-            geometry JSONB,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS segments_cache (
+                segment_id TEXT PRIMARY KEY,
+                street_name TEXT NOT NULL,
+                segment_length REAL DEFAULT 0,
+                bearing INTEGER DEFAULT 0,
+                start_lat REAL NOT NULL,
+                start_lon REAL NOT NULL,
+                end_lat REAL NOT NULL,
+                end_lon REAL NOT NULL,
+                geometry JSONB,
+                is_generated BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Tablas creadas antes de que cache_segment usara is_generated
+        cursor.execute("ALTER TABLE segments_cache ADD COLUMN IF NOT EXISTS is_generated BOOLEAN DEFAULT FALSE")
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_segments_cache_street_name
-        ON segments_cache(street_name);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_segments_cache_street_name
+            ON segments_cache(street_name);
+        ''')
     
-    conn.commit()
-    conn.close()
+        conn.commit()
     log.info("✓ Tabla 'segments_cache' verificada/creada")
 
 
+# Capa en memoria sobre segments_cache: la geometría de un segmento casi no cambia.
+# Escritura directa (write-through): cada upsert reemplaza la entrada en memoria.
+_segment_lru = LRUCache(SEGMENT_CACHE_SIZE, SEGMENT_CACHE_TTL)
+
+
+def _cached_segment_dict(segment_id, street_name, segment_length, bearing,
+                         start_lat, start_lon, end_lat, end_lon, geometry):
+    """Formato de get_cached_segment."""
+    return {
+        'segment_id': segment_id,
+        'street_name': street_name,
+        'segment_length': float(segment_length),
+        'bearing': int(bearing),
+        'nodes': [
+            {'lat': float(start_lat), 'lon': float(start_lon)},
+            {'lat': float(end_lat), 'lon': float(end_lon)}
+        ],
+        'geometry': geometry
+    }
+
+
+def get_segment_cache_stats():
+    """Aciertos y ocupación de la capa en memoria de segments_cache."""
+    return _segment_lru.stats()
+
+
+_SEGMENTS_CACHE_UPSERT = """
+    INSERT INTO segments_cache 
+    (segment_id, street_name, segment_length, bearing, 
+     start_lat, start_lon, end_lat, end_lon, geometry, is_generated)
+    VALUES %s
+    ON CONFLICT (segment_id) 
+    DO UPDATE SET
+        street_name = EXCLUDED.street_name,
+        segment_length = EXCLUDED.segment_length,
+        bearing = EXCLUDED.bearing,
+        start_lat = EXCLUDED.start_lat,
+        start_lon = EXCLUDED.start_lon,
+        end_lat = EXCLUDED.end_lat,
+        end_lon = EXCLUDED.end_lon,
+        geometry = EXCLUDED.geometry,
+        is_generated = EXCLUDED.is_generated,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
 def cache_segment(segment_id, street_name, segment_length, bearing, 
                   start_lat, start_lon, end_lat, end_lon, geometry=None, is_generated=False):
     """
     Cachea información de un segmento para uso futuro.
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            INSERT INTO segments_cache 
-            (segment_id, street_name, segment_length, bearing, 
-             start_lat, start_lon, end_lat, end_lon, geometry, is_generated)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (segment_id) 
-            DO UPDATE SET
-                street_name = EXCLUDED.street_name,
-                segment_length = EXCLUDED.segment_length,
-                bearing = EXCLUDED.bearing,
-                start_lat = EXCLUDED.start_lat,
-                start_lon = EXCLUDED.start_lon,
-                end_lat = EXCLUDED.end_lat,
-                end_lon = EXCLUDED.end_lon,
-                geometry = EXCLUDED.geometry,
-                is_generated = EXCLUDED.is_generated,
-                updated_at = CURRENT_TIMESTAMP
-        """, (segment_id, street_name, segment_length, bearing,
-              start_lat, start_lon, end_lat, end_lon, 
-              json.dumps(geometry) if geometry else None,
-              is_generated))
+            execute_values(cursor, _SEGMENTS_CACHE_UPSERT, [
+                (segment_id, street_name, segment_length, bearing,
+                 start_lat, start_lon, end_lat, end_lon, 
+                 json.dumps(geometry) if geometry else None,
+                 is_generated)
+            ])
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+        _segment_lru.put(segment_id, _cached_segment_dict(
+            segment_id, street_name, segment_length, bearing,
+            start_lat, start_lon, end_lat, end_lon, geometry
+        ))
         log.info(f"✓ Segmento {segment_id} cacheado ({'generado' if is_generated else 'real'})")
         return True
     except Exception as e:
+        # La fila en BD quedó en un estado desconocido: que la próxima lectura vaya a la BD
+        _segment_lru.pop(segment_id)
         log.error(f"❌ Error cacheando segmento {segment_id}: {e}")
         return False
 
 
+def cache_segments(segments):
+    """
+    Cachea varios segmentos (formato de get_cached_segment) en una sola sentencia.
+    """
+    if not segments:
+        return True
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            execute_values(cursor, _SEGMENTS_CACHE_UPSERT, [
+                (s['segment_id'], s['street_name'], s['segment_length'], s['bearing'],
+                 s['nodes'][0]['lat'], s['nodes'][0]['lon'], s['nodes'][-1]['lat'], s['nodes'][-1]['lon'],
+                 json.dumps(s['geometry']) if s.get('geometry') else None,
+                 bool(s.get('is_generated')))
+                for s in segments
+            ])
+            conn.commit()
+        for s in segments:
+            _segment_lru.put(s['segment_id'], _cached_segment_dict(
+                s['segment_id'], s['street_name'], s['segment_length'], s['bearing'],
+                s['nodes'][0]['lat'], s['nodes'][0]['lon'], s['nodes'][-1]['lat'], s['nodes'][-1]['lon'],
+                s.get('geometry')
+            ))
+        log.info(f"✓ {len(segments)} segmentos cacheados")
+        return True
+    except Exception as e:
+        for s in segments:
+            _segment_lru.pop(s['segment_id'])
+        log.error(f"❌ Error cacheando {len(segments)} segmentos: {e}")
+        return False
+
+
 def get_cached_segment(segment_id):
     """
     Obtiene un segmento desde la caché.
     """
+    return get_cached_segments([segment_id]).get(segment_id)
+
+
+def get_cached_segments(segment_ids):
+    """
+    Obtiene varios segmentos desde la caché: primero la capa en memoria y
+    los que falten con una sola consulta a segments_cache.
+    Retorna {segment_id: segmento} solo con los encontrados.
+    """
+    found = {}
+    missing = []
+    for segment_id in segment_ids:
+        segment = _segment_lru.get(segment_id)
+        if segment is not None:
+            found[segment_id] = segment
+        else:
+            missing.append(segment_id)
+    if not missing:
+        return found
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT segment_id, street_name, segment_length, bearing,
-                   start_lat, start_lon, end_lat, end_lon, geometry
-            FROM segments_cache
-            WHERE segment_id = %s
-        """, (segment_id,))
+            cursor.execute("""
+                SELECT segment_id, street_name, segment_length, bearing,
+                       start_lat, start_lon, end_lat, end_lon, geometry
+                FROM segments_cache
+                WHERE segment_id = ANY(%s)
+            """, (missing,))
         
-        result = cursor.fetchone()
-        conn.close()
+            results = cursor.fetchall()
         
-        if result:
-            return {
-                'segment_id': result[0],
-                'street_name': result[1],
-                'segment_length': float(result[2]),
-                'bearing': int(result[3]),
-                'nodes': [
-                    {'lat': float(result[4]), 'lon': float(result[5])},
-                    {'lat': float(result[6]), 'lon': float(result[7])}
-                ],
-                'geometry': json.loads(result[8]) if result[8] else None
-            }
-        return None
+        for result in results:
+            # JSONB ya llega decodificado
+            segment = _cached_segment_dict(*result)
+            _segment_lru.put(result[0], segment)
+            found[result[0]] = segment
+        return found
     except Exception as e:
-        log.error(f"Error obteniendo segmento cacheado {segment_id}: {e}")
-        return None
+        log.error(f"Error obteniendo {len(missing)} segmentos cacheados: {e}")
+        return found
+
+
+def get_segments_from_history(segment_ids, points_per_segment=50):
+    """
+    Reconstruye segmentos desde los históricos GPS (los primeros
+    `points_per_segment` puntos de cada uno), en una sola consulta.
+    Retorna {segment_id: segmento} solo para los que tienen 2+ puntos.
+    """
+    if not segment_ids:
+        return {}
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT segment_id, lat, lon, street_name, segment_length, bearing
+            FROM (
+                SELECT segment_id, lat, lon, street_name, segment_length, bearing,
+                       ROW_NUMBER() OVER (PARTITION BY segment_id ORDER BY ts) AS n
+                FROM coordinates
+                WHERE segment_id = ANY(%s)
+            ) t
+            WHERE n <= %s
+            ORDER BY segment_id, n
+        """, (list(segment_ids), points_per_segment))
+        rows = cursor.fetchall()
+
+    points = {}
+    for row in rows:
+        points.setdefault(row[0], []).append(row)
+    segments = {}
+    for segment_id, seg_rows in points.items():
+        if len(seg_rows) < 2:
+            continue
+        first = seg_rows[0]
+        segments[segment_id] = {
+            'segment_id': segment_id,
+            'street_name': first[3] if first[3] else 'Sin nombre',
+            'segment_length': float(first[4]) if first[4] else 0,
+            'bearing': int(first[5]) if first[5] else 0,
+            'nodes': [{'lat': float(row[1]), 'lon': float(row[2])} for row in seg_rows],
+            'source': 'gps_historical'
+        }
+    return segments
+
+
+def create_segment_registry_table():
+    """
+    Crea la tabla 'segment_registry': identidad estable de cada arista de
+    OSRM (par de nodos), con un id entero compacto. `legacy_id` es el hash
+    md5 que se usaba antes como segment_id. La geometría (inicio y fin) es
+    la de la arista cuando se conoce; si no, se amplía con los puntos
+    ajustados que van llegando a ella.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS segment_registry (
+                id SERIAL PRIMARY KEY,
+                legacy_id TEXT NOT NULL UNIQUE,
+                node_a BIGINT,
+                node_b BIGINT,
+                street_name TEXT NOT NULL DEFAULT 'Unknown',
+                segment_length REAL DEFAULT 0,
+                bearing INTEGER DEFAULT 0,
+                start_lat DOUBLE PRECISION NOT NULL,
+                start_lon DOUBLE PRECISION NOT NULL,
+                end_lat DOUBLE PRECISION NOT NULL,
+                end_lon DOUBLE PRECISION NOT NULL,
+                extent_m REAL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        conn.commit()
+    log.info("✓ Tabla 'segment_registry' verificada/creada")
+
+
+SEGMENT_REGISTRY_COLUMNS = '''
+    id, legacy_id, node_a, node_b, street_name, segment_length, bearing,
+    start_lat, start_lon, end_lat, end_lon, extent_m
+'''
+
+
+def _segment_registry_row(row):
+    return {
+        'id': row[0],
+        'legacy_id': row[1],
+        'node_pair': (row[2], row[3]) if row[2] is not None else None,
+        'street_name': row[4],
+        'segment_length': float(row[5] or 0),
+        'bearing': int(row[6] or 0),
+        'start': (row[7], row[8]),
+        'end': (row[9], row[10]),
+        'extent_m': float(row[11] or 0)
+    }
+
+
+def load_segment_registry():
+    """Todas las aristas registradas (se cargan una vez en memoria)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {SEGMENT_REGISTRY_COLUMNS} FROM segment_registry")
+        return [_segment_registry_row(row) for row in cursor.fetchall()]
+
+
+def get_registered_segments(segment_ids=(), legacy_ids=()):
+    """Aristas por id o por legacy_id, en una sola consulta por índice."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {SEGMENT_REGISTRY_COLUMNS} FROM segment_registry
+            WHERE id = ANY(%s) OR legacy_id = ANY(%s)
+        """, (list(segment_ids), list(legacy_ids)))
+        return [_segment_registry_row(row) for row in cursor.fetchall()]
+
+
+def register_segment(legacy_id, node_pair, street_name, segment_length, bearing, start, end, extent_m=0):
+    """
+    Registra una arista la primera vez que se ve, con su geometría (inicio y
+    fin como (lat, lon); ambos el punto ajustado si no se conoce). Si otro
+    proceso ya la registró retorna esa fila.
+    """
+    node_a, node_b = node_pair if node_pair else (None, None)
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            INSERT INTO segment_registry
+            (legacy_id, node_a, node_b, street_name, segment_length, bearing,
+             start_lat, start_lon, end_lat, end_lon, extent_m)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (legacy_id) DO UPDATE SET legacy_id = EXCLUDED.legacy_id
+            RETURNING {SEGMENT_REGISTRY_COLUMNS}
+        """, (legacy_id, node_a, node_b, street_name or 'Unknown', segment_length or 0, bearing or 0,
+              start[0], start[1], end[0], end[1], extent_m))
+        row = cursor.fetchone()
+        conn.commit()
+    return _segment_registry_row(row)
+
+
+def update_segment_geometry(segment_id, start, end, extent_m):
+    """Amplía la geometría de una arista (solo si la nueva es más larga que la guardada)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE segment_registry
+            SET start_lat = %s, start_lon = %s, end_lat = %s, end_lon = %s,
+                extent_m = %s, segment_length = GREATEST(segment_length, %s),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND extent_m < %s
+        """, (start[0], start[1], end[0], end[1], extent_m, extent_m, segment_id, extent_m))
+        conn.commit()
 
 def get_db():
-    """Establece una nueva conexión a la base de datos."""
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    return conn
+    """
+    Obtiene una conexión del pool.
+    Usar `with get_db() as conn:` (o llamar conn.close()) para devolverla.
+    """
+    pool = get_pool()
+    return PooledConnection(pool, pool.getconn())
+
+# ===== TIMESTAMPS =====
+# coordinates.timestamp es el texto que envía el dispositivo (hora local);
+# coordinates.ts es el mismo instante como TIMESTAMPTZ, indexado, para filtrar y ordenar.
+TIMESTAMP_FORMAT = '%d/%m/%Y %H:%M:%S'
+DEVICE_TZ = timezone(timedelta(hours=DEVICE_UTC_OFFSET_HOURS))
+
+@lru_cache(maxsize=4096)
+def coordinate_ts(timestamp_str):
+    """'DD/MM/YYYY HH:MM:SS' (hora del dispositivo) → datetime con zona, o None si no es válido."""
+    try:
+        return datetime.strptime(timestamp_str.strip(), TIMESTAMP_FORMAT).replace(tzinfo=DEVICE_TZ)
+    except (AttributeError, ValueError):
+        return None
+
+def device_datetime(dt):
+    """Interpreta un datetime sin zona (filtros de la UI) como hora de los dispositivos."""
+    if dt is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=DEVICE_TZ)
+    return dt
 
 def migrate_table():
     """
@@ -130,67 +652,63 @@ def migrate_table():
     Ejecutar esta función UNA SOLA VEZ para migrar de la estructura antigua a la nueva.
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        log.info("Iniciando migración de tabla coordinates...")
+            log.info("Iniciando migración de tabla coordinates...")
         
-        # Eliminar columnas device_name y device_id si existen
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            DROP COLUMN IF EXISTS device_name;
-        ''')
-        log.info("✓ Columna device_name eliminada")
+            # Eliminar columnas device_name y device_id si existen
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                DROP COLUMN IF EXISTS device_name;
+            ''')
+            log.info("✓ Columna device_name eliminada")
         
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            DROP COLUMN IF EXISTS device_id;
-        ''')
-        log.info("✓ Columna device_id eliminada")
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                DROP COLUMN IF EXISTS device_id;
+            ''')
+            log.info("✓ Columna device_id eliminada")
         
-        # Asegurar que los tipos de datos sean correctos
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            ALTER COLUMN lat TYPE REAL;
-        ''')
+            # Asegurar que los tipos de datos sean correctos
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                ALTER COLUMN lat TYPE REAL;
+            ''')
         
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            ALTER COLUMN lon TYPE REAL;
-        ''')
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                ALTER COLUMN lon TYPE REAL;
+            ''')
         
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            ALTER COLUMN timestamp TYPE TEXT;
-        ''')
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                ALTER COLUMN timestamp TYPE TEXT;
+            ''')
         
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            ALTER COLUMN source TYPE TEXT;
-        ''')
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                ALTER COLUMN source TYPE TEXT;
+            ''')
         
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            ALTER COLUMN user_id TYPE TEXT;
-        ''')
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                ALTER COLUMN user_id TYPE TEXT;
+            ''')
         
-        cursor.execute('''
-            ALTER TABLE coordinates 
-            ALTER COLUMN user_id DROP NOT NULL;
-        ''')
+            cursor.execute('''
+                ALTER TABLE coordinates 
+                ALTER COLUMN user_id DROP NOT NULL;
+            ''')
         
-        log.info("✓ Tipos de datos verificados/ajustados")
+            log.info("✓ Tipos de datos verificados/ajustados")
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         log.info("✓ Migración completada exitosamente")
         return True
         
     except Exception as e:
         log.error(f"Error durante la migración: {e}")
-        if conn:
-            conn.rollback()
-            conn.close()
         return False
 
 def create_table():
@@ -198,63 +716,62 @@ def create_table():
     Crea la tabla 'coordinates' si no existe.
     user_id ahora es TEXT para almacenar el número de cédula directamente.
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS coordinates (
-            id serial PRIMARY KEY,
-            lat REAL NOT NULL,
-            lon REAL NOT NULL,
-            timestamp TEXT NOT NULL,
-            source TEXT NOT NULL,
-            user_id TEXT
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS coordinates (
+                id serial PRIMARY KEY,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                timestamp TEXT NOT NULL,
+                source TEXT NOT NULL,
+                user_id TEXT,
+                ts TIMESTAMPTZ
+            )
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_coordinates_user_id
-        ON coordinates(user_id);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_coordinates_user_id
+            ON coordinates(user_id);
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_coordinates_timestamp
-        ON coordinates(timestamp);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_coordinates_timestamp
+            ON coordinates(timestamp);
+        ''')
 
-    conn.commit()
-    conn.close()
+        conn.commit()
     log.info("✓ Tabla 'coordinates' verificada/creada")
 
 def create_destinations_table():
     """Crea la tabla destinations si no existe."""
-    conn = get_db()
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS destinations (
-            id SERIAL PRIMARY KEY,
-            user_id VARCHAR(50) NOT NULL,
-            latitude DECIMAL(10, 8) NOT NULL,
-            longitude DECIMAL(11, 8) NOT NULL,
-            status VARCHAR(20) DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            delivered_at TIMESTAMP NULL
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS destinations (
+                id SERIAL PRIMARY KEY,
+                user_id VARCHAR(50) NOT NULL,
+                latitude DECIMAL(10, 8) NOT NULL,
+                longitude DECIMAL(11, 8) NOT NULL,
+                status VARCHAR(20) DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                delivered_at TIMESTAMP NULL
+            )
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_destinations_user_id 
-        ON destinations(user_id)
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_destinations_user_id 
+            ON destinations(user_id)
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_destinations_created_at 
-        ON destinations(created_at)
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_destinations_created_at 
+            ON destinations(created_at)
+        ''')
     
-    conn.commit()
-    conn.close()
+        conn.commit()
     log.info("✓ Tabla 'destinations' verificada/creada")
 
 def create_usuarios_web_table():  # ← Era create_usuarios_table()
@@ -262,39 +779,38 @@ def create_usuarios_web_table():  # ← Era create_usuarios_table()
     Crea la tabla 'usuarios_web' si no existe.
     user_id es la llave primaria (misma que se usa en coordinates).
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios_web (
-            user_id TEXT PRIMARY KEY,
-            cedula TEXT NOT NULL,
-            nombre_completo TEXT NOT NULL,
-            email TEXT NOT NULL,
-            telefono TEXT,
-            empresa TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usuarios_web (
+                user_id TEXT PRIMARY KEY,
+                cedula TEXT NOT NULL,
+                nombre_completo TEXT NOT NULL,
+                email TEXT NOT NULL,
+                telefono TEXT,
+                empresa TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_usuarios_web_cedula
-        ON usuarios_web(cedula);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_usuarios_web_cedula
+            ON usuarios_web(cedula);
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_usuarios_web_empresa
-        ON usuarios_web(empresa);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_usuarios_web_empresa
+            ON usuarios_web(empresa);
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_usuarios_web_email
-        ON usuarios_web(email);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_usuarios_web_email
+            ON usuarios_web(email);
+        ''')
 
-    conn.commit()
-    conn.close()
+        conn.commit()
     log.info("✓ Tabla 'usuarios_web' verificada/creada")
 
 
@@ -302,39 +818,38 @@ def create_rutas_table():
     """
     Crea la tabla 'rutas' para almacenar rutas preestablecidas por empresa.
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rutas (
-            id SERIAL PRIMARY KEY,
-            nombre_ruta TEXT NOT NULL,
-            empresa TEXT NOT NULL,
-            segment_ids TEXT NOT NULL,
-            descripcion TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            activa BOOLEAN DEFAULT TRUE
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rutas (
+                id SERIAL PRIMARY KEY,
+                nombre_ruta TEXT NOT NULL,
+                empresa TEXT NOT NULL,
+                segment_ids TEXT NOT NULL,
+                descripcion TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                activa BOOLEAN DEFAULT TRUE
+            )
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_rutas_empresa
-        ON rutas(empresa);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rutas_empresa
+            ON rutas(empresa);
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_rutas_activa
-        ON rutas(activa);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rutas_activa
+            ON rutas(activa);
+        ''')
     
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_rutas_nombre
-        ON rutas(nombre_ruta);
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rutas_nombre
+            ON rutas(nombre_ruta);
+        ''')
 
-    conn.commit()
-    conn.close()
+        conn.commit()
     log.info("✓ Tabla 'rutas' verificada/creada")
 
 def migrate_add_segment_fields():
@@ -343,33 +858,32 @@ def migrate_add_segment_fields():
     Ejecutar una sola vez si la tabla ya existe.
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        # Verificar si las columnas ya existen
-        cursor.execute("""
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name='coordinates' AND column_name='segment_id'
-        """)
+            # Verificar si las columnas ya existen
+            cursor.execute("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name='coordinates' AND column_name='segment_id'
+            """)
         
-        if cursor.fetchone() is None:
-            log.info("🔄 Agregando campos de segmentación a tabla existente...")
+            if cursor.fetchone() is None:
+                log.info("🔄 Agregando campos de segmentación a tabla existente...")
             
-            cursor.execute("ALTER TABLE coordinates ADD COLUMN segment_id TEXT DEFAULT NULL")
-            cursor.execute("ALTER TABLE coordinates ADD COLUMN street_name TEXT DEFAULT 'Unknown'")
-            cursor.execute("ALTER TABLE coordinates ADD COLUMN segment_length REAL DEFAULT 0")
-            cursor.execute("ALTER TABLE coordinates ADD COLUMN bearing INTEGER DEFAULT 0")
+                cursor.execute("ALTER TABLE coordinates ADD COLUMN segment_id TEXT DEFAULT NULL")
+                cursor.execute("ALTER TABLE coordinates ADD COLUMN street_name TEXT DEFAULT 'Unknown'")
+                cursor.execute("ALTER TABLE coordinates ADD COLUMN segment_length REAL DEFAULT 0")
+                cursor.execute("ALTER TABLE coordinates ADD COLUMN bearing INTEGER DEFAULT 0")
             
-            cursor.execute("CREATE INDEX idx_coordinates_segment_id ON coordinates(segment_id)")
-            cursor.execute("CREATE INDEX idx_coordinates_street_name ON coordinates(street_name)")
+                cursor.execute("CREATE INDEX idx_coordinates_segment_id ON coordinates(segment_id)")
+                cursor.execute("CREATE INDEX idx_coordinates_street_name ON coordinates(street_name)")
             
-            conn.commit()
-            log.info("✅ Migración completada exitosamente")
-        else:
-            log.info("✓ Campos de segmentación ya existen")
+                conn.commit()
+                log.info("✅ Migración completada exitosamente")
+            else:
+                log.info("✓ Campos de segmentación ya existen")
         
-        conn.close()
     except Exception as e:
         log.error(f"❌ Error en migración: {e}")
         raise
@@ -377,31 +891,196 @@ def migrate_add_segment_fields():
 def migrate_add_completed_at():
     """Migración para agregar completed_at a destinations."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        # Verificar si la columna ya existe
-        cursor.execute("""
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name='destinations' AND column_name='completed_at'
-        """)
+            # Verificar si la columna ya existe
+            cursor.execute("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name='destinations' AND column_name='completed_at'
+            """)
         
-        if cursor.fetchone() is None:
-            log.info("🔄 Agregando columna completed_at a destinations...")
+            if cursor.fetchone() is None:
+                log.info("🔄 Agregando columna completed_at a destinations...")
             
-            cursor.execute("ALTER TABLE destinations ADD COLUMN completed_at TIMESTAMP NULL")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_destinations_status ON destinations(status)")
+                cursor.execute("ALTER TABLE destinations ADD COLUMN completed_at TIMESTAMP NULL")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_destinations_status ON destinations(status)")
             
-            conn.commit()
-            log.info("✅ Migración completed_at completada")
-        else:
-            log.info("✓ Columna completed_at ya existe")
+                conn.commit()
+                log.info("✅ Migración completed_at completada")
+            else:
+                log.info("✓ Columna completed_at ya existe")
         
-        conn.close()
     except Exception as e:
         log.error(f"❌ Error en migración completed_at: {e}")
         raise
+
+def migrate_add_ts_column():
+    """
+    Migración para agregar coordinates.ts (TIMESTAMPTZ) a tablas existentes.
+
+    Agregar la columna sin DEFAULT es instantáneo. El llenado de las filas
+    existentes y los índices se hacen en un thread aparte (ver _backfill_ts)
+    para no demorar el arranque ni bloquear la tabla.
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name='coordinates' AND column_name='ts'
+            """)
+        
+            if cursor.fetchone() is None:
+                log.info("🔄 Agregando columna ts a coordinates...")
+                cursor.execute("ALTER TABLE coordinates ADD COLUMN ts TIMESTAMPTZ NULL")
+                conn.commit()
+                log.info("✅ Columna ts agregada")
+            else:
+                log.info("✓ Columna ts ya existe")
+        
+    except Exception as e:
+        log.error(f"❌ Error en migración ts: {e}")
+        raise
+
+    threading.Thread(target=_backfill_ts, name='ts-backfill', daemon=True).start()
+
+# Índices sobre ts; se crean con CONCURRENTLY para no bloquear las escrituras.
+# Con id al final, la paginación por (ts, id) de los históricos es un recorrido de rango
+TS_INDEXES = {
+    'idx_coordinates_user_ts_id': 'coordinates (user_id, ts, id)',
+    'idx_coordinates_ts_id': 'coordinates (ts, id)'
+}
+
+# Índices anteriores que los de TS_INDEXES cubren; se eliminan una vez creados los nuevos
+TS_INDEXES_REPLACED = ('idx_coordinates_user_ts', 'idx_coordinates_ts')
+
+# Advisory lock para que un solo proceso haga el backfill (reloader, varios workers)
+_TS_BACKFILL_LOCK = 0x636F6F7264       # 'coord'
+
+def _ts_index_valid(cursor, name):
+    """True/False si el índice existe y es válido o no; None si no existe."""
+    cursor.execute("""
+        SELECT i.indisvalid
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = %s
+    """, (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _ts_migration_done(cursor):
+    """La migración terminó si los índices de ts son válidos y ya no quedan los reemplazados."""
+    if not all(_ts_index_valid(cursor, name) for name in TS_INDEXES):
+        return False
+    cursor.execute("SELECT 1 FROM pg_class WHERE relname = ANY(%s)", (list(TS_INDEXES_REPLACED),))
+    return cursor.fetchone() is None
+
+def _backfill_ts_rows(cursor, lower, upper):
+    """
+    Convierte fila por fila (con coordinate_ts) un lote en el que TO_TIMESTAMP
+    falló, p. ej. por una fecha fuera de rango como 31/02/2025. Las filas que
+    no se pueden convertir quedan con ts NULL y se registran en el log.
+    """
+    cursor.execute("""
+        SELECT id, timestamp FROM coordinates
+        WHERE id > %s AND id <= %s AND ts IS NULL
+    """, (lower, upper))
+    values, invalid = [], []
+    for row_id, timestamp in cursor.fetchall():
+        ts = coordinate_ts(timestamp)
+        if ts is None:
+            invalid.append((row_id, timestamp))
+        else:
+            values.append((row_id, ts))
+    if values:
+        execute_values(cursor, """
+            UPDATE coordinates AS c SET ts = v.ts
+            FROM (VALUES %s) AS v (id, ts)
+            WHERE c.id = v.id
+        """, values, template="(%s, %s::timestamptz)", page_size=1000)
+    if invalid:
+        sample = ', '.join(f"{row_id}={timestamp!r}" for row_id, timestamp in invalid[:10])
+        log.warning(f"⚠️ {len(invalid)} coordenadas con timestamp inválido quedan sin ts: {sample}")
+    return len(values)
+
+def _backfill_ts():
+    """
+    Llena coordinates.ts en las filas anteriores a la migración, por lotes de
+    TS_BACKFILL_CHUNK ids (de las más recientes a las más antiguas, para que
+    las vistas en vivo queden completas primero), con un commit y una pausa
+    por lote. Al final crea los índices sobre ts. Una vez creados los
+    índices no se vuelve a buscar filas sin ts al arrancar.
+    """
+    conn = None
+    try:
+        conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        # TO_TIMESTAMP usa la zona de la sesión; en UTC el ::timestamp conserva la hora tal cual
+        cursor.execute("SET TIME ZONE 'UTC'")
+
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (_TS_BACKFILL_LOCK,))
+        if not cursor.fetchone()[0]:
+            log.info("✓ Backfill de ts en curso en otro proceso")
+            return
+
+        if _ts_migration_done(cursor):
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (_TS_BACKFILL_LOCK,))
+            return
+
+        cursor.execute("SELECT MIN(id), MAX(id) FROM coordinates WHERE ts IS NULL")
+        min_id, max_id = cursor.fetchone()
+        if min_id is not None:
+            log.info(f"🔄 Backfill de coordinates.ts (ids {min_id}-{max_id})...")
+            updated = 0
+            upper = max_id
+            while upper >= min_id:
+                lower = upper - TS_BACKFILL_CHUNK
+                try:
+                    # Solo textos con el formato esperado; los valores fuera de rango
+                    # (31/02, 25:00) pasan el filtro y hacen fallar el lote completo
+                    cursor.execute("""
+                        UPDATE coordinates
+                        SET ts = TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS')::timestamp
+                                 AT TIME ZONE make_interval(hours => %s)
+                        WHERE id > %s AND id <= %s
+                          AND ts IS NULL
+                          AND timestamp ~ '^\\d{1,2}/\\d{1,2}/\\d{4} \\d{1,2}:\\d{1,2}:\\d{1,2}$'
+                    """, (DEVICE_UTC_OFFSET_HOURS, lower, upper))
+                    updated += cursor.rowcount
+                except psycopg2.DataError as e:
+                    log.warning(f"⚠️ Lote de ids {lower + 1}-{upper} con fechas inválidas, convirtiendo fila por fila: {str(e).strip()}")
+                    updated += _backfill_ts_rows(cursor, lower, upper)
+                upper = lower
+                time.sleep(TS_BACKFILL_PAUSE_MS / 1000.0)
+            log.info(f"✅ Backfill de ts completado ({updated} filas)")
+
+        for name, definition in TS_INDEXES.items():
+            # Un CREATE INDEX CONCURRENTLY interrumpido deja el índice inválido: recrearlo
+            valid = _ts_index_valid(cursor, name)
+            if valid:
+                continue
+            if valid is not None:
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            log.info(f"🔄 Creando índice {name}...")
+            cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+            log.info(f"✅ Índice {name} creado")
+
+        for name in TS_INDEXES_REPLACED:
+            cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", (name,))
+            if cursor.fetchone():
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                log.info(f"✅ Índice {name} reemplazado")
+
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (_TS_BACKFILL_LOCK,))
+    except Exception as e:
+        log.error(f"❌ Error en backfill de ts: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
     
 def insert_coordinate(lat, lon, timestamp, source, user_id=None, 
                      segment_id=None, street_name='Unknown', 
@@ -411,16 +1090,16 @@ def insert_coordinate(lat, lon, timestamp, source, user_id=None,
     Todos los campos de segmentación son opcionales con valores por defecto.
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO coordinates 
-            (lat, lon, timestamp, source, user_id, segment_id, street_name, segment_length, bearing) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-            (lat, lon, timestamp, source, user_id, segment_id, street_name, segment_length, bearing)
-        )
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT INTO coordinates 
+                (lat, lon, timestamp, source, user_id, segment_id, street_name, segment_length, bearing, ts) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                (lat, lon, timestamp, source, user_id, segment_id, street_name, segment_length, bearing,
+                 coordinate_ts(timestamp))
+            )
+            conn.commit()
         
         segment_info = f"Segmento: {street_name} [{segment_id}]" if segment_id else "Sin segmento"
         log.info(f"✓ Guardado en BD: {lat:.6f}, {lon:.6f} | UserID: {user_id} | {segment_info}")
@@ -428,30 +1107,73 @@ def insert_coordinate(lat, lon, timestamp, source, user_id=None,
         log.error(f"❌ Error al insertar en BD: {e}")
         raise
 
+COORDINATE_COLUMNS = (
+    'lat', 'lon', 'timestamp', 'source', 'user_id',
+    'segment_id', 'street_name', 'segment_length', 'bearing', 'ts'
+)
+
+def insert_coordinates_bulk(rows):
+    """
+    Inserta varias coordenadas en una sola sentencia (VALUES multi-fila) y un solo commit.
+    Cada fila es un dict con las llaves de COORDINATE_COLUMNS (lat, lon, timestamp y
+    source son obligatorias; ts se calcula del timestamp si no viene).
+    Retorna la lista de ids generados, en el mismo orden.
+    """
+    if not rows:
+        return []
+
+    values = [
+        (
+            row['lat'], row['lon'], row['timestamp'], row['source'], row.get('user_id'),
+            row.get('segment_id'), row.get('street_name', 'Unknown'),
+            row.get('segment_length', 0), row.get('bearing', 0),
+            row.get('ts') or coordinate_ts(row['timestamp'])
+        )
+        for row in rows
+    ]
+
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            result = execute_values(
+                cursor,
+                f"""INSERT INTO coordinates ({', '.join(COORDINATE_COLUMNS)})
+                VALUES %s RETURNING id""",
+                values,
+                page_size=len(values),
+                fetch=True
+            )
+            conn.commit()
+
+        log.info(f"✓ Guardadas en BD {len(values)} coordenadas en lote")
+        return [r[0] for r in result]
+    except Exception as e:
+        log.error(f"❌ Error al insertar lote de {len(values)} coordenadas en BD: {e}")
+        raise
+
 def insert_user_registration(user_id, cedula, nombre_completo, email, telefono, empresa):
     """
     Inserta o actualiza un usuario en la base de datos.
     user_id es la llave primaria (mismo que se usa en coordinates).
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO usuarios_web 
-            (user_id, cedula, nombre_completo, email, telefono, empresa)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET
-                cedula = EXCLUDED.cedula,
-                nombre_completo = EXCLUDED.nombre_completo,
-                email = EXCLUDED.email,
-                telefono = EXCLUDED.telefono,
-                empresa = EXCLUDED.empresa,
-                updated_at = CURRENT_TIMESTAMP
-            """,
-            (user_id, cedula, nombre_completo, email, telefono, empresa)
-        )
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT INTO usuarios_web 
+                (user_id, cedula, nombre_completo, email, telefono, empresa)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    cedula = EXCLUDED.cedula,
+                    nombre_completo = EXCLUDED.nombre_completo,
+                    email = EXCLUDED.email,
+                    telefono = EXCLUDED.telefono,
+                    empresa = EXCLUDED.empresa,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (user_id, cedula, nombre_completo, email, telefono, empresa)
+            )
+            conn.commit()
         
         log.info(f"✓ Usuario guardado en BD: {user_id} | Cédula: {cedula} | Empresa: {empresa}")
     except Exception as e:
@@ -466,19 +1188,18 @@ def insert_ruta(nombre_ruta, empresa, segment_ids, descripcion=None):
     Ejemplo: "seg_123,seg_456,seg_789"
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO rutas 
-            (nombre_ruta, empresa, segment_ids, descripcion)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            """,
-            (nombre_ruta, empresa, segment_ids, descripcion)
-        )
-        ruta_id = cursor.fetchone()[0]
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT INTO rutas 
+                (nombre_ruta, empresa, segment_ids, descripcion)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+                """,
+                (nombre_ruta, empresa, segment_ids, descripcion)
+            )
+            ruta_id = cursor.fetchone()[0]
+            conn.commit()
         
         log.info(f"✓ Ruta guardada: {nombre_ruta} | Empresa: {empresa} | ID: {ruta_id}")
         return ruta_id
@@ -492,45 +1213,43 @@ def get_congestion_segments(time_window_seconds):
     Retorna lista de segmentos congestionados con coordenadas de los vehículos.
     """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("SET TIME ZONE 'America/Bogota'")
+            cursor.execute("SET TIME ZONE 'America/Bogota'")
         
-        # Query que incluye las coordenadas de todos los vehículos en el segmento
-        query = f"""
-            WITH recent_positions AS (
-                SELECT DISTINCT ON (user_id)
-                    user_id,
-                    lat,
-                    lon,
+            # Query que incluye las coordenadas de todos los vehículos en el segmento
+            query = """
+                WITH recent_positions AS (
+                    SELECT DISTINCT ON (user_id)
+                        user_id,
+                        lat,
+                        lon,
+                        segment_id,
+                        street_name,
+                        timestamp
+                    FROM coordinates
+                    WHERE segment_id IS NOT NULL
+                      AND ts >= NOW() - make_interval(secs => %s)
+                    ORDER BY user_id, ts DESC
+                )
+                SELECT 
                     segment_id,
                     street_name,
-                    timestamp
-                FROM coordinates
+                    COUNT(DISTINCT user_id) as vehicle_count,
+                    ARRAY_AGG(DISTINCT user_id) as vehicle_ids,
+                    AVG(lat) as center_lat,
+                    AVG(lon) as center_lon,
+                    ARRAY_AGG(ARRAY[lat, lon]) as segment_coords
+                FROM recent_positions
                 WHERE segment_id IS NOT NULL
-                  AND TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') 
-                      >= NOW() - INTERVAL '{time_window_seconds} seconds'
-                ORDER BY user_id, TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') DESC
-            )
-            SELECT 
-                segment_id,
-                street_name,
-                COUNT(DISTINCT user_id) as vehicle_count,
-                ARRAY_AGG(DISTINCT user_id) as vehicle_ids,
-                AVG(lat) as center_lat,
-                AVG(lon) as center_lon,
-                ARRAY_AGG(ARRAY[lat, lon]) as segment_coords
-            FROM recent_positions
-            WHERE segment_id IS NOT NULL
-            GROUP BY segment_id, street_name
-            HAVING COUNT(DISTINCT user_id) >= 2
-            ORDER BY vehicle_count DESC
-        """
+                GROUP BY segment_id, street_name
+                HAVING COUNT(DISTINCT user_id) >= 2
+                ORDER BY vehicle_count DESC
+            """
         
-        cursor.execute(query)
-        results = cursor.fetchall()
-        conn.close()
+            cursor.execute(query, (time_window_seconds,))
+            results = cursor.fetchall()
         
         congestion = []
         for row in results:
@@ -561,11 +1280,10 @@ def get_congestion_segments(time_window_seconds):
         
 def get_last_coordinate():
     """Obtiene la última coordenada registrada."""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM coordinates ORDER BY id DESC LIMIT 1")
-    data = cursor.fetchone()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM coordinates ORDER BY id DESC LIMIT 1")
+        data = cursor.fetchone()
 
     if data:
         column_names = ['id', 'lat', 'lon', 'timestamp', 'source', 'user_id']
@@ -574,148 +1292,246 @@ def get_last_coordinate():
 
 def get_latest_db_records(limit=20):
     """Obtiene los últimos N registros para la vista de base de datos."""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM coordinates ORDER BY id DESC LIMIT %s", (limit,))
-    data = cursor.fetchall()
-    column_names = ['id', 'lat', 'lon', 'timestamp', 'source', 'user_id']
-    results = [dict(zip(column_names, row)) for row in data]
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM coordinates ORDER BY id DESC LIMIT %s", (limit,))
+        data = cursor.fetchall()
+        column_names = ['id', 'lat', 'lon', 'timestamp', 'source', 'user_id']
+        results = [dict(zip(column_names, row)) for row in data]
     return results
 
 def get_historical_by_date(fecha_formateada, user_id=None):
     """Obtiene datos históricos por fecha (formato DD/MM/YYYY)."""
-    conn = get_db()
-    cursor = conn.cursor()
+    day_start = datetime.strptime(fecha_formateada, '%d/%m/%Y').replace(tzinfo=DEVICE_TZ)
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    query = "SELECT lat, lon, timestamp FROM coordinates WHERE timestamp LIKE %s"
-    params = [f"{fecha_formateada}%"]
+        query = "SELECT lat, lon, timestamp FROM coordinates WHERE ts >= %s AND ts < %s"
+        params = [day_start, day_start + timedelta(days=1)]
     
-    if user_id:
-        query += " AND user_id = %s"
-        params.append(str(user_id))
+        if user_id:
+            query += " AND user_id = %s"
+            params.append(str(user_id))
         
-    query += " ORDER BY timestamp"
+        query += " ORDER BY ts"
     
-    cursor.execute(query, tuple(params))
-    results = cursor.fetchall()
-    conn.close()
+        cursor.execute(query, tuple(params))
+        results = cursor.fetchall()
     
     coordenadas = [{'lat': float(r[0]), 'lon': float(r[1]), 'timestamp': r[2]} for r in results]
     log.info(f"Consulta histórica: {fecha_formateada} (User: {user_id}) - {len(coordenadas)} registros")
     return coordenadas
 
-def get_historical_by_range(start_datetime, end_datetime, user_id=None, user_ids=None):
+def _user_filter(user_id=None, user_ids=None):
+    """Condición SQL, parámetros y descripción del filtro de usuarios (user_ids tiene prioridad)."""
+    if user_ids and len(user_ids) > 0:
+        return "user_id = ANY(%s)", [[str(uid) for uid in user_ids]], f"Users: {user_ids}"
+    if user_id:
+        return "user_id = %s", [str(user_id)], f"User: {user_id}"
+    return None, [], "All users"
+
+# Exportaciones en curso: cada una tiene su conexión durante toda la descarga
+_history_streams = threading.BoundedSemaphore(max(1, HISTORY_STREAM_MAX))
+
+def _iter_historical(conditions, params, description):
     """
-    Obtiene datos históricos por rango de datetime (optimizado).
-    Acepta user_id (single) o user_ids (lista) para múltiples usuarios.
+    Recorre coordenadas en orden de (ts, id) con un cursor con nombre (del lado del
+    servidor), trayendo HISTORY_STREAM_CHUNK filas por viaje: la memoria no
+    depende del tamaño del rango y no hay tope de filas. Los duplicados
+    exactos (mismo punto, hora y usuario) se descartan al vuelo, comparando
+    solo dentro de cada ts, en lugar de un SELECT DISTINCT que obliga a
+    ordenar todo el resultado antes de enviar la primera fila.
+
+    La descarga dura lo que tarde el cliente en leerla, así que usa una
+    conexión propia y no una del pool (la comparte el buffer de ingesta),
+    con statement_timeout e idle_in_transaction_session_timeout. Como mucho
+    HISTORY_STREAM_MAX exportaciones a la vez; las demás esperan
+    DB_POOL_TIMEOUT segundos y fallan con PoolError.
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    if not _history_streams.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError(f"Hay {HISTORY_STREAM_MAX} exportaciones de históricos en curso")
+    count = 0
+    conn = None
+    try:
+        conn = psycopg2.connect(
+            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+            options=(f"-c statement_timeout={HISTORY_STATEMENT_TIMEOUT_MS} "
+                     f"-c idle_in_transaction_session_timeout={HISTORY_IDLE_TIMEOUT_MS}")
+        )
+        conn.set_session(readonly=True)
+        cursor = conn.cursor(name='historico')
+        cursor.itersize = HISTORY_STREAM_CHUNK
+        cursor.execute(f"""
+            SELECT lat, lon, timestamp, user_id, ts
+            FROM coordinates
+            WHERE {' AND '.join(conditions)}
+            ORDER BY ts, id
+        """, tuple(params))
+        current_ts, seen = None, set()
+        for lat, lon, timestamp, user_id, ts in cursor:
+            if ts != current_ts:
+                current_ts, seen = ts, set()
+            key = (lat, lon, timestamp, user_id)
+            if key in seen:
+                continue
+            seen.add(key)
+            count += 1
+            yield {'lat': float(lat), 'lon': float(lon), 'timestamp': timestamp, 'user_id': user_id}
+    finally:
+        if conn is not None:
+            conn.close()
+        _history_streams.release()
+    log.info(f"{description}: {count} registros")
 
-    query_base = """
-        SELECT DISTINCT
-            lat,
-            lon,
-            timestamp,
-            user_id,
-            TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') AS ts_orden
-        FROM coordinates
-        WHERE TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS')
-              BETWEEN %s AND %s
+def _range_filter(start_datetime, end_datetime, user_id=None, user_ids=None, per_user=False):
     """
-    params = [start_datetime, end_datetime]
+    Condiciones, parámetros y descripción de una consulta histórica por rango.
+    Con per_user se omite la condición de user_ids (la aplica _historical_page por usuario).
+    """
+    conditions = ["ts BETWEEN %s AND %s"]
+    params = [device_datetime(start_datetime), device_datetime(end_datetime)]
+    user_condition, user_params, user_filter_msg = _user_filter(user_id, user_ids)
+    if user_condition and not (per_user and user_ids):
+        conditions.append(user_condition)
+        params.extend(user_params)
+    return conditions, params, f"Consulta por rango: {start_datetime} a {end_datetime} ({user_filter_msg})"
 
-    # Priorizar user_ids sobre user_id
-    if user_ids and len(user_ids) > 0:
-        placeholders = ','.join(['%s'] * len(user_ids))
-        query_base += f" AND user_id IN ({placeholders})"
-        params.extend([str(uid) for uid in user_ids])
-        user_filter_msg = f"Users: {user_ids}"
-    elif user_id:
-        query_base += " AND user_id = %s"
-        params.append(str(user_id))
-        user_filter_msg = f"User: {user_id}"
-    else:
-        user_filter_msg = "All users"
-
-    query = query_base + " ORDER BY ts_orden LIMIT 50000;"
-
-    cursor.execute(query, tuple(params))
-    results = cursor.fetchall()
-    conn.close()
-
-    coordenadas = [{'lat': float(r[0]), 'lon': float(r[1]), 'timestamp': r[2], 'user_id': r[3]} for r in results]
-    log.info(f"Consulta optimizada: {start_datetime} a {end_datetime} ({user_filter_msg}) - {len(coordenadas)} registros")
-    return coordenadas
+def _geofence_filter(min_lat, max_lat, min_lon, max_lon, user_id=None, user_ids=None,
+                     start_datetime=None, end_datetime=None, per_user=False):
+    """Condiciones, parámetros y descripción de una consulta histórica por geocerca (per_user: ver _range_filter)."""
+    conditions = ["lat BETWEEN %s AND %s", "lon BETWEEN %s AND %s"]
+    params = [min_lat, max_lat, min_lon, max_lon]
+    if start_datetime and end_datetime:
+        conditions.append("ts BETWEEN %s AND %s")
+        params.extend([device_datetime(start_datetime), device_datetime(end_datetime)])
+    user_condition, user_params, user_filter_msg = _user_filter(user_id, user_ids)
+    if user_condition and not (per_user and user_ids):
+        conditions.append(user_condition)
+        params.extend(user_params)
+    time_range = f" [{start_datetime} - {end_datetime}]" if start_datetime and end_datetime else ""
+    return conditions, params, f"Consulta por Geocerca ({user_filter_msg}){time_range}"
+
+def iter_historical_by_range(start_datetime, end_datetime, user_id=None, user_ids=None):
+    """
+    Coordenadas históricas por rango de datetime, en orden de tiempo (generador).
+    Acepta user_id (single) o user_ids (lista) para múltiples usuarios.
+    """
+    return _iter_historical(*_range_filter(start_datetime, end_datetime, user_id, user_ids))
 
-def get_historical_by_geofence(min_lat, max_lat, min_lon, max_lon, user_id=None, user_ids=None, start_datetime=None, end_datetime=None):
+def iter_historical_by_geofence(min_lat, max_lat, min_lon, max_lon, user_id=None, user_ids=None,
+                                start_datetime=None, end_datetime=None):
     """
-    Obtiene datos históricos por geocerca (bounds).
+    Coordenadas históricas dentro de una geocerca (bounds), en orden de tiempo (generador).
     Acepta user_id (single) o user_ids (lista) para múltiples usuarios.
     Opcionalmente filtra por rango de tiempo.
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    return _iter_historical(*_geofence_filter(
+        min_lat, max_lat, min_lon, max_lon, user_id, user_ids, start_datetime, end_datetime
+    ))
 
-    query_base = """
-        SELECT DISTINCT
-            lat,
-            lon,
-            timestamp,
-            user_id,
-            TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') AS ts_orden
-        FROM coordinates
-        WHERE (lat BETWEEN %s AND %s)
-          AND (lon BETWEEN %s AND %s)
+def _historical_page(conditions, params, description, after=None, page_size=HISTORY_PAGE_SIZE, user_ids=None):
     """
-    params = [min_lat, max_lat, min_lon, max_lon]
+    Una página de coordenadas en orden de (ts, id), empezando después de la
+    llave `after` (ts, id) de la página anterior. Con el índice (ts, id) cada
+    página es un recorrido de rango que se detiene a las `page_size` filas,
+    sin ordenar el resultado completo. Con `user_ids` (las condiciones vienen
+    sin ese filtro, ver per_user) se recorre el índice (user_id, ts, id) de
+    cada usuario hasta `page_size` filas y solo se mezclan esas: con ANY el
+    índice no entrega el orden y cada página ordenaba todo el rango.
 
-    # Filtro de tiempo opcional
-    if start_datetime and end_datetime:
-        query_base += " AND TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') BETWEEN %s AND %s"
-        params.extend([start_datetime, end_datetime])
+    Los duplicados exactos se descartan al vuelo dentro de cada ts, como en
+    _iter_historical. Para que no reaparezcan en la página siguiente, la
+    página se completa hasta el final de su último ts.
+    Retorna (coordenadas, llave de la siguiente página o None si no hay más).
+    """
+    conditions = conditions + ["ts IS NOT NULL"]
+    params = list(params)
+    if after is not None:
+        conditions.append("(ts, id) > (%s, %s)")
+        params.extend(after)
+    where = ' AND '.join(conditions)
+    users = list(dict.fromkeys(str(uid) for uid in user_ids)) if user_ids else None
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if users:
+            cursor.execute(f"""
+                SELECT c.lat, c.lon, c.timestamp, c.user_id, c.ts, c.id
+                FROM unnest(%s::text[]) AS u(uid)
+                CROSS JOIN LATERAL (
+                    SELECT lat, lon, timestamp, user_id, ts, id
+                    FROM coordinates
+                    WHERE {where} AND user_id = u.uid
+                    ORDER BY ts, id
+                    LIMIT %s
+                ) c
+                ORDER BY c.ts, c.id
+                LIMIT %s
+            """, (users,) + tuple(params) + (page_size, page_size))
+        else:
+            cursor.execute(f"""
+                SELECT lat, lon, timestamp, user_id, ts, id
+                FROM coordinates
+                WHERE {where}
+                ORDER BY ts, id
+                LIMIT %s
+            """, tuple(params) + (page_size,))
+        results = cursor.fetchall()
+        full = len(results) == page_size
+        if full:
+            # Resto del último ts (por el mismo índice): así sus duplicados quedan en esta página
+            last_ts, last_id = results[-1][4], results[-1][5]
+            user_condition = " AND user_id = ANY(%s)" if users else ""
+            cursor.execute(f"""
+                SELECT lat, lon, timestamp, user_id, ts, id
+                FROM coordinates
+                WHERE {where}{user_condition} AND ts = %s AND id > %s
+                ORDER BY id
+            """, tuple(params) + ((users,) if users else ()) + (last_ts, last_id))
+            results.extend(cursor.fetchall())
 
-    # Priorizar user_ids sobre user_id
-    if user_ids and len(user_ids) > 0:
-        placeholders = ','.join(['%s'] * len(user_ids))
-        query_base += f" AND user_id IN ({placeholders})"
-        params.extend([str(uid) for uid in user_ids])
-        user_filter_msg = f"Users: {user_ids}"
-    elif user_id:
-        query_base += " AND user_id = %s"
-        params.append(str(user_id))
-        user_filter_msg = f"User: {user_id}"
-    else:
-        user_filter_msg = "All users"
-
-    query = query_base + " ORDER BY ts_orden LIMIT 50000;"
-
-    cursor.execute(query, tuple(params))
-    results = cursor.fetchall()
-    conn.close()
-
-    coordenadas = [{'lat': float(r[0]), 'lon': float(r[1]), 'timestamp': r[2], 'user_id': r[3]} for r in results]
-    time_range = f" [{start_datetime} - {end_datetime}]" if start_datetime and end_datetime else ""
-    log.info(f"Consulta por Geocerca ({user_filter_msg}){time_range}: {len(coordenadas)} registros encontrados")
-    return coordenadas
+    coordenadas = []
+    current_ts, seen = None, set()
+    for lat, lon, timestamp, user_id, ts, _ in results:
+        if ts != current_ts:
+            current_ts, seen = ts, set()
+        key = (lat, lon, timestamp, user_id)
+        if key in seen:
+            continue
+        seen.add(key)
+        coordenadas.append({'lat': float(lat), 'lon': float(lon), 'timestamp': timestamp, 'user_id': user_id})
+    next_after = (results[-1][4], results[-1][5]) if full else None
+    log.info(f"{description}: página de {len(coordenadas)} registros")
+    return coordenadas, next_after
+
+def get_historical_by_range_page(start_datetime, end_datetime, user_id=None, user_ids=None,
+                                 after=None, page_size=HISTORY_PAGE_SIZE):
+    """Página de iter_historical_by_range (ver _historical_page)."""
+    return _historical_page(*_range_filter(start_datetime, end_datetime, user_id, user_ids, per_user=True),
+                            after=after, page_size=page_size, user_ids=user_ids)
+
+def get_historical_by_geofence_page(min_lat, max_lat, min_lon, max_lon, user_id=None, user_ids=None,
+                                    start_datetime=None, end_datetime=None,
+                                    after=None, page_size=HISTORY_PAGE_SIZE):
+    """Página de iter_historical_by_geofence (ver _historical_page)."""
+    return _historical_page(*_geofence_filter(
+        min_lat, max_lat, min_lon, max_lon, user_id, user_ids, start_datetime, end_datetime, per_user=True
+    ), after=after, page_size=page_size, user_ids=user_ids)
     
 def get_last_coordinate_by_user(user_id):
     """Obtiene la última coordenada de un usuario específico."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT lat, lon, timestamp, source
-            FROM coordinates 
-            WHERE user_id = %s
-            ORDER BY TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') DESC 
-            LIMIT 1
-        """, (str(user_id),))
+            cursor.execute("""
+                SELECT lat, lon, timestamp, source
+                FROM coordinates 
+                WHERE user_id = %s AND ts IS NOT NULL
+                ORDER BY ts DESC, id DESC
+                LIMIT 1
+            """, (str(user_id),))
         
-        data = cursor.fetchone()
-        conn.close()
+            data = cursor.fetchone()
 
         if data:
             return {
@@ -731,23 +1547,62 @@ def get_last_coordinate_by_user(user_id):
         log.error(f"Error obteniendo coordenada de usuario {user_id}: {e}")
         return {'success': False, 'error': str(e)}
 
+def get_latest_positions(window_seconds):
+    """
+    Última coordenada de cada usuario con datos en los últimos `window_seconds`.
+    Retorna dicts con id, lat, lon, timestamp, source, user_id y ts.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT ON (user_id)
+                id, lat, lon, timestamp, source, user_id, ts
+            FROM coordinates
+            WHERE user_id IS NOT NULL
+              AND ts >= NOW() - make_interval(secs => %s)
+            ORDER BY user_id, ts DESC
+        """, (window_seconds,))
+        rows = cursor.fetchall()
+
+    column_names = ['id', 'lat', 'lon', 'timestamp', 'source', 'user_id', 'ts']
+    return [dict(zip(column_names, row)) for row in rows]
+
+def get_latest_segment_positions(window_seconds):
+    """
+    Último fix con segmento de cada usuario con datos en los últimos
+    `window_seconds` (la misma posición que usa get_congestion_segments).
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT ON (user_id)
+                user_id, lat, lon, segment_id, street_name, ts
+            FROM coordinates
+            WHERE segment_id IS NOT NULL
+              AND user_id IS NOT NULL
+              AND ts >= NOW() - make_interval(secs => %s)
+            ORDER BY user_id, ts DESC
+        """, (window_seconds,))
+        rows = cursor.fetchall()
+
+    column_names = ['user_id', 'lat', 'lon', 'segment_id', 'street_name', 'ts']
+    return [dict(zip(column_names, row)) for row in rows]
+
 def get_active_devices():
     """Obtiene dispositivos activos (últimos 2 minutos)."""
-    conn = get_db()
-    cursor = conn.cursor()
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("SET TIME ZONE 'America/Bogota'")
+        cursor.execute("SET TIME ZONE 'America/Bogota'")
     
-    cursor.execute('''
-        SELECT DISTINCT user_id
-        FROM coordinates 
-        WHERE user_id IS NOT NULL 
-          AND TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') 
-              >= NOW() - INTERVAL '30 seconds'
-    ''')
+        cursor.execute('''
+            SELECT DISTINCT user_id
+            FROM coordinates 
+            WHERE user_id IS NOT NULL 
+              AND ts >= NOW() - INTERVAL '30 seconds'
+        ''')
     
-    results = cursor.fetchall()
-    conn.close()
+        results = cursor.fetchall()
     
     devices = [{
         'user_id': user_id,
@@ -762,18 +1617,17 @@ def get_active_devices():
 def get_rutas_by_empresa(empresa):
     """Obtiene todas las rutas activas de una empresa."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT id, nombre_ruta, segment_ids, descripcion, created_at, updated_at
-            FROM rutas 
-            WHERE empresa = %s AND activa = TRUE
-            ORDER BY created_at DESC
-            """,
-            (empresa,)
-        )
-        results = cursor.fetchall()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT id, nombre_ruta, segment_ids, descripcion, created_at, updated_at
+                FROM rutas 
+                WHERE empresa = %s AND activa = TRUE
+                ORDER BY created_at DESC
+                """,
+                (empresa,)
+            )
+            results = cursor.fetchall()
         
         rutas = []
         for row in results:
@@ -795,17 +1649,16 @@ def get_rutas_by_empresa(empresa):
 def get_all_rutas():
     """Obtiene todas las rutas activas agrupadas por empresa."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT id, nombre_ruta, empresa, segment_ids, descripcion, created_at
-            FROM rutas 
-            WHERE activa = TRUE
-            ORDER BY empresa, created_at DESC
-            """
-        )
-        results = cursor.fetchall()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT id, nombre_ruta, empresa, segment_ids, descripcion, created_at
+                FROM rutas 
+                WHERE activa = TRUE
+                ORDER BY empresa, created_at DESC
+                """
+            )
+            results = cursor.fetchall()
         
         rutas = []
         for row in results:
@@ -824,20 +1677,54 @@ def get_all_rutas():
         log.error(f"❌ Error obteniendo todas las rutas: {e}")
         return []
 
-def get_empresas_from_usuarios():
-    """Obtiene lista de empresas únicas registradas en tabla usuarios_web."""
-    try:
-        conn = get_db()
+def get_ruta_by_id(ruta_id):
+    """Obtiene una ruta activa por su id, o None."""
+    with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            """SELECT DISTINCT empresa 
-            FROM usuarios_web 
+            """SELECT id, nombre_ruta, empresa, segment_ids, descripcion
+            FROM rutas
+            WHERE id = %s AND activa = TRUE
+            """,
+            (ruta_id,)
+        )
+        row = cursor.fetchone()
+    
+    if row is None:
+        return None
+    return {
+        'id': row[0],
+        'nombre_ruta': row[1],
+        'empresa': row[2],
+        'segment_ids': row[3],
+        'descripcion': row[4]
+    }
+
+def get_user_empresas():
+    """Empresa de cada usuario registrado: {user_id: empresa}."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT user_id, empresa
+            FROM usuarios_web
             WHERE empresa IS NOT NULL AND empresa != ''
-            ORDER BY empresa
             """
         )
-        results = cursor.fetchall()
-        conn.close()
+        return dict(cursor.fetchall())
+
+def get_empresas_from_usuarios():
+    """Obtiene lista de empresas únicas registradas en tabla usuarios_web."""
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT DISTINCT empresa 
+                FROM usuarios_web 
+                WHERE empresa IS NOT NULL AND empresa != ''
+                ORDER BY empresa
+                """
+            )
+            results = cursor.fetchall()
         
         empresas = [row[0] for row in results]
         log.info(f"Empresas encontradas: {len(empresas)}")
@@ -849,30 +1736,29 @@ def get_empresas_from_usuarios():
 def update_ruta(ruta_id, nombre_ruta=None, segment_ids=None, descripcion=None):
     """Actualiza una ruta existente."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        updates = []
-        params = []
+            updates = []
+            params = []
         
-        if nombre_ruta is not None:
-            updates.append("nombre_ruta = %s")
-            params.append(nombre_ruta)
-        if segment_ids is not None:
-            updates.append("segment_ids = %s")
-            params.append(segment_ids)
-        if descripcion is not None:
-            updates.append("descripcion = %s")
-            params.append(descripcion)
+            if nombre_ruta is not None:
+                updates.append("nombre_ruta = %s")
+                params.append(nombre_ruta)
+            if segment_ids is not None:
+                updates.append("segment_ids = %s")
+                params.append(segment_ids)
+            if descripcion is not None:
+                updates.append("descripcion = %s")
+                params.append(descripcion)
         
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        params.append(ruta_id)
+            updates.append("updated_at = CURRENT_TIMESTAMP")
+            params.append(ruta_id)
         
-        query = f"UPDATE rutas SET {', '.join(updates)} WHERE id = %s"
-        cursor.execute(query, tuple(params))
+            query = f"UPDATE rutas SET {', '.join(updates)} WHERE id = %s"
+            cursor.execute(query, tuple(params))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
         
         log.info(f"✓ Ruta {ruta_id} actualizada")
         return True
@@ -883,14 +1769,13 @@ def update_ruta(ruta_id, nombre_ruta=None, segment_ids=None, descripcion=None):
 def delete_ruta(ruta_id):
     """Desactiva una ruta (soft delete)."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE rutas SET activa = FALSE, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-            (ruta_id,)
-        )
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE rutas SET activa = FALSE, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                (ruta_id,)
+            )
+            conn.commit()
         
         log.info(f"✓ Ruta {ruta_id} desactivada")
         return True
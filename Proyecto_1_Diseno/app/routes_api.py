@@ -1,16 +1,33 @@
 # app/routes_api.py
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, Response, jsonify, request, current_app
 from app.database import (
     get_last_coordinate, get_historical_by_date, 
-    get_historical_by_range, get_historical_by_geofence, 
-    get_db, get_active_devices, get_last_coordinate_by_user, get_congestion_segments, 
+    iter_historical_by_range, iter_historical_by_geofence, 
+    get_historical_by_range_page, get_historical_by_geofence_page, 
+    get_db, 
     get_empresas_from_usuarios, get_rutas_by_empresa, get_all_rutas, 
-    insert_ruta, update_ruta, delete_ruta
+    insert_ruta, update_ruta, delete_ruta, get_pool_stats, get_ruta_by_id,
+    get_segment_cache_stats
+)
+from app.config import (
+    SEGMENT_BATCH_MAX, STREAM_HEARTBEAT_S, STREAM_RETRY_MS, HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX
 )
 from app.utils import get_git_info
-from app.services_osrm import check_osrm_available
+from app.services_osrm import (
+    get_osrm_monitor, get_snap_cache_stats, get_osrm_client, get_osrm_stats, OSRMUnavailable
+)
+from app.services_ingest import get_ingest_stats
+from app.services_udp_async import get_async_ingest_stats
+from app.services_udp_multiproc import get_udp_worker_stats
+from app.services_positions import get_position_registry, position_to_device
+from app.services_congestion import get_congestion_tracker
+from app.services_stream import get_position_stream, format_event, parse_bbox
+from app.services_localsnap import get_local_snap_stats
+from app.services_segments import resolve_segments, get_segment_registry_stats
 from datetime import datetime
-import requests
+import base64
+import itertools
+import json
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -26,108 +43,17 @@ pending_destinations = {}
 
 def get_segment_by_id(segment_id):
     """
-    Obtener geometría de un segmento por su ID.
-    
-    Estrategia multi-capa:
-    1. Caché en BD (segments_cache)
-    2. Históricos GPS (coordinates)
-    3. Reconstrucción usando OSRM
+    Obtener geometría de un segmento por su ID (ver resolve_segments):
+    registro de segmentos y, para ids md5 anteriores, segments_cache o históricos GPS.
     """
     try:
-        from app.database import get_cached_segment, cache_segment
-        from app.services_osrm import reconstruct_segment_from_osrm
-        
         log.info(f"🔍 Buscando segmento: {segment_id}")
-        
-        # ==== CAPA 1: CACHÉ ====
-        cached = get_cached_segment(segment_id)
-        if cached:
-            log.info(f"✅ Segmento {segment_id} encontrado en caché")
-            return jsonify({'success': True, 'segment': cached})
-        
-        # ==== CAPA 2: HISTÓRICOS GPS ====
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Obtener coordenadas GPS reales de vehículos que pasaron por aquí
-        cursor.execute("""
-            SELECT 
-                lat, lon, timestamp,
-                street_name,
-                segment_length,
-                bearing
-            FROM coordinates
-            WHERE segment_id = %s
-            ORDER BY TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS')
-            LIMIT 50
-        """, (segment_id,))
-        
-        gps_coords = cursor.fetchall()
-        
-        if gps_coords and len(gps_coords) >= 2:
-            # Tenemos datos GPS reales
-            nodes = [{'lat': float(row[0]), 'lon': float(row[1])} for row in gps_coords]
-            
-            # Tomar metadatos del primer registro
-            segment = {
-                'segment_id': segment_id,
-                'street_name': gps_coords[0][3] if gps_coords[0][3] else 'Sin nombre',
-                'segment_length': float(gps_coords[0][4]) if gps_coords[0][4] else 0,
-                'bearing': int(gps_coords[0][5]) if gps_coords[0][5] else 0,
-                'nodes': nodes,
-                'source': 'gps_historical'
-            }
-            
-            conn.close()
-            
-            # Cachear
-            cache_segment(
-                segment['segment_id'],
-                segment['street_name'],
-                segment['segment_length'],
-                segment['bearing'],
-                nodes[0]['lat'], nodes[0]['lon'],
-                nodes[-1]['lat'], nodes[-1]['lon']
-            )
-            
-            log.info(f"✅ Segmento {segment_id} reconstruido desde GPS ({len(nodes)} puntos)")
+        segment = resolve_segments([segment_id]).get(segment_id)
+        if segment:
             return jsonify({'success': True, 'segment': segment})
         
-        conn.close()
-        
-        # ==== CAPA 3: RECONSTRUCCIÓN CON OSRM ====
-        log.warning(f"⚠️ Segmento {segment_id} sin histórico GPS, usando OSRM para estimar")
-        
-        # Intentar reconstruir usando OSRM
-        reconstructed = reconstruct_segment_from_osrm(segment_id)
-        
-        if reconstructed:
-            # Cachear el segmento reconstruido
-            cache_segment(
-                reconstructed['segment_id'],
-                reconstructed['street_name'],
-                reconstructed['segment_length'],
-                reconstructed['bearing'],
-                reconstructed['nodes'][0]['lat'],
-                reconstructed['nodes'][0]['lon'],
-                reconstructed['nodes'][-1]['lat'],
-                reconstructed['nodes'][-1]['lon'],
-                is_generated=True
-            )
-            
-            return jsonify({'success': True, 'segment': reconstructed})
-        
-        # ==== FALLBACK: COORDENADAS ESTIMADAS ====
-        log.warning(f"⚠️ No se pudo reconstruir segmento {segment_id}, usando estimación")
-        
-        # Generar coordenadas basadas en hash del ID (consistente)
-        estimated = generate_estimated_segment(segment_id)
-        
-        return jsonify({
-            'success': True,
-            'segment': estimated,
-            'warning': 'Segmento estimado - no hay datos reales'
-        })
+        log.warning(f"⚠️ Segmento {segment_id} sin registro ni histórico GPS")
+        return jsonify({'success': False, 'error': f'Segmento {segment_id} no encontrado'}), 404
             
     except Exception as e:
         log.error(f"❌ Error obteniendo segmento {segment_id}: {e}")
@@ -139,54 +65,64 @@ def get_segment_by_id(segment_id):
         }), 500
 
 
-def generate_estimated_segment(segment_id):
+def _segments_response(segment_ids):
+    """Resuelve todos los segmentos de una vez; la lista respeta el orden pedido (null si falta)."""
+    if len(segment_ids) > SEGMENT_BATCH_MAX:
+        return jsonify({
+            'success': False,
+            'error': f'Máximo {SEGMENT_BATCH_MAX} segmentos por consulta'
+        }), 400
+    
+    found = resolve_segments(segment_ids)
+    missing = [segment_id for segment_id in segment_ids if segment_id not in found]
+    if missing:
+        log.warning(f"⚠️ {len(missing)} de {len(segment_ids)} segmentos sin registro ni histórico GPS")
+    return jsonify({
+        'success': True,
+        'segments': [found.get(segment_id) for segment_id in segment_ids],
+        'missing': missing,
+        'count': len(segment_ids) - len(missing)
+    })
+
+
+def _get_segments_batch():
     """
-    Genera coordenadas estimadas para un segmento basándose en su ID.
-    Usa hash para generar siempre las mismas coordenadas para el mismo ID.
+    Geometría de varios segmentos en una sola petición.
+    POST {"segment_ids": [...]} o {"ruta_id": N}; GET ?ids=a,b,c o ?ruta_id=N.
     """
-    import hashlib
-    import math
-    
-    # Centro de Barranquilla
-    BASE_LAT = 10.9878
-    BASE_LON = -74.7889
-    
-    # Hash del segment_id
-    hash_obj = hashlib.md5(segment_id.encode())
-    hash_hex = hash_obj.hexdigest()
-    
-    # Generar offset aleatorio pero consistente (±0.02 grados ≈ ±2km)
-    offset_lat = (int(hash_hex[:8], 16) % 4000 - 2000) / 100000
-    offset_lon = (int(hash_hex[8:16], 16) % 4000 - 2000) / 100000
-    
-    # Longitud del segmento (50-200m)
-    length = 50 + (int(hash_hex[16:20], 16) % 150)
-    
-    # Bearing (0-360°)
-    bearing = int(hash_hex[20:24], 16) % 360
-    
-    # Calcular punto final
-    bearing_rad = math.radians(bearing)
-    lat_delta = (length * math.cos(bearing_rad)) / 111000
-    lon_delta = (length * math.sin(bearing_rad)) / (111000 * math.cos(math.radians(BASE_LAT)))
-    
-    start_lat = BASE_LAT + offset_lat
-    start_lon = BASE_LON + offset_lon
-    end_lat = start_lat + lat_delta
-    end_lon = start_lon + lon_delta
-    
-    return {
-        'segment_id': segment_id,
-        'street_name': f'Segmento {segment_id[:8]}',
-        'segment_length': length,
-        'bearing': bearing,
-        'nodes': [
-            {'lat': start_lat, 'lon': start_lon},
-            {'lat': end_lat, 'lon': end_lon}
-        ],
-        'source': 'estimated',
-        'is_generated': True
-    }
+    try:
+        data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+        ruta_id = data.get('ruta_id')
+        if ruta_id is not None:
+            return _get_ruta_segments(int(ruta_id))
+        
+        segment_ids = data.get('segment_ids') if request.method == 'POST' else data.get('ids')
+        if isinstance(segment_ids, str):
+            segment_ids = segment_ids.split(',')
+        segment_ids = [str(segment_id).strip() for segment_id in segment_ids or [] if str(segment_id).strip()]
+        if not segment_ids:
+            return jsonify({'success': False, 'error': 'Se requiere segment_ids (o ruta_id)'}), 400
+        
+        return _segments_response(segment_ids)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'ruta_id inválido'}), 400
+    except Exception as e:
+        log.error(f"❌ Error obteniendo segmentos: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+def _get_ruta_segments(ruta_id):
+    """Geometría de todos los segmentos de una ruta, en orden."""
+    try:
+        ruta = get_ruta_by_id(ruta_id)
+        if not ruta:
+            return jsonify({'success': False, 'error': f'Ruta {ruta_id} no encontrada'}), 404
+        
+        segment_ids = [segment_id.strip() for segment_id in ruta['segment_ids'].split(',') if segment_id.strip()]
+        return _segments_response(segment_ids)
+    except Exception as e:
+        log.error(f"❌ Error obteniendo segmentos de la ruta {ruta_id}: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
 
 # ===== ENDPOINTS DE API (Producción y Test) =====
@@ -258,14 +194,13 @@ def _register_user():
 def get_registered_users():
     """Obtiene la lista de user_id únicos registrados en la base de datos."""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
 
-        # Obtener todos los user_id únicos de la tabla coordinates
-        cursor.execute('SELECT DISTINCT user_id FROM coordinates WHERE user_id IS NOT NULL ORDER BY user_id')
-        users = cursor.fetchall()
+            # Obtener todos los user_id únicos de la tabla coordinates
+            cursor.execute('SELECT DISTINCT user_id FROM coordinates WHERE user_id IS NOT NULL ORDER BY user_id')
+            users = cursor.fetchall()
 
-        conn.close()
 
         # Convertir a lista simple de user_ids
         user_list = [user[0] for user in users]
@@ -291,6 +226,71 @@ def _get_historico(fecha):
         print(f"Error en consulta histórica: {e}")
         return jsonify([]), 500
 
+def _stream_coordinates(rows):
+    """
+    Respuesta en streaming para un generador de coordenadas: un arreglo JSON
+    enviado por partes (el mismo cuerpo que antes) o, con ?format=ndjson, un
+    objeto JSON por línea. La consulta se ejecuta aquí, al pedir la primera
+    fila, para que un error de BD todavía pueda responder 500.
+    """
+    first = next(rows, None)
+    rows = itertools.chain([first], rows) if first is not None else iter(())
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            chunk = []
+            for row in rows:
+                chunk.append(json.dumps(row))
+                if len(chunk) >= 500:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+            if chunk:
+                yield '\n'.join(chunk) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    def generate():
+        chunk = []
+        separator = '['
+        for row in rows:
+            chunk.append(separator + json.dumps(row))
+            separator = ','
+            if len(chunk) >= 500:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(']' if separator == ',' else '[]')
+        yield ''.join(chunk)
+    return Response(generate(), mimetype='application/json')
+
+def _encode_page_cursor(after):
+    """Token opaco para la llave (ts, id) de la siguiente página."""
+    ts, row_id = after
+    return base64.urlsafe_b64encode(f"{ts.isoformat()}|{row_id}".encode()).decode().rstrip('=')
+
+def _decode_page_cursor(token):
+    """Llave (ts, id) de un token de _encode_page_cursor. ValueError si no es válido."""
+    raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+    ts, row_id = raw.split('|')
+    return datetime.fromisoformat(ts), int(row_id)
+
+def _historico_page(fetch_page, *args, **kwargs):
+    """
+    Modo paginado de los históricos (?page_size=N y ?cursor=<next_cursor>):
+    retorna {coordenadas, next_cursor}; next_cursor es null en la última página.
+    """
+    try:
+        page_size = int(request.args.get('page_size', HISTORY_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        after = _decode_page_cursor(cursor) if cursor else None
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({'error': 'page_size o cursor inválido'}), 400
+    page_size = max(1, min(page_size, HISTORY_PAGE_MAX))
+
+    coordenadas, next_after = fetch_page(*args, after=after, page_size=page_size, **kwargs)
+    return jsonify({
+        'coordenadas': coordenadas,
+        'next_cursor': _encode_page_cursor(next_after) if next_after else None
+    })
+
 def _get_historico_rango():
     try:
         fecha_inicio_str = request.args.get('inicio')
@@ -315,8 +315,11 @@ def _get_historico_rango():
         if user_ids_str:
             user_ids = [uid.strip() for uid in user_ids_str.split(',') if uid.strip()]
 
-        coordenadas = get_historical_by_range(start_datetime, end_datetime, user_id=user_id, user_ids=user_ids)
-        return jsonify(coordenadas)
+        if 'page_size' in request.args or 'cursor' in request.args:
+            return _historico_page(get_historical_by_range_page, start_datetime, end_datetime,
+                                   user_id=user_id, user_ids=user_ids)
+        rows = iter_historical_by_range(start_datetime, end_datetime, user_id=user_id, user_ids=user_ids)
+        return _stream_coordinates(rows)
 
     except ValueError:
         return jsonify({'error': 'Formato de fecha u hora inválido. Use YYYY-MM-DD y HH:MM'}), 400
@@ -352,14 +355,20 @@ def _get_historico_geocerca():
             start_datetime = datetime.strptime(f"{fecha_inicio_str} {hora_inicio_str}", '%Y-%m-%d %H:%M')
             end_datetime = datetime.strptime(f"{fecha_fin_str} {hora_fin_str}", '%Y-%m-%d %H:%M').replace(second=59)
 
-        coordenadas = get_historical_by_geofence(
+        if 'page_size' in request.args or 'cursor' in request.args:
+            return _historico_page(
+                get_historical_by_geofence_page, min_lat, max_lat, min_lon, max_lon,
+                user_id=user_id, user_ids=user_ids,
+                start_datetime=start_datetime, end_datetime=end_datetime
+            )
+        rows = iter_historical_by_geofence(
             min_lat, max_lat, min_lon, max_lon,
             user_id=user_id,
             user_ids=user_ids,
             start_datetime=start_datetime,
             end_datetime=end_datetime
         )
-        return jsonify(coordenadas)
+        return _stream_coordinates(rows)
     except Exception as e:
         print(f"Error en consulta por geocerca: {e}")
         import traceback
@@ -368,16 +377,21 @@ def _get_historico_geocerca():
 
 def _osrm_proxy(params):
     try:
-        url = f"http://localhost:5001/route/v1/driving/{params}"
-        response = requests.get(url, params=request.args, timeout=5)
+        response = get_osrm_client().get('route', f"/route/v1/driving/{params}", params=request.args, timeout=5)
         return jsonify(response.json()), response.status_code
+    except OSRMUnavailable as e:
+        return jsonify({'error': str(e), 'code': 'Unavailable'}), 503
     except Exception as e:
         return jsonify({'error': str(e), 'code': 'Error'}), 500
 
 def _get_active_devices():
-    """Retorna dispositivos activos (últimos 2 minutos)."""
+    """Retorna dispositivos activos (últimos 30 segundos)."""
     try:
-        devices = get_active_devices()
+        devices = [{
+            'user_id': position['user_id'],
+            'name': f"Usuario {position['user_id']}",
+            'last_seen': 'Reciente'
+        } for position in get_position_registry().active()]
         return jsonify(devices)
     except Exception as e:
         print(f"Error obteniendo dispositivos activos: {e}")
@@ -398,18 +412,17 @@ def _send_destination():
             return jsonify({'success': False, 'error': 'Parámetros incompletos'}), 400
         
         # Guardar en base de datos
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO destinations (user_id, latitude, longitude, status)
-            VALUES (%s, %s, %s, 'pending')
-            RETURNING id, created_at
-        ''', (user_id, latitude, longitude))
+            cursor.execute('''
+                INSERT INTO destinations (user_id, latitude, longitude, status)
+                VALUES (%s, %s, %s, 'pending')
+                RETURNING id, created_at
+            ''', (user_id, latitude, longitude))
         
-        result = cursor.fetchone()
-        conn.commit()
-        conn.close()
+            result = cursor.fetchone()
+            conn.commit()
         
         return jsonify({
             'success': True,
@@ -425,19 +438,18 @@ def _send_destination():
 def get_user_destinations(user_id):
     """Obtiene los destinos de un usuario en los últimos 30 minutos"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT id, latitude, longitude, status, created_at
-            FROM destinations 
-            WHERE user_id = %s 
-              AND created_at >= NOW() - INTERVAL '30 minutes'
-            ORDER BY created_at DESC
-        ''', (user_id,))
+            cursor.execute('''
+                SELECT id, latitude, longitude, status, created_at
+                FROM destinations 
+                WHERE user_id = %s 
+                  AND created_at >= NOW() - INTERVAL '30 minutes'
+                ORDER BY created_at DESC
+            ''', (user_id,))
         
-        results = cursor.fetchall()
-        conn.close()
+            results = cursor.fetchall()
         
         destinations = []
         for row in results:
@@ -464,43 +476,41 @@ def get_user_destinations(user_id):
 def _get_destination(user_id):
     """La app consulta si tiene un destino pendiente (desde base de datos)"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Buscar el destino más reciente pendiente
-        cursor.execute('''
-            SELECT id, latitude, longitude, created_at
-            FROM destinations 
-            WHERE user_id = %s 
-              AND status = 'pending'
-            ORDER BY created_at DESC 
-            LIMIT 1
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        if result:
-            # Marcar como enviado
+            # Buscar el destino más reciente pendiente
             cursor.execute('''
-                UPDATE destinations 
-                SET status = 'sent' 
-                WHERE id = %s
-            ''', (result[0],))
-            conn.commit()
+                SELECT id, latitude, longitude, created_at
+                FROM destinations 
+                WHERE user_id = %s 
+                  AND status = 'pending'
+                ORDER BY created_at DESC 
+                LIMIT 1
+            ''', (user_id,))
+        
+            result = cursor.fetchone()
+        
+            if result:
+                # Marcar como enviado
+                cursor.execute('''
+                    UPDATE destinations 
+                    SET status = 'sent' 
+                    WHERE id = %s
+                ''', (result[0],))
+                conn.commit()
             
-            destination = {
-                'lat': float(result[1]),
-                'lon': float(result[2]),
-                'timestamp': result[3].strftime('%d/%m/%Y %H:%M:%S')
-            }
+                destination = {
+                    'lat': float(result[1]),
+                    'lon': float(result[2]),
+                    'timestamp': result[3].strftime('%d/%m/%Y %H:%M:%S')
+                }
             
-            conn.close()
-            return jsonify({
-                'has_destination': True,
-                'destination': destination
-            })
+                return jsonify({
+                    'has_destination': True,
+                    'destination': destination
+                })
         
-        conn.close()
         return jsonify({'has_destination': False})
         
     except Exception as e:
@@ -516,27 +526,26 @@ def _complete_destination():
         if not user_id:
             return jsonify({'success': False, 'error': 'user_id requerido'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        # Completar el destino más reciente (pending o sent)
-        cursor.execute('''
-            UPDATE destinations 
-            SET status = 'completed', completed_at = NOW()
-            WHERE user_id = %s 
-              AND status IN ('pending', 'sent')
-              AND id = (
-                  SELECT id FROM destinations 
-                  WHERE user_id = %s AND status IN ('pending', 'sent')
-                  ORDER BY created_at DESC 
-                  LIMIT 1
-              )
-            RETURNING id
-        ''', (user_id, user_id))
-        
-        result = cursor.fetchone()
-        conn.commit()
-        conn.close()
+            # Completar el destino más reciente (pending o sent)
+            cursor.execute('''
+                UPDATE destinations 
+                SET status = 'completed', completed_at = NOW()
+                WHERE user_id = %s 
+                  AND status IN ('pending', 'sent')
+                  AND id = (
+                      SELECT id FROM destinations 
+                      WHERE user_id = %s AND status IN ('pending', 'sent')
+                      ORDER BY created_at DESC 
+                      LIMIT 1
+                  )
+                RETURNING id
+            ''', (user_id, user_id))
+        
+            result = cursor.fetchone()
+            conn.commit()
         
         if result:
             return jsonify({
@@ -557,13 +566,13 @@ def _complete_destination():
 
 def _get_user_location(user_id):
     """Obtiene la última ubicación de un usuario específico."""
-    return jsonify(get_last_coordinate_by_user(user_id))
+    return jsonify(get_position_registry().get(user_id))
 
 def get_congestion():
     """Obtiene segmentos con congestión (2+ vehículos)."""
     try:
         time_window = int(request.args.get('time_window'))
-        congestion_data = get_congestion_segments(time_window)
+        congestion_data = get_congestion_tracker().congested(time_window)
         
         return jsonify({
             'success': True,
@@ -678,44 +687,43 @@ def _delete_ruta(ruta_id):
 def _debug_usuarios():
     """DEBUG: Ver todos los usuarios y empresas registradas"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Ver todos los usuarios
-        cursor.execute("""
-            SELECT user_id, cedula, nombre_completo, email, telefono, empresa, created_at, updated_at
-            FROM usuarios_web 
-            ORDER BY created_at DESC
-        """)
-        users = cursor.fetchall()
-        
-        usuarios_list = []
-        empresas_set = set()
-        
-        for user in users:
-            empresa = user[5] if user[5] else "[SIN EMPRESA]"
-            if user[5]:
-                empresas_set.add(user[5])
+        with get_db() as conn:
+            cursor = conn.cursor()
+        
+            # Ver todos los usuarios
+            cursor.execute("""
+                SELECT user_id, cedula, nombre_completo, email, telefono, empresa, created_at, updated_at
+                FROM usuarios_web 
+                ORDER BY created_at DESC
+            """)
+            users = cursor.fetchall()
+        
+            usuarios_list = []
+            empresas_set = set()
+        
+            for user in users:
+                empresa = user[5] if user[5] else "[SIN EMPRESA]"
+                if user[5]:
+                    empresas_set.add(user[5])
             
-            usuarios_list.append({
-                'user_id': user[0],
-                'cedula': user[1],
-                'nombre_completo': user[2],
-                'email': user[3],
-                'telefono': user[4],
-                'empresa': empresa,
-                'created_at': user[6].strftime('%d/%m/%Y %H:%M:%S') if user[6] else None,
-                'updated_at': user[7].strftime('%d/%m/%Y %H:%M:%S') if user[7] else None
-            })
+                usuarios_list.append({
+                    'user_id': user[0],
+                    'cedula': user[1],
+                    'nombre_completo': user[2],
+                    'email': user[3],
+                    'telefono': user[4],
+                    'empresa': empresa,
+                    'created_at': user[6].strftime('%d/%m/%Y %H:%M:%S') if user[6] else None,
+                    'updated_at': user[7].strftime('%d/%m/%Y %H:%M:%S') if user[7] else None
+                })
         
-        # Estadísticas
-        cursor.execute("SELECT COUNT(*) FROM usuarios_web")
-        total_usuarios = cursor.fetchone()[0]
+            # Estadísticas
+            cursor.execute("SELECT COUNT(*) FROM usuarios_web")
+            total_usuarios = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM usuarios_web WHERE empresa IS NOT NULL AND empresa != ''")
-        usuarios_con_empresa = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM usuarios_web WHERE empresa IS NOT NULL AND empresa != ''")
+            usuarios_con_empresa = cursor.fetchone()[0]
         
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -735,44 +743,43 @@ def _debug_usuarios():
 def _debug_usuarios():
     """DEBUG: Ver todos los usuarios y empresas registradas"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Ver todos los usuarios
-        cursor.execute("""
-            SELECT user_id, cedula, nombre_completo, email, telefono, empresa, created_at, updated_at
-            FROM usuarios_web 
-            ORDER BY created_at DESC
-        """)
-        users = cursor.fetchall()
-        
-        usuarios_list = []
-        empresas_set = set()
-        
-        for user in users:
-            empresa = user[5] if user[5] else "[SIN EMPRESA]"
-            if user[5]:
-                empresas_set.add(user[5])
+        with get_db() as conn:
+            cursor = conn.cursor()
+        
+            # Ver todos los usuarios
+            cursor.execute("""
+                SELECT user_id, cedula, nombre_completo, email, telefono, empresa, created_at, updated_at
+                FROM usuarios_web 
+                ORDER BY created_at DESC
+            """)
+            users = cursor.fetchall()
+        
+            usuarios_list = []
+            empresas_set = set()
+        
+            for user in users:
+                empresa = user[5] if user[5] else "[SIN EMPRESA]"
+                if user[5]:
+                    empresas_set.add(user[5])
             
-            usuarios_list.append({
-                'user_id': user[0],
-                'cedula': user[1],
-                'nombre_completo': user[2],
-                'email': user[3],
-                'telefono': user[4],
-                'empresa': empresa,
-                'created_at': user[6].strftime('%d/%m/%Y %H:%M:%S') if user[6] else None,
-                'updated_at': user[7].strftime('%d/%m/%Y %H:%M:%S') if user[7] else None
-            })
+                usuarios_list.append({
+                    'user_id': user[0],
+                    'cedula': user[1],
+                    'nombre_completo': user[2],
+                    'email': user[3],
+                    'telefono': user[4],
+                    'empresa': empresa,
+                    'created_at': user[6].strftime('%d/%m/%Y %H:%M:%S') if user[6] else None,
+                    'updated_at': user[7].strftime('%d/%m/%Y %H:%M:%S') if user[7] else None
+                })
         
-        # Estadísticas
-        cursor.execute("SELECT COUNT(*) FROM usuarios_web")
-        total_usuarios = cursor.fetchone()[0]
+            # Estadísticas
+            cursor.execute("SELECT COUNT(*) FROM usuarios_web")
+            total_usuarios = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM usuarios_web WHERE empresa IS NOT NULL AND empresa != ''")
-        usuarios_con_empresa = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM usuarios_web WHERE empresa IS NOT NULL AND empresa != ''")
+            usuarios_con_empresa = cursor.fetchone()[0]
         
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -873,6 +880,14 @@ def debug_usuarios():
 def segment_from_coords_id():
     return get_segment_from_coords()
 
+@api_bp.route('/api/segments/batch', methods=['GET', 'POST'])
+def segments_batch():
+    return _get_segments_batch()
+
+@api_bp.route('/api/rutas/<int:ruta_id>/segments', methods=['GET'])
+def ruta_segments(ruta_id):
+    return _get_ruta_segments(ruta_id)
+
 # --- Rutas de Test ---
 @api_bp.route('/test/api/users/registered')
 def test_registered_users():
@@ -946,6 +961,14 @@ def test_segment_from_coords_id():
 def segment_details_test(segment_id):
     return get_segment_by_id(segment_id)
 
+@api_bp.route('/test/api/segments/batch', methods=['GET', 'POST'])
+def test_segments_batch():
+    return _get_segments_batch()
+
+@api_bp.route('/test/api/rutas/<int:ruta_id>/segments', methods=['GET'])
+def test_ruta_segments(ruta_id):
+    return _get_ruta_segments(ruta_id)
+
 
 
     
@@ -958,76 +981,161 @@ def version():
 def health():
     db_status = 'unhealthy'
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.fetchone()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
         db_status = 'healthy'
     except:
         pass
     
-    osrm_status = 'healthy' if check_osrm_available() else 'unavailable'
+    # Estado en caché del monitor de salud: no hace una llamada a OSRM por request
+    osrm_health = get_osrm_monitor().status()
+    osrm_status = 'healthy' if osrm_health['available'] else 'unavailable'
     
     return jsonify({
         'status': 'healthy' if db_status == 'healthy' else 'degraded',
         'database': db_status,
         'osrm': osrm_status,
+        'osrm_since': osrm_health['since'],
+        'osrm_last_check': osrm_health['last_check'],
         'snap_to_roads': osrm_status == 'healthy',
         'name': current_app.config['NAME'],
         'mode': 'test' if current_app.config['IS_TEST_MODE'] else 'production',
         **get_git_info()
     })
 
+def _get_metrics():
+    """Métricas internas del servidor para monitoreo."""
+    ingest = get_ingest_stats()
+    async_stats = get_async_ingest_stats()
+    if async_stats:
+        ingest['async'] = async_stats
+    
+    return jsonify({
+        'db_pool': get_pool_stats(),
+        'ingest': ingest,
+        'snap_cache': get_snap_cache_stats(),
+        'local_snap': get_local_snap_stats(),
+        'segments': get_segment_registry_stats(),
+        'segment_cache': get_segment_cache_stats(),
+        'osrm': get_osrm_stats(),
+        'positions': get_position_registry().stats(),
+        'congestion': get_congestion_tracker().stats(),
+        'stream': get_position_stream().stats(),
+        'udp_workers': get_udp_worker_stats()
+    })
+
+@api_bp.route('/api/metrics')
+def metrics():
+    return _get_metrics()
+
+@api_bp.route('/test/api/metrics')
+def test_metrics():
+    return _get_metrics()
+
+def _not_modified(etag):
+    """304 sin cuerpo para un sondeo sin cambios."""
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 def _get_coordenadas_all():
-    """Retorna las últimas coordenadas de todos los usuarios activos (últimos 30 segundos)"""
+    """
+    Retorna las últimas coordenadas de todos los usuarios activos (últimos 30 segundos).
+    Con ?since=<cursor> (el `cursor` de la respuesta anterior) retorna solo los
+    cambios: {cursor, full, devices, removed}. Responde con ETag; si coincide
+    con If-None-Match no hubo cambios y la respuesta es 304 sin cuerpo.
+    """
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Configurar zona horaria
-        cursor.execute("SET TIME ZONE 'America/Bogota'")
-        
-        # Obtener la última coordenada de cada usuario activo
-        # Usa PostgreSQL syntax correctamente
-        cursor.execute('''
-            SELECT DISTINCT ON (user_id)
-                id, lat, lon, timestamp, source, user_id
-            FROM coordinates
-            WHERE user_id IS NOT NULL
-              AND TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') 
-                  >= NOW() - INTERVAL '30 seconds'
-            ORDER BY user_id, TO_TIMESTAMP(timestamp, 'DD/MM/YYYY HH24:MI:SS') DESC
-        ''')
-
-        rows = cursor.fetchall()
-        conn.close()
-        
-        devices = []
-        for row in rows:
-            devices.append({
-                'id': row[0],
-                'lat': float(row[1]),
-                'lon': float(row[2]),
-                'timestamp': row[3],
-                'source': row[4] or f'user_{row[5]}',
-                'user_id': row[5],
-                'device_id': f'user_{row[5]}'
+        # Registro en memoria si la ingesta corre en este proceso; si no, BD
+        registry = get_position_registry()
+        etag = registry.etag()
+        if etag is not None and request.if_none_match.contains(etag):
+            return _not_modified(etag)
+
+        since = request.args.get('since')
+        changes = registry.changes(since)
+        if request.if_none_match.contains(changes['etag']):
+            return _not_modified(changes['etag'])
+
+        devices = [position_to_device(row) for row in changes['devices']]
+        if since is None:
+            log.info(f"📡 Coordenadas activas: {len(devices)} dispositivos")
+            response = jsonify(devices)
+        else:
+            response = jsonify({
+                'cursor': changes['cursor'],
+                'full': changes['full'],
+                'devices': devices,
+                'removed': changes['removed']
             })
-        
-        log.info(f"📡 Coordenadas activas: {len(devices)} dispositivos")
-        return jsonify(devices)
+        response.set_etag(changes['etag'])
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         log.error(f"Error obteniendo coordenadas de todos los dispositivos: {e}")
         import traceback
         log.error(traceback.format_exc())
         return jsonify([]), 500
 
+def _stream_positions():
+    """
+    Stream SSE de posiciones en vivo (reemplaza el sondeo de /coordenadas/all).
+    Eventos: `snapshot` con las posiciones activas al conectar, luego
+    `positions` con las nuevas de cada lote y `leave` con los user_ids que
+    salieron del viewport o de los filtros. Con Last-Event-ID (el navegador
+    lo envía al reconectar) se reponen solo los eventos perdidos. Latido cada
+    STREAM_HEARTBEAT_S.
+    Filtros opcionales: ?bbox=sur,oeste,norte,este, ?empresa= y ?user_id=.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            bbox = parse_bbox(bbox)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'bbox debe ser sur,oeste,norte,este'}), 400
+
+    stream = get_position_stream()
+    subscription, messages = stream.subscribe(
+        last_event_id, user_id=request.args.get('user_id'),
+        empresa=request.args.get('empresa'), bbox=bbox or None
+    )
+
+    def generate():
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            pending = messages
+            while True:
+                for event_id, event, data in pending:
+                    yield format_event(event_id, event, data)
+                pending = subscription.next(STREAM_HEARTBEAT_S)
+                if pending is None:
+                    return  # Cliente lento: se cierra y el navegador reconecta con Last-Event-ID
+                # Empresas y expiración se atienden aquí, no en el thread de escritura
+                stream.tick()
+                if not pending:
+                    yield ": heartbeat\n\n"
+        finally:
+            stream.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # nginx: no acumular el stream
+    })
+
 # --- Rutas de Producción ---
 @api_bp.route('/coordenadas/all')
 def coordenadas_all():
     return _get_coordenadas_all()
 
+@api_bp.route('/api/stream/positions')
+def stream_positions():
+    return _stream_positions()
+
 @api_bp.route('/api/users/register', methods=['POST'])
 def register_user():
     return _register_user()
@@ -1037,6 +1145,10 @@ def register_user():
 def test_coordenadas_all():
     return _get_coordenadas_all()
 
+@api_bp.route('/test/api/stream/positions')
+def test_stream_positions():
+    return _stream_positions()
+
 @api_bp.route('/api/destination/complete', methods=['POST'])
 def complete_destination():
     return _complete_destination()
@@ -0,0 +1,178 @@
+# app/services_congestion.py
+import heapq
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from app.config import CONGESTION_MAX_WINDOW_S
+from app.database import coordinate_ts, get_congestion_segments, get_latest_segment_positions
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CongestionTracker:
+    """
+    Vehículos actuales por segmento, mantenidos de forma incremental.
+
+    Igual que PositionRegistry, lo alimenta el buffer de ingesta con cada
+    lote escrito (attach) y solo está "en vivo" en el proceso que hace la
+    ingesta. Cada usuario cuenta en el segmento de su último fix con
+    segmento; al pasar a otro segmento sale del anterior. Los usuarios sin
+    datos por más de `max_window_s` se expiran (heap por hora del fix).
+
+    congested(ventana) recorre solo los segmentos con 2+ vehículos, así que
+    no depende del volumen de históricos. Ventanas más largas que
+    `max_window_s`, o consultas fuera del proceso de ingesta, van a la BD.
+    """
+
+    def __init__(self, max_window_s=CONGESTION_MAX_WINDOW_S):
+        self.max_window = timedelta(seconds=max_window_s)
+        self._lock = threading.Lock()
+        self._users = {}          # user_id → posición actual (con segment_id)
+        self._segments = {}       # segment_id → {user_id: posición}
+        self._congested = set()   # segmentos con 2+ vehículos (sin filtrar por ventana)
+        self._expiry = []         # heap (ts, user_id); entradas viejas se ignoran al salir
+        self._live_pid = None
+        self._warmed = False
+        self._stats = {'updates': 0, 'moves': 0, 'expired': 0, 'queries': 0, 'db_fallbacks': 0}
+
+    def attach(self, buffer):
+        """Se suscribe a los lotes escritos por el buffer de ingesta de este proceso."""
+        buffer.add_flush_listener(self.update_many)
+        self._live_pid = os.getpid()
+
+    def is_live(self):
+        return self._live_pid == os.getpid()
+
+    def _place(self, position):
+        """Ubica al usuario en su segmento actual (llamar con el lock tomado)."""
+        user_id = position['user_id']
+        current = self._users.get(user_id)
+        if current is not None:
+            if current['ts'] > position['ts']:
+                return
+            if current['segment_id'] != position['segment_id']:
+                self._remove(user_id, current['segment_id'])
+                self._stats['moves'] += 1
+        self._users[user_id] = position
+        vehicles = self._segments.setdefault(position['segment_id'], {})
+        vehicles[user_id] = position
+        if len(vehicles) >= 2:
+            self._congested.add(position['segment_id'])
+        heapq.heappush(self._expiry, (position['ts'], user_id))
+
+    def _remove(self, user_id, segment_id):
+        vehicles = self._segments.get(segment_id)
+        if vehicles is None:
+            return
+        vehicles.pop(user_id, None)
+        if len(vehicles) < 2:
+            self._congested.discard(segment_id)
+        if not vehicles:
+            del self._segments[segment_id]
+
+    def update_many(self, rows, ids):
+        """Actualiza con un lote recién escrito (los fixes sin segmento no mueven al usuario)."""
+        with self._lock:
+            for row in rows:
+                user_id, segment_id = row.get('user_id'), row.get('segment_id')
+                ts = row.get('ts') or coordinate_ts(row['timestamp'])
+                if not user_id or not segment_id or ts is None:
+                    continue
+                self._place({
+                    'user_id': user_id,
+                    'segment_id': segment_id,
+                    'street_name': row.get('street_name'),
+                    'lat': row['lat'],
+                    'lon': row['lon'],
+                    'ts': ts
+                })
+                self._stats['updates'] += 1
+            self._purge()
+
+    def _purge(self):
+        """Expira los usuarios sin datos en `max_window_s` (llamar con el lock tomado)."""
+        cutoff = datetime.now(timezone.utc) - self.max_window
+        while self._expiry and self._expiry[0][0] < cutoff:
+            ts, user_id = heapq.heappop(self._expiry)
+            current = self._users.get(user_id)
+            if current is not None and current['ts'] == ts:
+                del self._users[user_id]
+                self._remove(user_id, current['segment_id'])
+                self._stats['expired'] += 1
+
+    def _warm(self):
+        """Carga desde la BD las posiciones dentro de la ventana máxima (una vez, al primer uso)."""
+        if self._warmed:
+            return
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        try:
+            positions = get_latest_segment_positions(int(self.max_window.total_seconds()))
+        except Exception as e:
+            log.error(f"❌ Error cargando posiciones por segmento desde BD: {e}")
+            return
+        with self._lock:
+            for position in positions:
+                self._place(position)
+        log.info(f"🚦 Tracker de congestión cargado desde BD ({len(positions)} usuarios)")
+
+    def congested(self, time_window_seconds):
+        """
+        Segmentos con 2+ vehículos cuyo último fix está dentro de la ventana,
+        en el formato de get_congestion_segments.
+        """
+        window = timedelta(seconds=time_window_seconds)
+        if not self.is_live() or window > self.max_window:
+            with self._lock:
+                self._stats['db_fallbacks'] += 1
+            return get_congestion_segments(time_window_seconds)
+
+        self._warm()
+        cutoff = datetime.now(timezone.utc) - window
+        congestion = []
+        with self._lock:
+            self._purge()
+            self._stats['queries'] += 1
+            for segment_id in self._congested:
+                vehicles = [p for p in self._segments[segment_id].values() if p['ts'] >= cutoff]
+                if len(vehicles) < 2:
+                    continue
+                latest = max(vehicles, key=lambda p: p['ts'])
+                congestion.append({
+                    'segment_id': segment_id,
+                    'street_name': latest['street_name'],
+                    'vehicle_count': len(vehicles),
+                    'vehicle_ids': sorted(p['user_id'] for p in vehicles),
+                    'center_lat': sum(float(p['lat']) for p in vehicles) / len(vehicles),
+                    'center_lon': sum(float(p['lon']) for p in vehicles) / len(vehicles),
+                    'segment_coords': [[float(p['lat']), float(p['lon'])] for p in vehicles]
+                })
+        congestion.sort(key=lambda c: c['vehicle_count'], reverse=True)
+        return congestion
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['users'] = len(self._users)
+            s['segments'] = len(self._segments)
+            s['congested_segments'] = len(self._congested)
+        s['live'] = self.is_live()
+        s['max_window_s'] = int(self.max_window.total_seconds())
+        return s
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_congestion_tracker():
+    """Retorna el tracker de congestión global."""
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = CongestionTracker()
+    return _tracker
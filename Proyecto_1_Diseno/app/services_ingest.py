@@ -0,0 +1,628 @@
+# app/services_ingest.py
+import atexit
+import queue
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2.pool import PoolError
+from app.config import (
+    INGEST_BATCH_SIZE, INGEST_FLUSH_MS, INGEST_MAX_PENDING, INGEST_PUT_TIMEOUT_MS, INGEST_MAX_RETRIES,
+    SNAP_WORKERS, SNAP_QUEUE_SIZE, SNAP_MODE, MATCH_WINDOW, MATCH_MAX_WAIT_MS, MATCH_CONTEXT_S
+)
+from app.database import insert_coordinates_bulk, coordinate_ts
+from app.services_osrm import snap_to_road, match_trajectory
+from app.services_positions import get_position_registry
+from app.services_congestion import get_congestion_tracker
+from app.services_stream import get_position_stream
+import logging
+
+log = logging.getLogger(__name__)
+
+# Errores de conexión: el lote se reintenta. Cualquier otro error (DataError,
+# IntegrityError, NUL en un texto...) se debe a las filas y no se reintenta.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+
+def coordinate_row(fix, lat, lon, segment_info):
+    """Arma la fila para el buffer de escritura a partir de un fix ya ajustado."""
+    return {
+        'lat': lat,
+        'lon': lon,
+        'timestamp': fix['timestamp'],
+        'source': fix['source'],
+        'user_id': fix['user_id'],
+        'segment_id': segment_info['segment_id'] if segment_info else None,
+        'street_name': segment_info['street_name'] if segment_info else None,
+        'segment_length': segment_info['segment_length'] if segment_info else None
+    }
+
+
+class StageMetrics:
+    """Contadores y latencia de una etapa del pipeline de ingesta."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.dropped = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._last = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self._total += seconds
+            self._last = seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def drop(self, n=1):
+        with self._lock:
+            self.dropped += n
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'avg_ms': round(self._total * 1000 / self.count, 3) if self.count else 0,
+                'max_ms': round(self._max * 1000, 3),
+                'last_ms': round(self._last * 1000, 3)
+            }
+
+
+class CoordinateBuffer:
+    """
+    Buffer de ingesta de coordenadas.
+
+    El listener UDP agrega filas con add() y un thread las escribe en lote
+    (insert_coordinates_bulk) cuando hay `batch_size` filas pendientes o la
+    más antigua lleva `flush_interval_ms` esperando. Si el buffer llega a
+    `max_pending`, add() espera hasta `put_timeout_ms` y luego descarta la fila.
+
+    Si la BD no responde, el lote vuelve al frente del buffer y se reintenta
+    hasta `max_retries` veces seguidas. Si el error es de los datos, el lote
+    se parte por paquetes hasta aislar los que fallan, que se descartan.
+    """
+
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, flush_interval_ms=INGEST_FLUSH_MS,
+                 max_pending=INGEST_MAX_PENDING, put_timeout_ms=INGEST_PUT_TIMEOUT_MS,
+                 writer=insert_coordinates_bulk, max_retries=INGEST_MAX_RETRIES):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_pending = max(self.batch_size, max_pending)
+        self.put_timeout = put_timeout_ms / 1000.0
+        self.max_retries = max(0, max_retries)
+        self._writer = writer
+        self._failures = 0               # fallos seguidos por errores de conexión
+        self._flush_listeners = []
+        self._cond = threading.Condition()
+        self._pending = deque()          # [(filas, instante_de_llegada)], un grupo por paquete
+        self._pending_rows = 0
+        self._thread = None
+        self._stopping = False
+        self._stats = {
+            'received': 0,
+            'written': 0,
+            'batches': 0,
+            'dropped': 0,
+            'backpressure_waits': 0,
+            'flush_errors': 0,
+            'rejected': 0,
+            'last_batch_size': 0
+        }
+        self.flush_latency = StageMetrics()
+
+    def start(self):
+        """Inicia el thread de escritura (idempotente)."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='coordinate-buffer', daemon=True)
+            self._thread.start()
+        log.info(f"📦 Buffer de ingesta activo (lote={self.batch_size}, intervalo={int(self.flush_interval * 1000)}ms)")
+
+    def add_flush_listener(self, callback):
+        """
+        Registra callback(filas, ids) que se llama desde el thread de escritura
+        después de cada lote escrito. Debe ser rápido y no lanzar excepciones.
+        """
+        self._flush_listeners.append(callback)
+
+    def add(self, row, timeout=None):
+        """
+        Encola una fila para escribir. Retorna False si se descartó
+        porque el buffer siguió lleno durante el tiempo de espera
+        (`timeout` en segundos; por defecto put_timeout_ms, 0 para no esperar).
+        """
+        return self.add_many([row], timeout)
+
+    def add_many(self, rows, timeout=None):
+        """
+        Encola las filas de un mismo paquete como una unidad: entran todas
+        o ninguna, y se escriben en el mismo INSERT. Mismo contrato que add().
+        """
+        n = len(rows)
+        if not n:
+            return True
+        with self._cond:
+            if self._stopping:
+                self._stats['dropped'] += n
+                return False
+
+            # Un grupo más grande que max_pending solo entra con el buffer vacío
+            if self._pending_rows and self._pending_rows + n > self.max_pending:
+                self._stats['backpressure_waits'] += 1
+                deadline = time.monotonic() + (self.put_timeout if timeout is None else timeout)
+                while (self._pending_rows and self._pending_rows + n > self.max_pending
+                       and not self._stopping):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['dropped'] += n
+                        return False
+                    self._cond.wait(remaining)
+                if self._stopping:
+                    self._stats['dropped'] += n
+                    return False
+
+            self._pending.append((list(rows), time.monotonic()))
+            self._pending_rows += n
+            self._stats['received'] += n
+            # Despertar al escritor con la primera fila (arranca el plazo) o con un lote completo
+            if len(self._pending) == 1 or self._pending_rows >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def _next_batch(self):
+        """
+        Espera hasta que haya un lote listo (o hasta la parada) y lo extrae
+        como lista de grupos (uno por paquete).
+        """
+        with self._cond:
+            while True:
+                if self._pending:
+                    oldest = self._pending[0][1]
+                    wait = oldest + self.flush_interval - time.monotonic()
+                    if self._pending_rows >= self.batch_size or wait <= 0 or self._stopping:
+                        break
+                    self._cond.wait(wait)
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+
+            # Los grupos no se parten: un paquete con varios fixes va en un solo INSERT
+            groups = []
+            size = 0
+            while self._pending and (not groups or size + len(self._pending[0][0]) <= self.batch_size):
+                rows = self._pending.popleft()[0]
+                groups.append(rows)
+                size += len(rows)
+                self._pending_rows -= len(rows)
+            self._cond.notify_all()   # hay espacio para productores bloqueados
+            return groups
+
+    def _flush(self, groups):
+        """
+        Escribe un lote (lista de grupos). Retorna los ids escritos, o None si
+        la BD no respondió y el lote volvió al buffer (o se descartó al agotar
+        los reintentos).
+        """
+        parts = [groups]      # pila de partes por escribir; la siguiente va al final
+        written = []
+        while parts:
+            part = parts.pop()
+            batch = [row for rows in part for row in rows]
+            start = time.monotonic()
+            try:
+                ids = self._writer(batch)
+            except TRANSIENT_ERRORS as e:
+                log.error(f"❌ Error de conexión escribiendo lote de {len(batch)} coordenadas: {e}")
+                self._retry(part + [rows for rest in reversed(parts) for rows in rest])
+                return None
+            except Exception as e:
+                with self._cond:
+                    self._stats['flush_errors'] += 1
+                if len(part) == 1:
+                    log.error(f"❌ Paquete de {len(batch)} coordenadas descartado por error de datos: {e}")
+                    with self._cond:
+                        self._stats['rejected'] += len(batch)
+                    continue
+                # Separar el lote para aislar los paquetes con datos inválidos
+                log.warning(f"⚠️ Error de datos en lote de {len(batch)} coordenadas, separando: {e}")
+                middle = len(part) // 2
+                parts.append(part[middle:])
+                parts.append(part[:middle])
+                continue
+
+            elapsed = time.monotonic() - start
+            with self._cond:
+                self._failures = 0
+                self._stats['written'] += len(batch)
+                self._stats['batches'] += 1
+                self._stats['last_batch_size'] = len(batch)
+            self.flush_latency.record(elapsed)
+            for callback in self._flush_listeners:
+                try:
+                    callback(batch, ids)
+                except Exception as e:
+                    log.error(f"❌ Error en listener de lote escrito: {e}")
+            written.extend(ids)
+        return written
+
+    def _retry(self, groups):
+        """
+        Devuelve los grupos de un lote fallido al frente del buffer, en orden y
+        enteros; los que no caben se descartan. Tras `max_retries` fallos
+        seguidos el lote se descarta completo.
+        """
+        with self._cond:
+            self._stats['flush_errors'] += 1
+            self._failures += 1
+            if self._failures > self.max_retries:
+                lost = sum(len(rows) for rows in groups)
+                self._stats['dropped'] += lost
+                self._failures = 0
+                log.error(f"❌ {lost} coordenadas descartadas tras {self.max_retries} reintentos")
+                return
+
+            space = self.max_pending - self._pending_rows
+            keep = []
+            for rows in groups:
+                # Un grupo más grande que max_pending solo entra con el buffer vacío (como en add_many)
+                if len(rows) > space and (keep or self._pending_rows):
+                    break
+                keep.append(rows)
+                space -= len(rows)
+            lost = sum(len(rows) for rows in groups[len(keep):])
+            self._stats['dropped'] += lost
+            now = time.monotonic()
+            self._pending.extendleft((rows, now) for rows in reversed(keep))
+            self._pending_rows += sum(len(rows) for rows in keep)
+
+    def _run(self):
+        while True:
+            groups = self._next_batch()
+            if groups is None:
+                return
+            if self._flush(groups) is None:
+                if self._stopping:
+                    # La BD no responde durante el apagado: no reintentar indefinidamente
+                    with self._cond:
+                        lost = self._pending_rows
+                        self._stats['dropped'] += lost
+                        self._pending.clear()
+                        self._pending_rows = 0
+                    if lost:
+                        log.error(f"❌ {lost} coordenadas descartadas al apagar (BD no disponible)")
+                    return
+                time.sleep(min(1.0, self.flush_interval))
+
+    def stop(self, timeout=10):
+        """Detiene el buffer escribiendo todo lo pendiente."""
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            pending = self._pending_rows
+            self._cond.notify_all()
+        log.info(f"🛑 Deteniendo buffer de ingesta ({pending} coordenadas pendientes)")
+        thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s['pending'] = self._pending_rows
+        s['batch_size'] = self.batch_size
+        s['flush_interval_ms'] = int(self.flush_interval * 1000)
+        s['max_pending'] = self.max_pending
+        s['flush_latency'] = self.flush_latency.snapshot()
+        return s
+
+
+class MatchWindows:
+    """
+    Agrupa los fixes de cada usuario en ventanas para ajustarlas con /match.
+
+    Una ventana se envía (dispatch(fixes, contexto)) al juntar `window` fixes
+    o cuando su fix más antiguo lleva `max_wait_ms` esperando. El último fix
+    de la ventana anterior va como contexto si su hora está a menos de
+    `context_s` segundos, para que el ajuste sea continuo entre ventanas;
+    el contexto no se vuelve a escribir.
+    """
+
+    def __init__(self, dispatch, window=MATCH_WINDOW, max_wait_ms=MATCH_MAX_WAIT_MS,
+                 context_s=MATCH_CONTEXT_S):
+        self.window = max(2, window)
+        self.max_wait = max_wait_ms / 1000.0
+        self.context_s = context_s
+        self._dispatch = dispatch
+        self._lock = threading.Lock()
+        self._open = {}          # user_id → (fixes, instante del primero)
+        self._last = {}          # user_id → (último fix enviado, instante)
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._stats = {'windows': 0, 'fixes': 0, 'by_size': 0, 'by_timeout': 0}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='match-windows', daemon=True)
+        self._thread.start()
+
+    def add(self, fixes):
+        ready = []
+        with self._lock:
+            now = time.monotonic()
+            for fix in fixes:
+                user_id = fix['user_id']
+                pending, opened_at = self._open.get(user_id, ([], now))
+                pending.append(fix)
+                if len(pending) >= self.window:
+                    self._open.pop(user_id, None)
+                    ready.append(self._close(user_id, pending, 'by_size'))
+                else:
+                    self._open[user_id] = (pending, opened_at)
+        for window, context in ready:
+            self._dispatch(window, context)
+
+    def _close(self, user_id, fixes, reason):
+        """Cierra la ventana de un usuario (con el lock tomado). Retorna (fixes, contexto)."""
+        context = self._last.get(user_id, (None, None))[0]
+        if context is not None:
+            previous, current = coordinate_ts(context['timestamp']), coordinate_ts(fixes[0]['timestamp'])
+            if previous is None or current is None or abs((current - previous).total_seconds()) > self.context_s:
+                context = None
+        self._last[user_id] = (fixes[-1], time.monotonic())
+        self._stats['windows'] += 1
+        self._stats['fixes'] += len(fixes)
+        self._stats[reason] += 1
+        return fixes, context
+
+    def _expired(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            users = [user_id for user_id, (_, opened_at) in self._open.items()
+                     if force or now - opened_at >= self.max_wait]
+            return [self._close(user_id, self._open.pop(user_id)[0], 'by_timeout') for user_id in users]
+
+    def _run(self):
+        interval = min(0.1, self.max_wait / 4) if self.max_wait > 0 else 0.01
+        next_cleanup = time.monotonic() + 10
+        while not self._stop_event.wait(interval):
+            for window, context in self._expired():
+                self._dispatch(window, context)
+            if time.monotonic() >= next_cleanup:
+                # Olvidar el contexto de usuarios que ya no envían
+                cutoff = time.monotonic() - self.context_s - self.max_wait
+                with self._lock:
+                    self._last = {u: last for u, last in self._last.items() if last[1] >= cutoff}
+                next_cleanup = time.monotonic() + 10
+
+    def stop(self):
+        """Envía todas las ventanas abiertas y detiene el thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(2)
+            self._thread = None
+        for window, context in self._expired(force=True):
+            self._dispatch(window, context)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['open_windows'] = len(self._open)
+            s['pending_fixes'] = sum(len(fixes) for fixes, _ in self._open.values())
+        s['window'] = self.window
+        s['max_wait_ms'] = int(self.max_wait * 1000)
+        s['avg_window'] = round(s['fixes'] / s['windows'], 2) if s['windows'] else 0
+        return s
+
+
+class SnapWorkerPool:
+    """
+    Etapa de snap-to-road del pipeline de ingesta.
+
+    El listener UDP entrega los fixes de cada paquete con submit_batch(), que
+    nunca bloquea: si la cola (`queue_size` paquetes) está llena el paquete se
+    descarta y se cuenta. Un grupo de `workers` threads consulta OSRM y pasa
+    el resultado al buffer de escritura en lote.
+
+    Con `matcher` (SNAP_MODE=match) los fixes se agrupan por usuario en
+    ventanas (MatchWindows) y cada ventana se ajusta con una sola llamada;
+    si falla, sus puntos se ajustan uno a uno con `snapper`.
+    """
+
+    def __init__(self, buffer, workers=SNAP_WORKERS, queue_size=SNAP_QUEUE_SIZE,
+                 snapper=snap_to_road, matcher=None):
+        self.workers = max(1, workers)
+        self._buffer = buffer
+        self._snapper = snapper
+        self._matcher = matcher
+        self._windows = MatchWindows(self._enqueue_window) if matcher else None
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._threads = []
+        self.queue_wait = StageMetrics()
+        self.snap = StageMetrics()
+        self.match = StageMetrics()
+
+    def start(self):
+        """Inicia los workers (idempotente)."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'snap-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self._windows:
+            self._windows.start()
+        mode = 'match' if self._windows else 'nearest'
+        log.info(f"🗺️  Pool de snap-to-road activo ({self.workers} workers, cola={self._queue.maxsize}, modo={mode})")
+
+    def submit(self, fix):
+        """
+        Encola un fix parseado (lat, lon, timestamp, user_id, source).
+        Retorna False si la cola estaba llena y el fix se descartó.
+        """
+        return self.submit_batch([fix])
+
+    def submit_batch(self, fixes):
+        """
+        Encola los fixes de un mismo paquete como una sola unidad de trabajo:
+        se ajustan juntos y entran juntos al buffer (un solo INSERT).
+        En modo match se suman a la ventana del usuario.
+        Retorna False si la cola estaba llena y el paquete se descartó.
+        """
+        if self._windows:
+            self._windows.add(fixes)
+            return True
+        return self._enqueue(fixes, None, False)
+
+    def _enqueue_window(self, fixes, context):
+        if not self._enqueue(fixes, context, True):
+            log.warning(f"⚠️ Cola de snap-to-road llena, ventana de {len(fixes)} fixes descartada")
+
+    def _enqueue(self, fixes, context, use_match):
+        try:
+            self._queue.put_nowait((fixes, context, use_match, time.monotonic()))
+            return True
+        except queue.Full:
+            self.queue_wait.drop(len(fixes))
+            return False
+
+    def _snap_one(self, fix):
+        try:
+            return self._snapper(fix['lat'], fix['lon'])
+        except Exception as e:
+            log.error(f"❌ Error en snap-to-road para {fix.get('user_id')}: {e}")
+            self.snap.error()
+            return fix['lat'], fix['lon'], None
+
+    def _match_window(self, fixes, context):
+        """Ajusta la ventana con /match; los puntos sin ajuste (o todos, si falla) van por /nearest."""
+        start = time.monotonic()
+        trajectory = ([context] if context else []) + fixes
+        try:
+            matched = self._matcher(trajectory)
+        except Exception as e:
+            log.error(f"❌ Error en map-matching para {fixes[0].get('user_id')}: {e}")
+            matched = None
+        if matched is None:
+            self.match.error()
+            return [self._snap_one(fix) for fix in fixes]
+        self.match.record(time.monotonic() - start)
+        if context:
+            matched = matched[1:]
+        unmatched = sum(1 for result in matched if result is None)
+        if unmatched:
+            self.match.drop(unmatched)   # puntos que OSRM no ajustó: van por /nearest
+        return [result or self._snap_one(fix) for fix, result in zip(fixes, matched)]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fixes, context, use_match, enqueued_at = item
+            start = time.monotonic()
+            self.queue_wait.record(start - enqueued_at)
+
+            if use_match:
+                results = self._match_window(fixes, context)
+            else:
+                results = [self._snap_one(fix) for fix in fixes]
+            rows = [coordinate_row(fix, *result) for fix, result in zip(fixes, results)]
+            self.snap.record(time.monotonic() - start)
+
+            if not self._buffer.add_many(rows):
+                log.warning(f"⚠️ Buffer de ingesta lleno, {len(rows)} coordenadas descartadas de {fixes[0]['source']}")
+
+    def stop(self, timeout=10):
+        """Procesa lo que queda en la cola y detiene los workers."""
+        if not self._threads:
+            return
+        if self._windows:
+            self._windows.stop()
+        log.info(f"🛑 Deteniendo pool de snap-to-road ({self._queue.qsize()} paquetes en cola)")
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+
+    def stats(self):
+        stats = {
+            'workers': self.workers,
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'queue_wait': self.queue_wait.snapshot(),
+            'snap': self.snap.snapshot()
+        }
+        if self._windows:
+            stats['match'] = self.match.snapshot()
+            stats['match_windows'] = self._windows.stats()
+        return stats
+
+
+_buffer = None
+_snap_pool = None
+_buffer_lock = threading.Lock()
+_receive_metrics = StageMetrics()
+
+
+def get_coordinate_buffer():
+    """Retorna el buffer global, iniciándolo en el primer uso."""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = CoordinateBuffer()
+                # Las posiciones en vivo se actualizan con cada lote escrito (ya con id)
+                get_position_registry().attach(_buffer)
+                get_congestion_tracker().attach(_buffer)
+                get_position_stream().attach(_buffer)
+                _buffer.start()
+                atexit.register(_buffer.stop)
+    return _buffer
+
+
+def get_snap_pool():
+    """Retorna el pool de snap-to-road global, iniciándolo en el primer uso."""
+    global _snap_pool
+    if _snap_pool is None:
+        buffer = get_coordinate_buffer()
+        with _buffer_lock:
+            if _snap_pool is None:
+                matcher = match_trajectory if SNAP_MODE == 'match' else None
+                _snap_pool = SnapWorkerPool(buffer, matcher=matcher)
+                _snap_pool.start()
+                # atexit es LIFO: se vacía la cola de snap antes que el buffer de escritura
+                atexit.register(_snap_pool.stop)
+    return _snap_pool
+
+
+def get_receive_metrics():
+    """Métricas de la etapa de recepción y parseo (las registra el listener UDP)."""
+    return _receive_metrics
+
+
+def get_ingest_stats():
+    """Profundidad de cola y latencia de cada etapa del pipeline de ingesta."""
+    return {
+        'receive': _receive_metrics.snapshot(),
+        'snap': _snap_pool.stats() if _snap_pool else {},
+        'write': _buffer.stats() if _buffer else {}
+    }
@@ -0,0 +1,263 @@
+# app/services_localsnap.py
+import hashlib
+import json
+import math
+import threading
+import time
+import xml.etree.ElementTree as ET
+from app.config import SNAP_ENGINE, LOCAL_SNAP_FILE, LOCAL_SNAP_MAX_DISTANCE_M
+import logging
+
+try:
+    import numpy as np
+except ImportError:  # Opcional: sin numpy la proyección se hace en Python puro
+    np = None
+
+log = logging.getLogger(__name__)
+
+_METERS_PER_DEGREE = 111320.0
+
+# Desde cuántos tramos candidatos en una celda se proyecta con numpy (por debajo el bucle es más rápido)
+NUMPY_MIN_CANDIDATES = 32
+
+# Vías por las que enruta el perfil de carro de OSRM (las demás no se cargan)
+CAR_HIGHWAYS = {
+    'motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link',
+    'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified',
+    'residential', 'living_street', 'service', 'road'
+}
+
+
+def _segment_id(a, b):
+    """Mismo segment_id que services_osrm para una arista entre dos nodos OSM."""
+    node_pair = f"{min(a, b)}-{max(a, b)}"
+    return hashlib.md5(node_pair.encode()).hexdigest()[:12]
+
+
+def _read_osm(path):
+    """
+    Lee un extracto .osm (XML) y retorna las vías de carro como
+    (nombre, [(lat, lon), ...], [nodo, ...]).
+    """
+    coords = {}
+    ways = []
+    for _, elem in ET.iterparse(path, events=('end',)):
+        if elem.tag == 'node':
+            coords[int(elem.get('id'))] = (float(elem.get('lat')), float(elem.get('lon')))
+            elem.clear()
+        elif elem.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in elem.findall('tag')}
+            if tags.get('highway') in CAR_HIGHWAYS:
+                nodes = [int(nd.get('ref')) for nd in elem.findall('nd')]
+                nodes = [node for node in nodes if node in coords]
+                ways.append((tags.get('name'), [coords[node] for node in nodes], nodes))
+            elem.clear()
+    return ways
+
+
+def _read_geojson(path):
+    """
+    Lee LineStrings/MultiLineStrings de un GeoJSON. Si la propiedad `nodes`
+    trae los ids OSM alineados con las coordenadas, los segment_id coinciden
+    con los de OSRM; si no, se derivan de la geometría.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    ways = []
+    for feature in data.get('features', []):
+        geometry = feature.get('geometry') or {}
+        properties = feature.get('properties') or {}
+        highway = properties.get('highway')
+        if highway is not None and highway not in CAR_HIGHWAYS:
+            continue
+        if geometry.get('type') == 'LineString':
+            lines = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiLineString':
+            lines = geometry['coordinates']
+        else:
+            continue
+        nodes = properties.get('nodes')
+        for line in lines:
+            points = [(lat, lon) for lon, lat, *_ in line]
+            ways.append((properties.get('name'), points,
+                         nodes if nodes and len(nodes) == len(points) and len(lines) == 1 else None))
+    return ways
+
+
+class LocalSnapEngine:
+    """
+    Snap-to-road en el proceso, sin llamadas HTTP, a partir de un extracto
+    de calles (.osm o .geojson).
+
+    Cada tramo entre dos nodos consecutivos de una vía se guarda en una
+    cuadrícula de celdas de `max_distance_m` metros, en todas las celdas que
+    toca su caja ampliada en esa distancia: así los candidatos de un punto
+    están en una sola celda. El punto se proyecta sobre todos los candidatos
+    (vectorizado con numpy en celdas densas, si está instalado) y gana el
+    más cercano.
+    Retorna lo mismo que snap_to_road, o None si no hay calle a menos de
+    `max_distance_m`.
+    """
+
+    def __init__(self, ways, max_distance_m=LOCAL_SNAP_MAX_DISTANCE_M):
+        self.max_distance = max_distance_m
+        self.cell = max(max_distance_m, 1.0)
+        self._lock = threading.Lock()
+        self._stats = {'snaps': 0, 'misses': 0, 'validated': 0, 'agreed': 0, 'total_us': 0.0}
+
+        lats = [lat for _, points, _ in ways for lat, _ in points]
+        ref_lat = (min(lats) + max(lats)) / 2 if lats else 0.0
+        self._ky = _METERS_PER_DEGREE
+        self._kx = _METERS_PER_DEGREE * math.cos(math.radians(ref_lat))
+
+        ax, ay, bx, by, self._info = [], [], [], [], []
+        for name, points, nodes in ways:
+            for i in range(len(points) - 1):
+                (lat1, lon1), (lat2, lon2) = points[i], points[i + 1]
+                if (lat1, lon1) == (lat2, lon2):
+                    continue
+                x1, y1, x2, y2 = lon1 * self._kx, lat1 * self._ky, lon2 * self._kx, lat2 * self._ky
+                ax.append(x1); ay.append(y1); bx.append(x2); by.append(y2)
+                if nodes:
+                    segment_id = _segment_id(nodes[i], nodes[i + 1])
+                else:
+                    segment_id = hashlib.md5(f"{lat1:.6f},{lon1:.6f};{lat2:.6f},{lon2:.6f}".encode()).hexdigest()[:12]
+                self._info.append((
+                    segment_id,
+                    name or 'Unknown',
+                    round(math.hypot(x2 - x1, y2 - y1), 1),
+                    round(math.degrees(math.atan2(x2 - x1, y2 - y1)) % 360),
+                    [nodes[i], nodes[i + 1]] if nodes else None
+                ))
+
+        grid = {}
+        pad = self.max_distance
+        for i in range(len(ax)):
+            for cx in range(int((min(ax[i], bx[i]) - pad) // self.cell), int((max(ax[i], bx[i]) + pad) // self.cell) + 1):
+                for cy in range(int((min(ay[i], by[i]) - pad) // self.cell), int((max(ay[i], by[i]) + pad) // self.cell) + 1):
+                    grid.setdefault((cx, cy), []).append(i)
+
+        self._segments = [(x1, y1, x2 - x1, y2 - y1, (x2 - x1) ** 2 + (y2 - y1) ** 2)
+                          for x1, y1, x2, y2 in zip(ax, ay, bx, by)]
+        self._grid = grid
+        # numpy solo compensa su costo fijo por llamada en celdas con muchos candidatos
+        self._grid_np = {}
+        if np is not None:
+            self._ax, self._ay = np.array(ax), np.array(ay)
+            self._dx, self._dy = np.array(bx) - self._ax, np.array(by) - self._ay
+            self._len2 = self._dx ** 2 + self._dy ** 2
+            self._grid_np = {key: np.array(ids, dtype=np.int32) for key, ids in grid.items()
+                             if len(ids) >= NUMPY_MIN_CANDIDATES}
+        log.info(f"🧭 Snap local: {len(self._info)} tramos de {len(ways)} vías en {len(grid)} celdas "
+                 f"({len(self._grid_np)} vectorizadas con numpy)")
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        ways = _read_osm(path) if path.endswith('.osm') else _read_geojson(path)
+        return cls(ways, **kwargs)
+
+    def _nearest(self, px, py, candidates):
+        """
+        (índice, distancia², x, y) del tramo más cercano entre los candidatos
+        (lista de índices, o arreglo de numpy para la versión vectorizada).
+        """
+        if np is not None and isinstance(candidates, np.ndarray):
+            ax, ay, dx, dy = self._ax[candidates], self._ay[candidates], self._dx[candidates], self._dy[candidates]
+            t = np.clip(((px - ax) * dx + (py - ay) * dy) / self._len2[candidates], 0.0, 1.0)
+            qx, qy = ax + t * dx, ay + t * dy
+            dist2 = (qx - px) ** 2 + (qy - py) ** 2
+            k = int(dist2.argmin())
+            return int(candidates[k]), float(dist2[k]), float(qx[k]), float(qy[k])
+
+        best = None
+        for i in candidates:
+            ax, ay, dx, dy, len2 = self._segments[i]
+            t = ((px - ax) * dx + (py - ay) * dy) / len2
+            t = 0.0 if t < 0 else 1.0 if t > 1 else t
+            qx, qy = ax + t * dx, ay + t * dy
+            dist2 = (qx - px) ** 2 + (qy - py) ** 2
+            if best is None or dist2 < best[1]:
+                best = (i, dist2, qx, qy)
+        return best
+
+    def snap(self, lat, lon):
+        """Retorna (lat, lon, segment_info) ajustados, o None si no hay calle cerca."""
+        start = time.perf_counter()
+        px, py = lon * self._kx, lat * self._ky
+        key = (int(px // self.cell), int(py // self.cell))
+        candidates = self._grid_np.get(key)
+        if candidates is None:
+            candidates = self._grid.get(key)
+        best = self._nearest(px, py, candidates) if candidates is not None else None
+        found = best is not None and best[1] <= self.max_distance ** 2
+
+        with self._lock:
+            self._stats['total_us'] += (time.perf_counter() - start) * 1e6
+            self._stats['snaps' if found else 'misses'] += 1
+        if not found:
+            return None
+
+        i, _, qx, qy = best
+        segment_id, street_name, length, bearing, nodes = self._info[i]
+        segment_info = {
+            'segment_id': segment_id,
+            'street_name': street_name,
+            'start_intersection': None,
+            'end_intersection': None,
+            'segment_length': length,
+            'bearing': bearing
+        }
+        if nodes:
+            segment_info['nodes'] = list(nodes)
+        x1, y1, dx, dy, _ = self._segments[i]
+        segment_info['geometry'] = ((y1 / self._ky, x1 / self._kx), ((y1 + dy) / self._ky, (x1 + dx) / self._kx))
+        return qy / self._ky, qx / self._kx, segment_info
+
+    def record_validation(self, agreed):
+        """Registra una comparación contra OSRM (mismo segment_id o no)."""
+        with self._lock:
+            self._stats['validated'] += 1
+            if agreed:
+                self._stats['agreed'] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        lookups = s['snaps'] + s['misses']
+        s['avg_us'] = round(s.pop('total_us') / lookups, 2) if lookups else 0
+        s['agreement'] = round(s['agreed'] / s['validated'], 4) if s['validated'] else None
+        s['segments'] = len(self._info)
+        s['numpy_cells'] = len(self._grid_np)
+        s['max_distance_m'] = self.max_distance
+        return s
+
+
+_engine = None
+_engine_loaded = False
+_engine_lock = threading.Lock()
+
+
+def get_local_snap_engine():
+    """
+    Motor de snap local si SNAP_ENGINE=local (se carga una vez, en el primer
+    uso). None si no está configurado o el extracto no se pudo cargar.
+    """
+    global _engine, _engine_loaded
+    if SNAP_ENGINE != 'local':
+        return None
+    if not _engine_loaded:
+        with _engine_lock:
+            if not _engine_loaded:
+                try:
+                    _engine = LocalSnapEngine.from_file(LOCAL_SNAP_FILE)
+                except Exception as e:
+                    log.error(f"❌ No se pudo cargar el extracto de calles {LOCAL_SNAP_FILE}: {e} - se usa OSRM")
+                _engine_loaded = True
+    return _engine
+
+
+def get_local_snap_stats():
+    """Estadísticas del motor de snap local (vacío si no está activo)."""
+    if _engine is None:
+        return {}
+    return _engine.stats()
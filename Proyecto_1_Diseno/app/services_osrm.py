@@ -1,23 +1,553 @@
 # app/services_osrm.py
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+import bisect
 import hashlib
-from app.config import OSRM_HOST
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from app.cache import LRUCache
+from app.database import coordinate_ts
+from app.services_localsnap import get_local_snap_engine
+from app.services_segments import get_segment_registry
+from app.config import (
+    OSRM_HOST, SNAP_CACHE_SIZE, SNAP_CACHE_TTL, SNAP_CACHE_CELL_M, OSRM_EDGE_CACHE_SIZE,
+    OSRM_POOL_SIZE, OSRM_TIMEOUT, OSRM_CONNECT_TIMEOUT, OSRM_BREAKER_FAILURES, OSRM_BREAKER_RESET_S,
+    OSRM_HEALTH_INTERVAL_S, LOCAL_SNAP_FALLBACK, LOCAL_SNAP_VALIDATE_RATE
+)
 import logging
 
 log = logging.getLogger(__name__)
 
-def reconstruct_segment_from_osrm(segment_id):
+# ===== CLIENTE OSRM =====
+
+class OSRMUnavailable(requests.exceptions.ConnectionError):
+    """El circuit breaker está abierto: no se llama a OSRM hasta que pase el tiempo de espera."""
+
+
+class LatencyHistogram:
+    """Histograma de latencias con buckets fijos (ms) y percentiles aproximados."""
+
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self._total_ms = 0.0
+
+    def record(self, seconds, ok=True):
+        ms = seconds * 1000
+        with self._lock:
+            self._counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            self.count += 1
+            self._total_ms += ms
+            if not ok:
+                self.errors += 1
+
+    def _percentile(self, counts, fraction):
+        """Límite superior del bucket que contiene el percentil."""
+        target = fraction * sum(counts)
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= target:
+                return self.BUCKETS_MS[i] if i < len(self.BUCKETS_MS) else None
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            count, errors, total = self.count, self.errors, self._total_ms
+        labels = [f'le_{b}ms' for b in self.BUCKETS_MS] + ['gt_5000ms']
+        return {
+            'count': count,
+            'errors': errors,
+            'avg_ms': round(total / count, 3) if count else 0,
+            'p50_ms': self._percentile(counts, 0.5) if count else 0,
+            'p95_ms': self._percentile(counts, 0.95) if count else 0,
+            'p99_ms': self._percentile(counts, 0.99) if count else 0,
+            'buckets': dict(zip(labels, counts))
+        }
+
+
+class OSRMClient:
     """
-    Intenta reconstruir un segmento usando OSRM.
-    
-    Como el segment_id es un hash de nodos y no tenemos los nodos originales,
-    esta función no puede reconstruir el segmento exacto.
-    
-    Retorna None para que se use el fallback de estimación.
+    Cliente HTTP compartido para OSRM (thread-safe).
+
+    Usa una sesión de requests con conexiones keep-alive (hasta `pool_size`
+    abiertas) y un circuit breaker: tras `breaker_failures` fallos seguidos
+    (error de conexión, timeout o HTTP 5xx) deja de llamar a OSRM durante
+    `breaker_reset_s` segundos y lanza OSRMUnavailable al instante; luego
+    deja pasar una llamada de prueba que lo cierra si funciona. Registra un
+    histograma de latencia por servicio (nearest, route, match).
+    """
+
+    def __init__(self, base_url=OSRM_HOST, pool_size=OSRM_POOL_SIZE, timeout=OSRM_TIMEOUT,
+                 connect_timeout=OSRM_CONNECT_TIMEOUT, breaker_failures=OSRM_BREAKER_FAILURES,
+                 breaker_reset_s=OSRM_BREAKER_RESET_S):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.breaker_failures = max(1, breaker_failures)
+        self.breaker_reset_s = breaker_reset_s
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._stats = {'rejected': 0, 'opened': 0}
+        self._latency = {}
+
+    def _histogram(self, service):
+        histogram = self._latency.get(service)
+        if histogram is None:
+            with self._lock:
+                histogram = self._latency.setdefault(service, LatencyHistogram())
+        return histogram
+
+    def acquire(self, service, probe=False):
+        """
+        Pide permiso al circuit breaker antes de una llamada. Lanza
+        OSRMUnavailable si está abierto. Con probe=True (chequeos de salud)
+        siempre deja pasar.
+        """
+        with self._lock:
+            if self._state == 'closed' or probe:
+                return
+            if self._state == 'open' and time.monotonic() - self._opened_at >= self.breaker_reset_s:
+                self._state = 'half_open'
+            if self._state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self._stats['rejected'] += 1
+        raise OSRMUnavailable(f"OSRM no disponible (circuit breaker abierto), servicio {service}")
+
+    def release(self, service, elapsed, ok):
+        """Registra el resultado de una llamada (latencia y estado del breaker)."""
+        self._histogram(service).record(elapsed, ok)
+        with self._lock:
+            self._trial_in_flight = False
+            if ok:
+                if self._state != 'closed':
+                    log.info("✅ OSRM respondió: circuit breaker cerrado")
+                self._state = 'closed'
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == 'half_open' or (self._state == 'closed' and self._failures >= self.breaker_failures):
+                if self._state == 'closed':
+                    log.warning(f"⚠️ OSRM: {self._failures} fallos seguidos, circuit breaker abierto por {self.breaker_reset_s}s")
+                    self._stats['opened'] += 1
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+
+    def get(self, service, path, params=None, timeout=None, probe=False):
+        """GET a OSRM (path relativo, p. ej. '/nearest/v1/driving/lon,lat'). Retorna la respuesta."""
+        self.acquire(service, probe)
+        start = time.monotonic()
+        try:
+            response = self._session.get(
+                f"{self.base_url}{path}", params=params,
+                timeout=(self.connect_timeout, timeout or self.timeout)
+            )
+        except requests.exceptions.RequestException:
+            self.release(service, time.monotonic() - start, False)
+            raise
+        self.release(service, time.monotonic() - start, response.status_code < 500)
+        return response
+
+    def is_open(self):
+        with self._lock:
+            return self._state != 'closed'
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['state'] = self._state
+            s['consecutive_failures'] = self._failures
+            services = list(self._latency.items())
+        s['latency'] = {service: histogram.snapshot() for service, histogram in services}
+        return s
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_osrm_client():
+    """Cliente OSRM del proceso (se crea de nuevo tras un fork: los sockets no se comparten)."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = OSRMClient()
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_osrm_stats():
+    """Estado del circuit breaker, latencias por servicio y monitor de salud de OSRM."""
+    s = get_osrm_client().stats()
+    if _monitor is not None and _monitor_pid == os.getpid():
+        s['health'] = _monitor.status()
+    return s
+
+
+async def _get_async(session, service, path, params=None):
+    """
+    GET a OSRM desde el servidor asyncio (sesión aiohttp propia), pasando por
+    el mismo circuit breaker e histogramas. Retorna (status, json o None).
+    """
+    client = get_osrm_client()
+    client.acquire(service)
+    start = time.monotonic()
+    try:
+        async with session.get(f"{client.base_url}{path}", params=params) as response:
+            data = await response.json() if response.status == 200 else None
+    except Exception:
+        client.release(service, time.monotonic() - start, False)
+        raise
+    client.release(service, time.monotonic() - start, response.status < 500)
+    return response.status, data
+
+# ===== MONITOR DE SALUD =====
+
+class OSRMHealthMonitor:
+    """
+    Verifica OSRM en segundo plano cada `interval` segundos y guarda el
+    resultado, así consultar la disponibilidad no hace una llamada HTTP.
+    La primera verificación se hace al iniciar (síncrona) para que el
+    estado se conozca desde el arranque. Mientras OSRM está caído,
+    snap_to_road no lo llama; una verificación exitosa cierra también el
+    circuit breaker del cliente.
+    """
+
+    PROBE_PATH = "/nearest/v1/driving/-74.8,11.0"
+
+    def __init__(self, client, interval=OSRM_HEALTH_INTERVAL_S):
+        self.client = client
+        self.interval = max(0.1, interval)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._available = None
+        self._changed_at = None
+        self._checked_at = None
+        self._last_error = None
+        self._stats = {'checks': 0, 'failures': 0, 'transitions': 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='osrm-health', daemon=True)
+        self.check()
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Hace una verificación y actualiza el estado. Retorna si OSRM está disponible."""
+        error = None
+        try:
+            response = self.client.get('health', self.PROBE_PATH, probe=True, timeout=self.client.connect_timeout * 2)
+            available = response.status_code == 200
+            if not available:
+                error = f"HTTP {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            available, error = False, str(e)
+
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            previous = self._available
+            self._checked_at = now
+            self._last_error = error
+            self._stats['checks'] += 1
+            if not available:
+                self._stats['failures'] += 1
+            if available == previous:
+                return available
+            self._available = available
+            self._changed_at = now
+            if previous is not None:
+                self._stats['transitions'] += 1
+
+        if available:
+            log.info("✅ OSRM disponible")
+        else:
+            log.warning(f"⚠️ OSRM no disponible - snap-to-roads desactivado ({error})")
+        return available
+
+    def is_available(self):
+        return bool(self._available)
+
+    def is_down(self):
+        """True solo si la última verificación falló (desconocido no cuenta como caído)."""
+        return self._available is False
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        with self._lock:
+            s = dict(self._stats)
+            s.update({
+                'available': self._available,
+                'since': self._changed_at.isoformat() if self._changed_at else None,
+                'last_check': self._checked_at.isoformat() if self._checked_at else None,
+                'last_error': self._last_error,
+                'interval_s': self.interval
+            })
+        return s
+
+
+_monitor = None
+_monitor_pid = None
+_monitor_lock = threading.Lock()
+
+
+def get_osrm_monitor():
+    """Monitor de salud de OSRM del proceso; se inicia en el primer uso."""
+    global _monitor, _monitor_pid
+    if _monitor is None or _monitor_pid != os.getpid():
+        with _monitor_lock:
+            if _monitor is None or _monitor_pid != os.getpid():
+                _monitor = OSRMHealthMonitor(get_osrm_client())
+                _monitor_pid = os.getpid()
+        _monitor.start()
+    return _monitor
+
+
+def osrm_known_down():
+    """True si el monitor del proceso ya verificó que OSRM está caído (sin llamada HTTP)."""
+    return _monitor is not None and _monitor_pid == os.getpid() and _monitor.is_down()
+
+# ===== CACHÉ DE SNAP-TO-ROAD =====
+# Llave: celda de una cuadrícula de SNAP_CACHE_CELL_M metros (en grados; a la latitud
+# de Barranquilla la celda es ~2% más angosta en longitud, irrelevante a esta escala).
+# Valor: (lat ajustada, lon ajustada, segment_info) del primer fix que cayó en la celda.
+_METERS_PER_DEGREE = 111320.0
+_snap_cell_deg = max(SNAP_CACHE_CELL_M, 0.01) / _METERS_PER_DEGREE
+_snap_cache = LRUCache(SNAP_CACHE_SIZE, SNAP_CACHE_TTL)
+
+def _snap_cache_key(lat, lon):
+    return (round(lat / _snap_cell_deg), round(lon / _snap_cell_deg))
+
+# Rumbo, longitud y geometría por arista (par de nodos OSM): /route solo se consulta la primera vez
+_edge_cache = LRUCache(OSRM_EDGE_CACHE_SIZE)
+
+# Distancia (en cada eje) de los extremos de la ruta de sondeo de una arista nueva
+_EDGE_PROBE_M = 150
+
+def get_snap_cache_stats():
+    """Aciertos, fallos y ocupación de las cachés de snap-to-road y de aristas."""
+    s = _snap_cache.stats()
+    s['cell_m'] = SNAP_CACHE_CELL_M
+    s['edges'] = _edge_cache.stats()
+    return s
+
+def _fallback_segment(snapped_lat, snapped_lon):
+    """Segmento de respaldo: hash de las coordenadas ajustadas redondeadas."""
+    segment_string = f"{snapped_lat:.4f},{snapped_lon:.4f}"
+    segment_id = hashlib.md5(segment_string.encode()).hexdigest()[:12]
+    return {
+        'segment_id': segment_id,
+        'street_name': 'Unknown',
+        'start_intersection': None,
+        'end_intersection': None,
+        'segment_length': 0,
+        'bearing': 0
+    }
+
+
+def _segment_from_route(data):
+    """
+    Extrae la información del segmento de una respuesta de /route
+    (steps=true, annotations=true). Retorna None si no trae nodos.
     """
-    log.warning(f"⚠️ No se puede reconstruir segmento {segment_id} sin los nodos originales")
+    if data.get('code') == 'Ok' and len(data.get('routes', [])) > 0:
+        route = data['routes'][0]
+        legs = route.get('legs', [])
+        
+        if legs and len(legs) > 0:
+            annotation = legs[0].get('annotation', {})
+            nodes = annotation.get('nodes', [])
+            steps = legs[0].get('steps', [])
+            
+            if nodes and len(nodes) >= 2:
+                # Usar los nodos para crear el segment_id
+                # Los nodos son únicos por segmento en OSRM
+                node_pair = f"{min(nodes)}-{max(nodes)}"
+                segment_id = hashlib.md5(node_pair.encode()).hexdigest()[:12]
+                
+                # Obtener nombre de calle y bearing del primer step
+                street_name = 'Unknown'
+                bearing = 0
+                
+                if steps and len(steps) > 0:
+                    step = steps[0]
+                    street_name = step.get('name', 'Unknown') or 'Unknown'
+                    intersections = step.get('intersections', [])
+                    if intersections:
+                        bearings = intersections[0].get('bearings', [])
+                        if bearings:
+                            bearing = bearings[0]
+                
+                log.info(f"✓ Segment detectado: nodes={node_pair}, bearing={bearing}°")
+                
+                return {
+                    'segment_id': segment_id,
+                    'street_name': street_name,
+                    'start_intersection': None,
+                    'end_intersection': None,
+                    'segment_length': legs[0].get('distance', 0),
+                    'bearing': bearing,
+                    'nodes': nodes  # Guardar los nodos para debug
+                }
     return None
 
+
+def _snapped_from_nearest(data):
+    """Extrae (lat, lon, distancia) ajustados de una respuesta de /nearest, o None."""
+    if data.get('code') == 'Ok' and len(data.get('waypoints', [])) > 0:
+        waypoint = data['waypoints'][0]
+        snapped_lon, snapped_lat = waypoint['location'][0], waypoint['location'][1]
+        return snapped_lat, snapped_lon, waypoint.get('distance', 0)
+    return None
+
+
+def _segment_from_nearest(data):
+    """
+    Arma segment_info con el waypoint de /nearest (nodos de la arista y nombre
+    de la calle), con el mismo segment_id que _segment_from_route.
+    Retorna (par_de_nodos, segment_info) o None si OSRM no trajo los nodos.
+    Rumbo y longitud salen de la caché de aristas; si la arista es nueva
+    quedan en 0 y el llamador los completa con _apply_edge.
+    """
+    waypoint = data['waypoints'][0]
+    nodes = [node for node in waypoint.get('nodes') or [] if node]
+    if len(nodes) < 2:
+        return None
+    
+    node_pair = f"{min(nodes)}-{max(nodes)}"
+    segment = {
+        'segment_id': hashlib.md5(node_pair.encode()).hexdigest()[:12],
+        'street_name': waypoint.get('name') or 'Unknown',
+        'start_intersection': None,
+        'end_intersection': None,
+        'segment_length': 0,
+        'bearing': 0,
+        'nodes': nodes
+    }
+    return node_pair, segment
+
+
+def _apply_edge(segment, edge):
+    """Completa segment_info con el rumbo, la longitud y, si se conoce, la geometría de la arista."""
+    segment['bearing'] = edge['bearing']
+    segment['segment_length'] = edge['segment_length']
+    if segment['street_name'] == 'Unknown':
+        segment['street_name'] = edge['street_name']
+    if edge.get('geometry'):
+        segment['geometry'] = edge['geometry']
+    return segment
+
+
+def _same_location(a, b):
+    """True si dos ubicaciones [lon, lat] de OSRM coinciden (~1 m)."""
+    return abs(a[0] - b[0]) < 1e-5 and abs(a[1] - b[1]) < 1e-5
+
+
+def _edge_geometries(route, waypoints):
+    """
+    Extremos exactos de las aristas que recorre una ruta o matching de OSRM
+    (overview=full, geometries=geojson, annotations con nodes), como
+    {par de nodos: ((lat, lon), (lat, lon))} en el sentido del recorrido.
+
+    En cada tramo `nodes` trae un nodo por coordenada, pero la primera y la
+    última coordenada son los puntos pedidos: solo los nodos interiores
+    tienen su posición real. La arista que contiene un punto pedido une el
+    último nodo interior del tramo que llega con el primero del que sale.
+    `waypoints` son las ubicaciones [lon, lat] de inicio de cada tramo, para
+    verificar que la geometría esté alineada con los nodos.
+    """
+    coordinates = (route.get('geometry') or {}).get('coordinates') or []
+    edges = {}
+    offset = 0
+    previous = None       # (nodo, coordenada, último nodo del tramo) del tramo anterior
+    for index, leg in enumerate(route.get('legs', [])):
+        nodes = (leg.get('annotation') or {}).get('nodes') or []
+        if (len(nodes) < 2 or offset + len(nodes) > len(coordinates) or index >= len(waypoints)
+                or not _same_location(coordinates[offset], waypoints[index])):
+            break
+        points = [(nodes[i], coordinates[offset + i]) for i in range(1, len(nodes) - 1)]
+        if previous is not None and points and previous[2] == points[0][0] and nodes[0] == previous[0]:
+            points.insert(0, previous[:2])
+        for (node_a, (lon_a, lat_a)), (node_b, (lon_b, lat_b)) in zip(points, points[1:]):
+            edges[f"{min(node_a, node_b)}-{max(node_a, node_b)}"] = ((lat_a, lon_a), (lat_b, lon_b))
+        previous = points[-1] + (nodes[-1],) if points else None
+        offset += len(nodes) - 1
+    return edges
+
+
+def _edge_from_geometry(start, end, street_name='Unknown'):
+    """Rumbo y longitud de una arista a partir de sus extremos (lat, lon)."""
+    dx = (end[1] - start[1]) * _METERS_PER_DEGREE * math.cos(math.radians((start[0] + end[0]) / 2))
+    dy = (end[0] - start[0]) * _METERS_PER_DEGREE
+    return {
+        'bearing': round(math.degrees(math.atan2(dx, dy))) % 360,
+        'segment_length': round(math.hypot(dx, dy), 1),
+        'street_name': street_name,
+        'geometry': (start, end)
+    }
+
+
+def _probe_request(lat, lon):
+    """
+    Ruta de sondeo para una arista nueva: cruza el punto ajustado desde
+    _EDGE_PROBE_M al suroeste hasta _EDGE_PROBE_M al noreste, así pasa por
+    los dos nodos de la arista y trae sus posiciones.
+    """
+    d_lat = _EDGE_PROBE_M / _METERS_PER_DEGREE
+    d_lon = d_lat / max(math.cos(math.radians(lat)), 0.01)
+    path = f"/route/v1/driving/{lon - d_lon},{lat - d_lat};{lon},{lat};{lon + d_lon},{lat + d_lat}"
+    return path, {'overview': 'full', 'geometries': 'geojson', 'annotations': 'nodes'}
+
+
+def _edge_from_probe(data, node_pair):
+    """Arista (con geometría) a partir de la respuesta de la ruta de sondeo, o None si no pasó por ella."""
+    if data.get('code') != 'Ok' or not data.get('routes'):
+        return None
+    waypoints = [waypoint['location'] for waypoint in data.get('waypoints', [])]
+    geometry = _edge_geometries(data['routes'][0], waypoints).get(node_pair)
+    return _edge_from_geometry(*geometry) if geometry else None
+
+
+def _edge_from_route(data):
+    """Rumbo, longitud y nombre de la arista a partir de una respuesta de /route, o None."""
+    route_segment = _segment_from_route(data)
+    if not route_segment:
+        return None
+    return {
+        'bearing': route_segment['bearing'],
+        'segment_length': route_segment['segment_length'],
+        'street_name': route_segment['street_name']
+    }
+
+
 def get_street_segment_id(lat, lon, snapped_lat, snapped_lon):
     """
     Genera un ID único para el segmento de calle usando los nodos de OSRM.
@@ -25,102 +555,125 @@ def get_street_segment_id(lat, lon, snapped_lat, snapped_lon):
     """
     try:
         # Usar /route con el mismo punto duplicado para obtener info del segmento
-        url = f"{OSRM_HOST}/route/v1/driving/{lon},{lat};{lon},{lat}"
-        response = requests.get(url, params={
+        response = get_osrm_client().get('route', f"/route/v1/driving/{lon},{lat};{lon},{lat}", params={
             'steps': 'true',
             'annotations': 'true'
-        }, timeout=2)
+        })
         
         if response.status_code == 200:
-            data = response.json()
-            if data.get('code') == 'Ok' and len(data.get('routes', [])) > 0:
-                route = data['routes'][0]
-                legs = route.get('legs', [])
-                
-                if legs and len(legs) > 0:
-                    annotation = legs[0].get('annotation', {})
-                    nodes = annotation.get('nodes', [])
-                    steps = legs[0].get('steps', [])
-                    
-                    if nodes and len(nodes) >= 2:
-                        # Usar los nodos para crear el segment_id
-                        # Los nodos son únicos por segmento en OSRM
-                        node_pair = f"{min(nodes)}-{max(nodes)}"
-                        segment_id = hashlib.md5(node_pair.encode()).hexdigest()[:12]
-                        
-                        # Obtener nombre de calle y bearing del primer step
-                        street_name = 'Unknown'
-                        bearing = 0
-                        
-                        if steps and len(steps) > 0:
-                            step = steps[0]
-                            street_name = step.get('name', 'Unknown') or 'Unknown'
-                            intersections = step.get('intersections', [])
-                            if intersections:
-                                bearings = intersections[0].get('bearings', [])
-                                if bearings:
-                                    bearing = bearings[0]
-                        
-                        log.info(f"✓ Segment detectado: nodes={node_pair}, bearing={bearing}°")
-                        
-                        return {
-                            'segment_id': segment_id,
-                            'street_name': street_name,
-                            'start_intersection': None,
-                            'end_intersection': None,
-                            'segment_length': legs[0].get('distance', 0),
-                            'bearing': bearing,
-                            'nodes': nodes  # Guardar los nodos para debug
-                        }
+            segment = _segment_from_route(response.json())
+            if segment:
+                return segment
         
         # Fallback: usar coordenadas redondeadas
         log.warning(f"⚠ Usando fallback para segment_id en ({lat}, {lon})")
-        segment_string = f"{snapped_lat:.4f},{snapped_lon:.4f}"
-        segment_id = hashlib.md5(segment_string.encode()).hexdigest()[:12]
-        
-        return {
-            'segment_id': segment_id,
-            'street_name': 'Unknown',
-            'start_intersection': None,
-            'end_intersection': None,
-            'segment_length': 0,
-            'bearing': 0
-        }
+        return _fallback_segment(snapped_lat, snapped_lon)
         
     except Exception as e:
         log.error(f"Error obteniendo segment_id: {e}")
         # Fallback básico
-        segment_string = f"{snapped_lat:.4f},{snapped_lon:.4f}"
-        segment_id = hashlib.md5(segment_string.encode()).hexdigest()[:12]
-        return {
-            'segment_id': segment_id,
-            'street_name': 'Unknown',
-            'start_intersection': None,
-            'end_intersection': None,
-            'segment_length': 0,
-            'bearing': 0
-        }
+        return _fallback_segment(snapped_lat, snapped_lon)
+
+
+def _register(result):
+    """Asigna al resultado de un ajuste el id estable del registro de segmentos."""
+    snapped_lat, snapped_lon, segment_info = result
+    if segment_info is not None:
+        get_segment_registry().resolve(segment_info, snapped_lat, snapped_lon)
+    return result
+
+
+async def _register_async(result):
+    """
+    _register para el event loop: el id se resuelve en memoria y solo si hay
+    que escribir en la BD (arista nueva, geometría por ampliar) se hace en
+    el pool de threads, para no detener los demás paquetes en curso.
+    """
+    snapped_lat, snapped_lon, segment_info = result
+    if segment_info is None:
+        return result
+    if get_segment_registry().resolve(segment_info, snapped_lat, snapped_lon, use_db=False) is None:
+        await asyncio.get_running_loop().run_in_executor(None, _register, result)
+    return result
+
+
+def _snap_local(lat, lon):
+    """
+    Ajuste con el motor local (SNAP_ENGINE=local). Retorna el resultado, o
+    None si hay que seguir con OSRM (motor inactivo, o sin calle cercana y
+    con LOCAL_SNAP_FALLBACK). Una fracción de los ajustes se compara contra
+    OSRM (LOCAL_SNAP_VALIDATE_RATE).
+    """
+    engine = get_local_snap_engine()
+    if engine is None:
+        return None
+    result = engine.snap(lat, lon)
+    if result is None:
+        return None if LOCAL_SNAP_FALLBACK else (lat, lon, None)
+    if LOCAL_SNAP_VALIDATE_RATE and random.random() < LOCAL_SNAP_VALIDATE_RATE and not osrm_known_down():
+        osrm_segment = _snap_to_road_osrm(lat, lon)[2]
+        if osrm_segment is not None:
+            agreed = osrm_segment['segment_id'] == result[2]['segment_id']
+            engine.record_validation(agreed)
+            if not agreed:
+                log.info(f"🧭 Snap local difiere de OSRM en ({lat:.6f}, {lon:.6f}): "
+                         f"{result[2]['street_name']} vs {osrm_segment['street_name']}")
+    return result
 
 
 def snap_to_road(lat, lon):
     """
     Ajusta coordenadas GPS a la calle más cercana y retorna información del segmento.
+    Con SNAP_ENGINE=local se ajusta en el proceso y OSRM queda como respaldo.
+    Un fix en la misma celda que uno reciente reutiliza el resultado sin consultar OSRM.
+    Si el monitor de salud sabe que OSRM está caído retorna el punto sin ajustar al instante.
     Retorna: (lat, lon, segment_info)
     """
+    local = _snap_local(lat, lon)
+    if local is not None:
+        return _register(local)
+    
+    key = _snap_cache_key(lat, lon)
+    cached = _snap_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    if osrm_known_down():
+        return lat, lon, None
+    
+    result = _snap_to_road_osrm(lat, lon)
+    if result[2] is not None:
+        _snap_cache.put(key, _register(result))
+    return result
+
+
+def _snap_to_road_osrm(lat, lon):
+    """
+    snap_to_road sin caché. Normalmente una sola llamada (/nearest trae nodos
+    y nombre); /route solo para una arista nueva o si /nearest no trae nodos.
+    """
     try:
-        url = f"{OSRM_HOST}/nearest/v1/driving/{lon},{lat}"
-        response = requests.get(url, params={'number': 1}, timeout=2)
+        response = get_osrm_client().get('nearest', f"/nearest/v1/driving/{lon},{lat}", params={'number': 1})
         
         if response.status_code == 200:
             data = response.json()
-            if data.get('code') == 'Ok' and len(data.get('waypoints', [])) > 0:
-                snapped_location = data['waypoints'][0]['location']
-                snapped_lon = snapped_location[0]
-                snapped_lat = snapped_location[1]
-                distance = data['waypoints'][0].get('distance', 0)
+            snapped = _snapped_from_nearest(data)
+            if snapped:
+                snapped_lat, snapped_lon, distance = snapped
                 
-                # Obtener información del segmento de calle
-                segment_info = get_street_segment_id(lat, lon, snapped_lat, snapped_lon)
+                # Información del segmento de calle desde el mismo waypoint
+                from_nearest = _segment_from_nearest(data)
+                if from_nearest:
+                    node_pair, segment_info = from_nearest
+                    edge = _edge_cache.get(node_pair)
+                    if edge is None:
+                        edge = _get_edge(snapped_lat, snapped_lon, node_pair)
+                        if edge:
+                            _edge_cache.put(node_pair, edge)
+                    if edge:
+                        _apply_edge(segment_info, edge)
+                else:
+                    segment_info = get_street_segment_id(lat, lon, snapped_lat, snapped_lon)
                 
                 log.info(f"✓ Snap-to-road: ({lat:.6f}, {lon:.6f}) → ({snapped_lat:.6f}, {snapped_lon:.6f})")
                 log.info(f"  Segmento: {segment_info['street_name']} | ID: {segment_info['segment_id']} | Ajuste: {distance:.2f}m")
@@ -133,6 +686,8 @@ def snap_to_road(lat, lon):
             log.warning(f"⚠ OSRM HTTP error {response.status_code}")
             return lat, lon, None
             
+    except OSRMUnavailable:
+        return lat, lon, None
     except requests.exceptions.RequestException as e:
         log.warning(f"⚠ Error de conexión OSRM: {e}")
         return lat, lon, None
@@ -141,16 +696,216 @@ def snap_to_road(lat, lon):
         return lat, lon, None
 
 
-def check_osrm_available():
-    """Verifica si OSRM está disponible."""
+def _get_edge(lat, lon, node_pair):
+    """
+    Rumbo, longitud y geometría de una arista nueva con la ruta de sondeo
+    que cruza el punto ajustado. Si la ruta no pasa por la arista, /route
+    con el punto duplicado (rumbo y longitud, sin geometría).
+    """
     try:
-        response = requests.get(f"{OSRM_HOST}/nearest/v1/driving/-74.8,11.0", timeout=2)
+        path, params = _probe_request(lat, lon)
+        response = get_osrm_client().get('route', path, params=params)
         if response.status_code == 200:
-            log.info("✅ OSRM disponible")
-            return True
+            edge = _edge_from_probe(response.json(), node_pair)
+            if edge:
+                return edge
+        response = get_osrm_client().get('route', f"/route/v1/driving/{lon},{lat};{lon},{lat}",
+                                         params={'steps': 'true', 'annotations': 'true'})
+        if response.status_code == 200:
+            return _edge_from_route(response.json())
+    except OSRMUnavailable:
+        pass
+    except Exception as e:
+        log.error(f"Error obteniendo rumbo del segmento: {e}")
+    return None
+
+
+async def snap_to_road_async(session, lat, lon):
+    """
+    Versión asyncio de snap_to_road para el servidor UDP asíncrono.
+    `session` es un aiohttp.ClientSession compartido (keep-alive) que ya
+    define el timeout de cada llamada. Comparte la caché con snap_to_road.
+    Retorna: (lat, lon, segment_info)
+    """
+    engine = get_local_snap_engine()
+    if engine is not None:
+        # Microsegundos: no vale la pena salir del event loop (sin validación contra OSRM)
+        result = engine.snap(lat, lon)
+        if result is not None:
+            return await _register_async(result)
+        if not LOCAL_SNAP_FALLBACK:
+            return lat, lon, None
+    
+    key = _snap_cache_key(lat, lon)
+    cached = _snap_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    if osrm_known_down():
+        return lat, lon, None
+    
+    result = await _snap_to_road_osrm_async(session, lat, lon)
+    if result[2] is not None:
+        _snap_cache.put(key, await _register_async(result))
+    return result
+
+
+async def _snap_to_road_osrm_async(session, lat, lon):
+    """snap_to_road_async sin caché (mismas llamadas que _snap_to_road_osrm)."""
+    try:
+        status, data = await _get_async(session, 'nearest', f"/nearest/v1/driving/{lon},{lat}", {'number': 1})
+        if status != 200:
+            log.warning(f"⚠ OSRM HTTP error {status}")
+            return lat, lon, None
+        snapped = _snapped_from_nearest(data)
+
+        if not snapped:
+            log.warning(f"⚠ OSRM: No encontró calle cercana para ({lat:.6f}, {lon:.6f})")
+            return lat, lon, None
+        snapped_lat, snapped_lon, distance = snapped
+
+        from_nearest = _segment_from_nearest(data)
+        if from_nearest:
+            node_pair, segment_info = from_nearest
+            edge = _edge_cache.get(node_pair)
         else:
-            log.warning("⚠️ OSRM responde pero con error")
-            return False
-    except requests.exceptions.RequestException:
-        log.warning("⚠️ OSRM no disponible - snap-to-roads desactivado")
-        return False
\ No newline at end of file
+            node_pair, segment_info, edge = None, None, None
+
+        if edge is None and node_pair is not None:
+            try:
+                path, params = _probe_request(snapped_lat, snapped_lon)
+                status, probe_data = await _get_async(session, 'route', path, params)
+                if status == 200:
+                    edge = _edge_from_probe(probe_data, node_pair)
+                    if edge:
+                        _edge_cache.put(node_pair, edge)
+            except OSRMUnavailable:
+                pass
+            except Exception as e:
+                log.error(f"Error obteniendo geometría del segmento: {e}")
+
+        if edge is None:
+            route_data = None
+            try:
+                params = {'steps': 'true', 'annotations': 'true'}
+                _, route_data = await _get_async(session, 'route', f"/route/v1/driving/{lon},{lat};{lon},{lat}", params)
+            except OSRMUnavailable:
+                pass
+            except Exception as e:
+                log.error(f"Error obteniendo segment_id: {e}")
+            if route_data is not None:
+                if segment_info is None:
+                    segment_info = _segment_from_route(route_data)
+                else:
+                    edge = _edge_from_route(route_data)
+                    if edge:
+                        _edge_cache.put(node_pair, edge)
+
+        if edge:
+            _apply_edge(segment_info, edge)
+        if not segment_info:
+            log.warning(f"⚠ Usando fallback para segment_id en ({lat}, {lon})")
+            segment_info = _fallback_segment(snapped_lat, snapped_lon)
+
+        log.info(f"✓ Snap-to-road: ({lat:.6f}, {lon:.6f}) → ({snapped_lat:.6f}, {snapped_lon:.6f})")
+        log.info(f"  Segmento: {segment_info['street_name']} | ID: {segment_info['segment_id']} | Ajuste: {distance:.2f}m")
+        return snapped_lat, snapped_lon, segment_info
+
+    except OSRMUnavailable:
+        return lat, lon, None
+    except Exception as e:
+        log.warning(f"⚠ Error de conexión OSRM: {e}")
+        return lat, lon, None
+
+
+def _segment_from_nodes(nodes, street_name):
+    """segment_info para una arista (par de nodos OSM), con rumbo de la caché si se conoce."""
+    node_pair = f"{min(nodes)}-{max(nodes)}"
+    segment = {
+        'segment_id': hashlib.md5(node_pair.encode()).hexdigest()[:12],
+        'street_name': street_name or 'Unknown',
+        'start_intersection': None,
+        'end_intersection': None,
+        'segment_length': 0,
+        'bearing': 0,
+        'nodes': list(nodes)
+    }
+    edge = _edge_cache.get(node_pair)
+    if edge:
+        _apply_edge(segment, edge)
+    return segment
+
+
+def match_trajectory(fixes):
+    """
+    Ajusta una trayectoria (fixes de un mismo usuario) con una sola llamada a /match.
+    Retorna una lista alineada con `fixes` con (lat, lon, segment_info) o None
+    para los puntos que OSRM no pudo ajustar (o sin timestamp válido, que no se
+    pueden ubicar en la trayectoria), o None si /match falló.
+    """
+    if len(fixes) < 2 or osrm_known_down():
+        return None
+    # /match exige los puntos en orden cronológico: los fixes sin hora válida se dejan fuera
+    stamps = {i: coordinate_ts(fix['timestamp']) for i, fix in enumerate(fixes)}
+    order = sorted((i for i, ts in stamps.items() if ts is not None), key=lambda i: (stamps[i], i))
+    if len(order) < 2:
+        return None
+    coordinates = ';'.join(f"{fixes[i]['lon']},{fixes[i]['lat']}" for i in order)
+    params = {
+        'overview': 'full', 'geometries': 'geojson', 'annotations': 'nodes', 'gaps': 'ignore',
+        'timestamps': ';'.join(str(int(stamps[i].timestamp())) for i in order)
+    }
+
+    try:
+        response = get_osrm_client().get('match', f"/match/v1/driving/{coordinates}", params=params,
+                                         timeout=OSRM_TIMEOUT * 2)
+        if response.status_code != 200:
+            log.warning(f"⚠ OSRM /match HTTP error {response.status_code}")
+            return None
+        data = response.json()
+    except OSRMUnavailable:
+        return None
+    except Exception as e:
+        log.warning(f"⚠ Error de conexión OSRM /match: {e}")
+        return None
+
+    if data.get('code') != 'Ok':
+        log.warning(f"⚠ OSRM /match: {data.get('code')} para {len(fixes)} puntos")
+        return None
+
+    matchings = data.get('matchings', [])
+    tracepoints = data.get('tracepoints', [])
+    # Geometría de las aristas recorridas, para las que aún no están en caché
+    for index, matching in enumerate(matchings):
+        waypoints = sorted((tp['waypoint_index'], tp['location']) for tp in tracepoints
+                           if tp and tp['matchings_index'] == index)
+        for node_pair, geometry in _edge_geometries(matching, [location for _, location in waypoints]).items():
+            if _edge_cache.get(node_pair) is None:
+                _edge_cache.put(node_pair, _edge_from_geometry(*geometry))
+
+    results = [None] * len(fixes)
+    for position, tracepoint in zip(order, tracepoints):
+        if not tracepoint:
+            continue
+        snapped_lon, snapped_lat = tracepoint['location'][0], tracepoint['location'][1]
+        legs = matchings[tracepoint['matchings_index']].get('legs', [])
+        waypoint = tracepoint['waypoint_index']
+        # La arista del punto: inicio del tramo que sale de él (o final del que llega, si es el último)
+        nodes = []
+        if waypoint < len(legs):
+            nodes = legs[waypoint].get('annotation', {}).get('nodes', [])[:2]
+        elif waypoint > 0 and waypoint - 1 < len(legs):
+            nodes = legs[waypoint - 1].get('annotation', {}).get('nodes', [])[-2:]
+        if len(nodes) < 2:
+            continue
+        segment_info = _segment_from_nodes(nodes, tracepoint.get('name'))
+        results[position] = _register((snapped_lat, snapped_lon, segment_info))
+
+    matched = sum(1 for r in results if r)
+    log.info(f"✓ Map-matching: {matched}/{len(fixes)} puntos de {fixes[0].get('user_id')} en una llamada")
+    return results
+
+
+def check_osrm_available():
+    """Verifica si OSRM está disponible (estado en caché del monitor de salud)."""
+    return get_osrm_monitor().is_available()
@@ -0,0 +1,266 @@
+# app/services_positions.py
+import math
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from app.config import POSITION_TTL_SECONDS, POSITION_TOMBSTONES
+from app.database import coordinate_ts, get_latest_positions, get_last_coordinate_by_user
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def position_to_device(position):
+    """Formato de /coordenadas/all (y del stream de posiciones) para una posición."""
+    return {
+        'id': position['id'],
+        'lat': float(position['lat']),
+        'lon': float(position['lon']),
+        'timestamp': position['timestamp'],
+        'source': position['source'] or f"user_{position['user_id']}",
+        'user_id': position['user_id'],
+        'device_id': f"user_{position['user_id']}"
+    }
+
+
+class PositionRegistry:
+    """
+    Última posición conocida de cada usuario, en memoria.
+
+    La alimenta el buffer de ingesta después de cada lote escrito (attach),
+    así que solo está "en vivo" en el proceso que hace la ingesta. En el
+    primer uso se carga desde la BD lo que llegó antes del arranque. Un
+    usuario sin datos por más de `ttl_seconds` (según la hora del fix) deja
+    de estar activo. Si el registro no está en vivo, los métodos de consulta
+    van a la BD.
+
+    Cada cambio (posición nueva o usuario que pasa a inactivo) recibe un
+    número de secuencia; con él changes() retorna solo lo ocurrido desde el
+    cursor de un cliente. Las bajas se recuerdan (las últimas
+    `tombstones`); un cursor más viejo que eso, o de otro arranque del
+    proceso, recibe la foto completa.
+    """
+
+    def __init__(self, ttl_seconds=POSITION_TTL_SECONDS, tombstones=POSITION_TOMBSTONES):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self._lock = threading.Lock()
+        self._positions = {}      # user_id → posición (con 'seq' del último cambio)
+        self._epoch = f"{time.time_ns():x}"  # distingue cursores de otro arranque
+        self._seq = 0
+        self._tombstones = deque(maxlen=tombstones)  # (seq, user_id) de usuarios que pasaron a inactivos
+        self._tombstone_floor = 0  # cursores anteriores a esto ya no tienen sus bajas
+        self._live_pid = None
+        self._warmed = False
+        self._stats = {'updates': 0, 'hits': 0, 'misses': 0, 'db_fallbacks': 0, 'expired': 0}
+
+    def attach(self, buffer):
+        """Se suscribe a los lotes escritos por el buffer de ingesta de este proceso."""
+        buffer.add_flush_listener(self.update_many)
+        self._live_pid = os.getpid()
+
+    def is_live(self):
+        return self._live_pid == os.getpid()
+
+    def update_many(self, rows, ids):
+        """Actualiza con un lote recién escrito; un fix atrasado no pisa uno más nuevo."""
+        with self._lock:
+            for row, row_id in zip(rows, ids):
+                user_id = row.get('user_id')
+                ts = row.get('ts') or coordinate_ts(row['timestamp'])
+                if not user_id or ts is None:
+                    continue
+                current = self._positions.get(user_id)
+                if current is not None and current['ts'] > ts:
+                    continue
+                self._seq += 1
+                self._positions[user_id] = {
+                    'id': row_id,
+                    'lat': row['lat'],
+                    'lon': row['lon'],
+                    'timestamp': row['timestamp'],
+                    'source': row['source'],
+                    'user_id': user_id,
+                    'ts': ts,
+                    'seq': self._seq
+                }
+                self._stats['updates'] += 1
+
+    def _warm(self):
+        """Carga desde la BD las posiciones recientes (una vez, al primer uso)."""
+        if self._warmed:
+            return
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        try:
+            positions = get_latest_positions(int(self.ttl.total_seconds()))
+        except Exception as e:
+            log.error(f"❌ Error cargando posiciones recientes desde BD: {e}")
+            return
+        with self._lock:
+            for position in positions:
+                current = self._positions.get(position['user_id'])
+                if current is None or current['ts'] < position['ts']:
+                    self._seq += 1
+                    self._positions[position['user_id']] = dict(position, seq=self._seq)
+        log.info(f"📍 Registro de posiciones cargado desde BD ({len(positions)} usuarios)")
+
+    def _purge(self):
+        """Elimina los usuarios inactivos (llamar con el lock tomado)."""
+        cutoff = datetime.now(timezone.utc) - self.ttl
+        expired = [user_id for user_id, p in self._positions.items() if p['ts'] < cutoff]
+        for user_id in expired:
+            del self._positions[user_id]
+            self._seq += 1
+            if len(self._tombstones) == self._tombstones.maxlen:
+                self._tombstone_floor = self._tombstones[0][0]
+            self._tombstones.append((self._seq, user_id))
+        self._stats['expired'] += len(expired)
+
+    def active(self):
+        """Última posición de cada usuario activo, ordenada por user_id."""
+        if not self.is_live():
+            with self._lock:
+                self._stats['db_fallbacks'] += 1
+            return get_latest_positions(int(self.ttl.total_seconds()))
+        self._warm()
+        with self._lock:
+            self._purge()
+            return [dict(self._positions[user_id]) for user_id in sorted(self._positions)]
+
+    def etag(self):
+        """
+        Versión actual de las posiciones activas, sin construir la respuesta
+        (None si el registro no está en vivo: la calcula changes() desde la BD).
+        """
+        if not self.is_live():
+            return None
+        self._warm()
+        with self._lock:
+            self._purge()
+            return f"r{self._epoch}.{self._seq}"
+
+    def changes(self, cursor=None):
+        """
+        Cambios desde `cursor` (el de una respuesta anterior): posiciones
+        nuevas y user_ids que pasaron a inactivos. Sin cursor, o si no es
+        válido, `full` es True y `devices` trae todas las posiciones activas.
+        Retorna {cursor, etag, full, devices, removed}.
+        """
+        if not self.is_live():
+            return self._changes_from_db(cursor)
+        self._warm()
+        with self._lock:
+            self._purge()
+            token = f"r{self._epoch}.{self._seq}"
+            since = None
+            if cursor and cursor.startswith(f"r{self._epoch}."):
+                try:
+                    since = int(cursor.rsplit('.', 1)[1])
+                except ValueError:
+                    pass
+            if since is not None and not (self._tombstone_floor <= since <= self._seq):
+                since = None
+
+            if since is None:
+                devices = [dict(self._positions[user_id]) for user_id in sorted(self._positions)]
+                removed = []
+            else:
+                devices = [dict(self._positions[user_id]) for user_id in sorted(self._positions)
+                           if self._positions[user_id]['seq'] > since]
+                removed = sorted({user_id for seq, user_id in self._tombstones
+                                  if seq > since and user_id not in self._positions})
+        return {'cursor': token, 'etag': token, 'full': since is None, 'devices': devices, 'removed': removed}
+
+    def _changes_from_db(self, cursor):
+        """
+        changes() sin el registro en vivo. El cursor lleva el mayor id visto y
+        la hora en que se emitió (t0): una sola consulta trae la última
+        posición de quienes tuvieron datos desde t0 - ttl; las que siguen en
+        la ventana y tienen id nuevo son cambios, las demás estaban activas
+        en t0 y ya no (bajas). La etag se calcula del resultado.
+        """
+        with self._lock:
+            self._stats['db_fallbacks'] += 1
+        now = time.time()
+        ttl_s = self.ttl.total_seconds()
+        max_id = t0 = None
+        if cursor and cursor.startswith('d'):
+            try:
+                max_id, t0 = (int(part) for part in cursor[1:].split('.'))
+            except ValueError:
+                pass
+        # Un cursor muy viejo pediría una ventana enorme: foto completa
+        if t0 is None or not (0 <= now - t0 <= 10 * ttl_s):
+            max_id = t0 = None
+
+        window = ttl_s if t0 is None else ttl_s + (now - t0)
+        positions = get_latest_positions(math.ceil(window))
+        cutoff = datetime.now(timezone.utc) - self.ttl
+        active = [p for p in positions if p['ts'] >= cutoff]
+        if t0 is None:
+            devices, removed = active, []
+        else:
+            devices = [p for p in active if p['id'] > max_id]
+            removed = sorted(p['user_id'] for p in positions if p['ts'] < cutoff)
+
+        seen = max((p['id'] for p in positions), default=0)
+        return {
+            'cursor': f"d{max(seen, max_id or 0)}.{int(now)}",
+            'etag': f"d{max((p['id'] for p in active), default=0)}-{len(active)}",
+            'full': t0 is None,
+            'devices': devices,
+            'removed': removed
+        }
+
+    def get(self, user_id):
+        """
+        Última posición de un usuario, en el formato de get_last_coordinate_by_user.
+        Si no está activo en memoria se consulta la BD (última posición histórica).
+        """
+        user_id = str(user_id)
+        if self.is_live():
+            self._warm()
+            with self._lock:
+                position = self._positions.get(user_id)
+                if position is not None and position['ts'] >= datetime.now(timezone.utc) - self.ttl:
+                    self._stats['hits'] += 1
+                    return {
+                        'success': True,
+                        'lat': float(position['lat']),
+                        'lon': float(position['lon']),
+                        'timestamp': position['timestamp'],
+                        'source': position['source'],
+                        'user_id': user_id
+                    }
+                self._stats['misses'] += 1
+        else:
+            with self._lock:
+                self._stats['db_fallbacks'] += 1
+        return get_last_coordinate_by_user(user_id)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['users'] = len(self._positions)
+            s['seq'] = self._seq
+        s['live'] = self.is_live()
+        s['ttl_seconds'] = int(self.ttl.total_seconds())
+        return s
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_position_registry():
+    """Retorna el registro de posiciones global."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = PositionRegistry()
+    return _registry
@@ -0,0 +1,306 @@
+# app/services_segments.py
+import math
+import threading
+import time
+from app.config import SEGMENT_MIN_GROWTH_M, SEGMENT_REGISTRY_RETRY_S
+from app.database import (
+    load_segment_registry, get_registered_segments, register_segment, update_segment_geometry,
+    get_cached_segments, cache_segments, get_segments_from_history
+)
+import logging
+
+log = logging.getLogger(__name__)
+
+_METERS_PER_DEGREE = 111320.0
+
+
+def _distance_m(a, b):
+    """Distancia aproximada en metros entre dos puntos (lat, lon) cercanos."""
+    dx = (b[1] - a[1]) * _METERS_PER_DEGREE * math.cos(math.radians((a[0] + b[0]) / 2))
+    dy = (b[0] - a[0]) * _METERS_PER_DEGREE
+    return math.hypot(dx, dy)
+
+
+def is_registry_id(segment_id):
+    """True si es un id entero del registro (los md5 anteriores tienen 12 caracteres)."""
+    segment_id = str(segment_id)
+    return segment_id.isdigit() and len(segment_id) < 12
+
+
+class SegmentRegistry:
+    """
+    Identidad estable de los segmentos: cada arista de OSRM (la llave es el
+    segment_id md5 del par de nodos) recibe un id entero al verla por primera
+    vez, persistido en segment_registry, junto con la calle, el rumbo y su
+    geometría. La geometría es la de la arista según OSRM (o el motor local)
+    cuando segment_info la trae; si no, empieza en el primer punto ajustado
+    y se amplía con los puntos que caen más allá de los extremos.
+
+    Todo el registro vive en memoria (se carga de la BD en el primer uso),
+    así resolver un segmento es un acceso a diccionario. Si la BD no está
+    disponible (o mientras se carga) los segmentos conservan el id md5 y se
+    reintenta más tarde.
+    """
+
+    def __init__(self, min_growth_m=SEGMENT_MIN_GROWTH_M, retry_s=SEGMENT_REGISTRY_RETRY_S):
+        self.min_growth = min_growth_m
+        self.retry_s = retry_s
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._by_legacy = {}
+        self._by_id = {}
+        self._loaded = False
+        self._retry_at = 0.0
+        self._stats = {'registered': 0, 'resolved': 0, 'geometry_updates': 0, 'db_lookups': 0, 'errors': 0}
+
+    def _add(self, entry):
+        with self._lock:
+            self._by_legacy[entry['legacy_id']] = entry
+            self._by_id[entry['id']] = entry
+        return entry
+
+    def _error(self, action, e):
+        """Registra un error de BD y pausa el registro `retry_s` segundos."""
+        with self._lock:
+            self._stats['errors'] += 1
+            self._retry_at = time.monotonic() + self.retry_s
+        log.error(f"❌ Registro de segmentos: error {action}: {e}")
+
+    def _ready(self):
+        """
+        Carga el registro desde la BD la primera vez. False si la BD no está
+        disponible o si otro thread lo está cargando: la lectura se hace sin
+        el lock, así resolve/get_many de los demás no esperan detrás de ella.
+        """
+        if self._loaded:
+            return True
+        if time.monotonic() < self._retry_at or not self._load_lock.acquire(blocking=False):
+            return False
+        try:
+            if self._loaded:
+                return True
+            try:
+                entries = load_segment_registry()
+            except Exception as e:
+                self._error("cargando el registro", e)
+                return False
+            by_legacy = {entry['legacy_id']: entry for entry in entries}
+            by_id = {entry['id']: entry for entry in entries}
+            with self._lock:
+                # Conservar las agregadas mientras se cargaba (pueden ser más nuevas)
+                by_legacy.update(self._by_legacy)
+                by_id.update(self._by_id)
+                self._by_legacy, self._by_id = by_legacy, by_id
+                self._loaded = True
+        finally:
+            self._load_lock.release()
+        log.info(f"🧩 Registro de segmentos cargado ({len(entries)} segmentos)")
+        return True
+
+    def resolve(self, segment_info, lat, lon, use_db=True):
+        """
+        Reemplaza el segment_id md5 de segment_info por el id entero del
+        registro (registrando la arista si es nueva) y amplía su geometría
+        con el punto ajustado (lat, lon). Retorna segment_info.
+
+        Con use_db=False no toca la BD (para el event loop asyncio): si hace
+        falta (registro sin cargar, arista nueva o geometría por ampliar)
+        retorna None sin modificar segment_info, y hay que repetir la
+        llamada con use_db=True fuera del loop.
+        """
+        legacy_id = segment_info['segment_id']
+        if is_registry_id(legacy_id):
+            return segment_info
+        geometry = segment_info.get('geometry')
+        if not use_db:
+            entry = self._by_legacy.get(legacy_id) if self._loaded else None
+            if entry is None or self._growth(entry, (lat, lon), geometry) is not None:
+                return None
+            with self._lock:
+                self._stats['resolved'] += 1
+            segment_info['segment_id'] = str(entry['id'])
+            return segment_info
+        if not self._ready():
+            return segment_info
+
+        entry = self._by_legacy.get(legacy_id)
+        if entry is None:
+            nodes = segment_info.get('nodes') or []
+            node_pair = (min(nodes[:2]), max(nodes[:2])) if len(nodes) >= 2 else None
+            start, end = geometry if geometry else ((lat, lon), (lat, lon))
+            try:
+                entry = self._add(register_segment(
+                    legacy_id, node_pair, segment_info.get('street_name'),
+                    segment_info.get('segment_length'), segment_info.get('bearing'),
+                    start, end, _distance_m(start, end)
+                ))
+            except Exception as e:
+                self._error(f"registrando {legacy_id}", e)
+                return segment_info
+            with self._lock:
+                self._stats['registered'] += 1
+            log.info(f"🧩 Segmento {entry['id']} registrado: {entry['street_name']} ({legacy_id})")
+        else:
+            self._extend(entry, (lat, lon), geometry)
+
+        with self._lock:
+            self._stats['resolved'] += 1
+        segment_info['segment_id'] = str(entry['id'])
+        return segment_info
+
+    def _growth(self, entry, point, geometry=None):
+        """
+        Nueva geometría (inicio, fin, extensión), o None si no cambia: la de
+        la arista si es más larga que la guardada (registrada antes sin
+        ella), o si no la ampliada hasta el punto si cae más allá de un extremo.
+        """
+        start, end, extent = entry['start'], entry['end'], entry['extent_m']
+        if geometry:
+            length = _distance_m(*geometry)
+            if length >= extent + self.min_growth:
+                return geometry[0], geometry[1], length
+        from_start, from_end = _distance_m(start, point), _distance_m(end, point)
+        if from_start >= from_end and from_start >= extent + self.min_growth:
+            return start, point, from_start
+        if from_end > from_start and from_end >= extent + self.min_growth:
+            return point, end, from_end
+        return None
+
+    def _extend(self, entry, point, geometry=None):
+        """Amplía la geometría si el punto cae más allá de uno de los extremos (o la reemplaza por la de la arista)."""
+        with self._lock:
+            growth = self._growth(entry, point, geometry)
+            if growth is None:
+                return
+            start, end, extent = growth
+            entry['start'], entry['end'], entry['extent_m'] = start, end, extent
+            entry['segment_length'] = max(entry['segment_length'], extent)
+            self._stats['geometry_updates'] += 1
+        try:
+            update_segment_geometry(entry['id'], start, end, extent)
+        except Exception as e:
+            self._error(f"actualizando geometría del segmento {entry['id']}", e)
+
+    def get(self, segment_id):
+        """Segmento por id entero o por su md5 anterior, o None si no existe."""
+        return self.get_many([segment_id]).get(str(segment_id))
+
+    def get_many(self, segment_ids, lookup_db=True):
+        """
+        Segmentos por id entero o md5 anterior: desde memoria, y los que
+        falten (registrados por otro proceso) con una sola búsqueda por
+        índice si `lookup_db`. Retorna {id pedido: segmento} solo con los encontrados.
+        """
+        segment_ids = [str(segment_id) for segment_id in segment_ids]
+        found, missing = {}, []
+        ready = self._ready()
+        for segment_id in segment_ids:
+            by_id = is_registry_id(segment_id)
+            entry = None
+            if ready:
+                entry = self._by_id.get(int(segment_id)) if by_id else self._by_legacy.get(segment_id)
+            if entry is not None:
+                found[segment_id] = entry
+            else:
+                missing.append(segment_id)
+        if not missing or not lookup_db:
+            return found
+
+        with self._lock:
+            self._stats['db_lookups'] += 1
+        ids = [int(segment_id) for segment_id in missing if is_registry_id(segment_id)]
+        legacy_ids = [segment_id for segment_id in missing if not is_registry_id(segment_id)]
+        missing = set(missing)
+        for entry in get_registered_segments(ids, legacy_ids):
+            self._add(entry)
+            for key in (str(entry['id']), entry['legacy_id']):
+                if key in missing:
+                    found[key] = entry
+        return found
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['segments'] = len(self._by_id)
+        s['loaded'] = self._loaded
+        return s
+
+
+def segment_to_dict(entry):
+    """Formato de /api/segment/<id> para un segmento del registro."""
+    start_lat, start_lon = entry['start']
+    end_lat, end_lon = entry['end']
+    return {
+        'segment_id': str(entry['id']),
+        'legacy_id': entry['legacy_id'],
+        'street_name': entry['street_name'],
+        'segment_length': round(entry['segment_length'], 1),
+        'bearing': entry['bearing'],
+        'nodes': [
+            {'lat': float(start_lat), 'lon': float(start_lon)},
+            {'lat': float(end_lat), 'lon': float(end_lon)}
+        ],
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': [[float(start_lon), float(start_lat)], [float(end_lon), float(end_lat)]]
+        },
+        'osm_nodes': list(entry['node_pair']) if entry['node_pair'] else None,
+        'source': 'registry'
+    }
+
+
+def resolve_segments(segment_ids):
+    """
+    Geometría de varios segmentos con pocas consultas, sin importar cuántos sean:
+    1. Registro de segmentos en memoria
+    2. Solo ids md5 anteriores: segments_cache (capa en memoria, luego una consulta con ANY)
+    3. Registro de segmentos en BD, para los que registró otro proceso (una consulta con ANY)
+    4. Solo ids md5 anteriores: históricos GPS (una consulta con ANY),
+       guardando lo reconstruido en segments_cache en una sola sentencia
+    Retorna {segment_id: segmento} solo con los encontrados.
+    """
+    segment_ids = list(dict.fromkeys(str(segment_id) for segment_id in segment_ids))
+    registry = get_segment_registry()
+    found = {segment_id: segment_to_dict(entry)
+             for segment_id, entry in registry.get_many(segment_ids, lookup_db=False).items()}
+
+    legacy = [segment_id for segment_id in segment_ids
+              if segment_id not in found and not is_registry_id(segment_id)]
+    if legacy:
+        found.update(get_cached_segments(legacy))
+
+    missing = [segment_id for segment_id in segment_ids if segment_id not in found]
+    if missing:
+        found.update({segment_id: segment_to_dict(entry)
+                      for segment_id, entry in registry.get_many(missing).items()})
+
+    missing = [segment_id for segment_id in missing
+               if segment_id not in found and not is_registry_id(segment_id)]
+    if missing:
+        rebuilt = get_segments_from_history(missing)
+        if rebuilt:
+            cache_segments(list(rebuilt.values()))
+            log.info(f"✅ {len(rebuilt)} segmentos reconstruidos desde GPS")
+        found.update(rebuilt)
+    return found
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_segment_registry():
+    """Retorna el registro de segmentos global."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = SegmentRegistry()
+    return _registry
+
+
+def get_segment_registry_stats():
+    """Estadísticas del registro de segmentos (vacío si aún no se usó)."""
+    if _registry is None:
+        return {}
+    return _registry.stats()
@@ -0,0 +1,507 @@
+# app/services_stream.py
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from app.config import (
+    POSITION_TTL_SECONDS, STREAM_REPLAY_SIZE, STREAM_CLIENT_QUEUE, STREAM_POLL_S,
+    STREAM_GRID_DEG, STREAM_EMPRESA_REFRESH_S
+)
+from app.database import get_latest_positions, get_user_empresas
+from app.services_positions import get_position_registry, position_to_device
+import logging
+
+log = logging.getLogger(__name__)
+
+# Un viewport que cubre más celdas que esto se revisa con cada posición (sin índice)
+MAX_SUBSCRIPTION_CELLS = 2500
+
+
+def format_event(event_id, event, data):
+    """Mensaje SSE (text/event-stream) con id, tipo y datos en JSON."""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def parse_bbox(value):
+    """'sur,oeste,norte,este' → (sur, oeste, norte, este). ValueError si no es válido."""
+    south, west, north, east = (float(part) for part in value.split(','))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError(f"bbox inválido: {value}")
+    return south, west, north, east
+
+
+class Subscription:
+    """
+    Cola de mensajes de un cliente del stream, con sus filtros (usuario,
+    empresa y viewport). Si acumula más de `max_pending` mensajes sin leer
+    (cliente lento o conexión atascada) se marca como descartada: el stream
+    la saca y el cliente reconecta con Last-Event-ID.
+    """
+
+    def __init__(self, max_pending, user_id=None, empresa=None, bbox=None):
+        self.max_pending = max_pending
+        self.user_id = str(user_id) if user_id else None
+        self.empresa = empresa or None
+        self.bbox = bbox
+        self.cells = None         # celdas del índice que cubre el viewport (None = sin índice)
+        self.visible = set()      # user_ids enviados que siguen dentro de los filtros
+        self.dropped = False
+        self._messages = deque()
+        self._cond = threading.Condition()
+
+    def matches(self, device):
+        if self.user_id is not None and str(device['user_id']) != self.user_id:
+            return False
+        if self.empresa is not None and device.get('empresa') != self.empresa:
+            return False
+        if self.bbox is not None:
+            south, west, north, east = self.bbox
+            return south <= device['lat'] <= north and west <= device['lon'] <= east
+        return True
+
+    def offer(self, message):
+        """Encola un mensaje (id, evento, datos). False si el cliente quedó descartado."""
+        with self._cond:
+            if self.dropped:
+                return False
+            if len(self._messages) >= self.max_pending:
+                self.dropped = True
+                self._messages.clear()
+                self._cond.notify()
+                return False
+            self._messages.append(message)
+            self._cond.notify()
+            return True
+
+    def next(self, timeout):
+        """
+        Espera hasta `timeout` segundos y retorna todos los mensajes pendientes
+        (lista vacía si no llegó nada, para enviar un latido). None si fue descartada.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._messages or self.dropped, timeout)
+            if self.dropped:
+                return None
+            messages = list(self._messages)
+            self._messages.clear()
+            return messages
+
+
+class PositionStream:
+    """
+    Difusión de posiciones en vivo a todos los clientes conectados (SSE).
+
+    Cada lote que escribe el buffer de ingesta se publica una sola vez como
+    un evento con id creciente (`{epoch}.{seq}`, como los cursores de
+    PositionRegistry: un id de otro arranque o de otro worker no se
+    confunde con uno de este) y se reparte a las colas de los suscriptores
+    sin volver a la BD, así el número de dashboards no multiplica la carga.
+    Los últimos `replay_size` eventos se guardan para que un cliente que
+    reconecta con Last-Event-ID reciba solo lo que se perdió; si ya no
+    están, recibe una foto de las posiciones activas.
+
+    La última posición de cada usuario vive en una cuadrícula de celdas de
+    `grid_deg` grados, y cada suscripción con viewport se registra en las
+    celdas que cubre: una posición solo se revisa contra los suscriptores
+    de su celda (y de la anterior, si cambió). Un vehículo que sale del
+    viewport, deja de cumplir el filtro o expira, llega como evento `leave`.
+
+    Si la ingesta corre en otro proceso (workers UDP), un único thread
+    consulta las últimas posiciones cada `poll_s` segundos mientras haya
+    clientes y publica solo las que cambiaron.
+    """
+
+    def __init__(self, replay_size=STREAM_REPLAY_SIZE, client_queue=STREAM_CLIENT_QUEUE,
+                 poll_s=STREAM_POLL_S, grid_deg=STREAM_GRID_DEG):
+        self.client_queue = client_queue
+        self.poll_s = poll_s
+        self.grid_deg = grid_deg
+        self._lock = threading.Lock()
+        self._epoch = f"{time.time_ns():x}"
+        self._seq = 0
+        self._history = deque(maxlen=replay_size)  # (seq, dispositivos, user_ids expirados)
+        self._subscribers = set()
+        self._global_subscribers = set()  # sin viewport, o con uno demasiado grande
+        self._cell_subscribers = {}       # celda → suscripciones cuyo viewport la toca
+        self._positions = {}              # user_id → (dispositivo, celda, visto en monotonic)
+        self._grid = {}                   # celda → user_ids
+        self._purged_at = time.monotonic()
+        self._empresas = {}
+        self._empresas_at = None
+        self._last_ids = {}               # user_id → id de la última posición publicada por el poller
+        self._warmed = False
+        self._live_pid = None
+        self._poller = None
+        self._stats = {'events': 0, 'positions': 0, 'messages': 0, 'subscribed': 0, 'dropped': 0,
+                       'replays': 0, 'snapshots': 0, 'polls': 0}
+
+    def attach(self, buffer):
+        """Se suscribe a los lotes escritos por el buffer de ingesta de este proceso."""
+        buffer.add_flush_listener(self.publish_rows)
+        self._live_pid = os.getpid()
+
+    def is_live(self):
+        return self._live_pid == os.getpid()
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.grid_deg), math.floor(lon / self.grid_deg)
+
+    def _bbox_cells(self, bbox):
+        """Celdas que cubre un viewport, o None si son demasiadas para indexarlo."""
+        south, west, north, east = bbox
+        (row0, col0), (row1, col1) = self._cell(south, west), self._cell(north, east)
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_SUBSCRIPTION_CELLS:
+            return None
+        return [(row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+    def _empresa_map(self):
+        """
+        user_id → empresa, recargado de usuarios_web cada STREAM_EMPRESA_REFRESH_S.
+        Solo desde el lado de los clientes SSE (subscribe, tick): publish()
+        corre en el thread de escritura y usa el mapa ya cargado.
+        """
+        now = time.monotonic()
+        if self._empresas_at is None or now - self._empresas_at >= STREAM_EMPRESA_REFRESH_S:
+            self._empresas_at = now
+            try:
+                self._empresas = get_user_empresas()
+            except Exception as e:
+                log.error(f"❌ Stream de posiciones: error cargando empresas de usuarios: {e}")
+        return self._empresas
+
+    def _index(self, device, now):
+        """Guarda la última posición en la cuadrícula. Retorna (celda, celda anterior) (con el lock)."""
+        user_id = str(device['user_id'])
+        previous = self._positions.get(user_id)
+        cell = self._cell(device['lat'], device['lon'])
+        old_cell = previous[1] if previous else None
+        if old_cell != cell:
+            if old_cell is not None:
+                self._unindex(user_id, old_cell)
+            self._grid.setdefault(cell, set()).add(user_id)
+        self._positions[user_id] = (device, cell, now)
+        return cell, old_cell
+
+    def _unindex(self, user_id, cell):
+        users = self._grid.get(cell)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._grid[cell]
+
+    @staticmethod
+    def _route(subscription, device, routed):
+        """Decide si la posición le llega a la suscripción o si sale de su vista (con el lock)."""
+        user_id = str(device['user_id'])
+        if subscription.matches(device):
+            subscription.visible.add(user_id)
+            routed.setdefault(subscription, ([], []))[0].append(device)
+        elif user_id in subscription.visible:
+            subscription.visible.discard(user_id)
+            routed.setdefault(subscription, ([], []))[1].append(user_id)
+
+    def publish_rows(self, rows, ids):
+        """Publica un lote recién escrito (solo filas con user_id)."""
+        devices = [
+            position_to_device({
+                'id': row_id, 'lat': row['lat'], 'lon': row['lon'], 'timestamp': row['timestamp'],
+                'source': row['source'], 'user_id': row['user_id']
+            })
+            for row, row_id in zip(rows, ids) if row.get('user_id')
+        ]
+        if devices:
+            self.publish(devices)
+
+    def publish(self, devices):
+        """
+        Crea un evento con los dispositivos y entrega a cada suscriptor lo que
+        le corresponde. Sin suscriptores solo actualiza el índice y el
+        historial (para la foto y el replay de quien se conecte después).
+        """
+        empresas = self._empresas
+        for device in devices:
+            device['empresa'] = empresas.get(str(device['user_id']))
+
+        routed = {}
+        now = time.monotonic()
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._stats['events'] += 1
+            self._stats['positions'] += len(devices)
+            if not self._subscribers:
+                for device in devices:
+                    self._index(device, now)
+                self._history.append((seq, devices, self._purge(now)))
+                return
+            for device in devices:
+                cell, old_cell = self._index(device, now)
+                candidates = self._global_subscribers | self._cell_subscribers.get(cell, set())
+                if old_cell is not None and old_cell != cell:
+                    candidates |= self._cell_subscribers.get(old_cell, set())
+                for subscription in candidates:
+                    self._route(subscription, device, routed)
+            removed = self._expire(now, routed)
+            self._history.append((seq, devices, removed))
+        self._deliver(seq, routed)
+
+    def _event_id(self, seq):
+        return f"{self._epoch}.{seq}"
+
+    def _parse_event_id(self, value):
+        """Secuencia de un Last-Event-ID de este stream, o None (otro arranque o inválido)."""
+        if not value or not str(value).startswith(f"{self._epoch}."):
+            return None
+        try:
+            return int(str(value).rsplit('.', 1)[1])
+        except ValueError:
+            return None
+
+    def _deliver(self, seq, routed):
+        """Entrega a cada suscriptor sus posiciones y `leave` del evento (sin el lock)."""
+        event_id = self._event_id(seq)
+        for subscription, (visible, left) in routed.items():
+            messages = []
+            if visible:
+                messages.append((event_id, 'positions', visible))
+            if left:
+                messages.append((event_id, 'leave', left))
+            for message in messages:
+                if not subscription.offer(message):
+                    self._drop(subscription)
+                    break
+            else:
+                with self._lock:
+                    self._stats['messages'] += len(messages)
+
+    def tick(self):
+        """
+        Tareas periódicas desde el lado de los clientes SSE (cada vuelta del
+        generador): refresca el mapa de empresas y expira posiciones.
+        """
+        self._empresa_map()
+        self.expire()
+
+    def expire(self):
+        """
+        Expira las posiciones viejas aunque no lleguen fixes nuevos (ingesta
+        detenida, de noche...): lo llaman tick() y subscribe(). Las bajas van
+        en un evento propio, también para replay.
+        """
+        routed = {}
+        with self._lock:
+            removed = self._expire(time.monotonic(), routed)
+            if not removed:
+                return
+            self._seq += 1
+            seq = self._seq
+            self._history.append((seq, [], removed))
+        self._deliver(seq, routed)
+
+    def _expire(self, now, routed):
+        """Purga el índice y agrega a `routed` el `leave` de quien veía a los expirados (con el lock)."""
+        removed = self._purge(now)
+        if removed:
+            for subscription in self._subscribers:
+                left = [user_id for user_id in removed if user_id in subscription.visible]
+                if left:
+                    subscription.visible.difference_update(left)
+                    routed.setdefault(subscription, ([], []))[1].extend(left)
+        return removed
+
+    def _purge(self, now):
+        """
+        Saca del índice a los usuarios sin posiciones en POSITION_TTL_SECONDS
+        (con el lock). Retorna sus user_ids, para enviarles `leave`.
+        """
+        if now - self._purged_at < 5:
+            return []
+        self._purged_at = now
+        cutoff = now - POSITION_TTL_SECONDS
+        removed = [user_id for user_id, (_, _, seen) in self._positions.items() if seen < cutoff]
+        for user_id in removed:
+            _, cell, _ = self._positions.pop(user_id)
+            self._unindex(user_id, cell)
+        return removed
+
+    def _warm(self):
+        """Carga las posiciones activas en el índice (una vez, al primer cliente)."""
+        if self._warmed:
+            return
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        try:
+            positions = get_position_registry().active()
+        except Exception as e:
+            log.error(f"❌ Stream de posiciones: error cargando posiciones activas: {e}")
+            return
+        empresas = self._empresa_map()
+        now = time.monotonic()
+        with self._lock:
+            for position in positions:
+                device = position_to_device(position)
+                device['empresa'] = empresas.get(str(device['user_id']))
+                if str(device['user_id']) not in self._positions:
+                    self._index(device, now)
+                    self._last_ids[device['user_id']] = device['id']
+        log.info(f"📡 Stream de posiciones: {len(positions)} posiciones activas indexadas")
+
+    def _drop(self, subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._remove(subscription)
+                self._stats['dropped'] += 1
+                log.warning(f"⚠️ Stream: cliente descartado por lento ({subscription.max_pending} mensajes sin leer)")
+
+    def _remove(self, subscription):
+        """Saca la suscripción de los índices (con el lock)."""
+        self._subscribers.discard(subscription)
+        self._global_subscribers.discard(subscription)
+        for cell in subscription.cells or ():
+            subscribers = self._cell_subscribers.get(cell)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._cell_subscribers[cell]
+
+    def _update_empresa(self, device):
+        """Empresa según el mapa actual: la del publish puede venir de un mapa sin cargar o viejo."""
+        device['empresa'] = self._empresas.get(str(device['user_id']), device.get('empresa'))
+
+    def _visible_now(self, subscription):
+        """Posiciones del índice que cumplen los filtros de la suscripción (con el lock)."""
+        if subscription.empresa is not None:
+            for device, _, _ in self._positions.values():
+                self._update_empresa(device)
+        if subscription.cells is None:
+            candidates = (entry[0] for entry in self._positions.values())
+        else:
+            candidates = (self._positions[user_id][0]
+                          for cell in subscription.cells for user_id in self._grid.get(cell, ()))
+        return [device for device in candidates if subscription.matches(device)]
+
+    def subscribe(self, last_event_id=None, user_id=None, empresa=None, bbox=None):
+        """
+        Registra un cliente con sus filtros. Retorna (suscripción, mensajes
+        iniciales): los eventos perdidos desde `last_event_id` (el header
+        Last-Event-ID tal cual) si es de este stream y siguen en el
+        historial, o si no una foto (`snapshot`) de las posiciones activas
+        que cumplen los filtros, tomada del índice.
+
+        Al reanudar, el cliente puede tener en pantalla cualquier vehículo
+        que hoy está en su vista o que aparece en los eventos perdidos: se
+        parte de ese conjunto para que los que quedaron fuera reciban `leave`.
+        """
+        if not self.is_live():
+            self._ensure_poller()
+        self._warm()
+        self.tick()
+        last_seq = self._parse_event_id(last_event_id)
+        subscription = Subscription(self.client_queue, user_id=user_id, empresa=empresa, bbox=bbox)
+        if bbox is not None:
+            subscription.cells = self._bbox_cells(bbox)
+
+        with self._lock:
+            self._subscribers.add(subscription)
+            if subscription.cells is None:
+                self._global_subscribers.add(subscription)
+            else:
+                for cell in subscription.cells:
+                    self._cell_subscribers.setdefault(cell, set()).add(subscription)
+            self._stats['subscribed'] += 1
+
+            backlog = None
+            if last_seq is not None and last_seq <= self._seq:
+                oldest = self._history[0][0] if self._history else self._seq + 1
+                if last_seq >= oldest - 1:
+                    backlog = [event for event in self._history if event[0] > last_seq]
+
+            if backlog is not None:
+                self._stats['replays'] += 1
+                subscription.visible = {str(device['user_id']) for device in self._visible_now(subscription)}
+                for _, devices, removed in backlog:
+                    subscription.visible.update(str(device['user_id']) for device in devices)
+                    subscription.visible.update(removed)
+                messages = []
+                for seq, devices, removed in backlog:
+                    routed = {}
+                    for device in devices:
+                        if subscription.empresa is not None:
+                            self._update_empresa(device)
+                        self._route(subscription, device, routed)
+                    visible, left = routed.get(subscription, ([], []))
+                    left = left + [user_id for user_id in removed if user_id in subscription.visible]
+                    subscription.visible.difference_update(left)
+                    if visible:
+                        messages.append((self._event_id(seq), 'positions', visible))
+                    if left:
+                        messages.append((self._event_id(seq), 'leave', left))
+                return subscription, messages
+
+            self._stats['snapshots'] += 1
+            snapshot = self._visible_now(subscription)
+            subscription.visible = {str(device['user_id']) for device in snapshot}
+            return subscription, [(self._event_id(self._seq), 'snapshot', snapshot)]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._remove(subscription)
+
+    def _ensure_poller(self):
+        if self._poller is not None and self._poller.is_alive():
+            return
+        with self._lock:
+            if self._poller is not None and self._poller.is_alive():
+                return
+            self._poller = threading.Thread(target=self._poll_loop, name='position-stream-poller', daemon=True)
+            self._poller.start()
+        log.info(f"📡 Stream de posiciones: ingesta en otro proceso, consultando la BD cada {self.poll_s}s")
+
+    def _poll_loop(self):
+        """Una consulta compartida por todos los clientes; publica las posiciones nuevas."""
+        while not self.is_live():
+            with self._lock:
+                idle = not self._subscribers
+            if not idle:
+                try:
+                    positions = get_latest_positions(POSITION_TTL_SECONDS)
+                    with self._lock:
+                        self._stats['polls'] += 1
+                    changed = [p for p in positions if self._last_ids.get(p['user_id']) != p['id']]
+                    self._last_ids = {p['user_id']: p['id'] for p in positions}
+                    if changed:
+                        self.publish([position_to_device(p) for p in changed])
+                except Exception as e:
+                    log.error(f"❌ Stream de posiciones: error consultando la BD: {e}")
+            time.sleep(self.poll_s)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['subscribers'] = len(self._subscribers)
+            s['viewport_subscribers'] = len(self._subscribers) - len(self._global_subscribers)
+            s['indexed_users'] = len(self._positions)
+            s['indexed_cells'] = len(self._grid)
+            s['last_event_id'] = self._event_id(self._seq)
+            s['replay_events'] = len(self._history)
+        s['live'] = self.is_live()
+        s['grid_deg'] = self.grid_deg
+        return s
+
+
+_stream = None
+_stream_lock = threading.Lock()
+
+
+def get_position_stream():
+    """Retorna el stream de posiciones global."""
+    global _stream
+    if _stream is None:
+        with _stream_lock:
+            if _stream is None:
+                _stream = PositionStream()
+    return _stream
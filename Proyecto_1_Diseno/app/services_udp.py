@@ -1,9 +1,13 @@
 # app/services_udp.py
 import socket
 import re
-from app.config import UDP_IP, UDP_PORT
-from app.database import insert_coordinate
-from app.services_osrm import snap_to_road, check_osrm_available
+import struct
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from app.config import UDP_IP, UDP_PORT, DEVICE_UTC_OFFSET_HOURS
+from app.services_ingest import get_snap_pool, get_receive_metrics
+from app.services_osrm import check_osrm_available
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +21,38 @@ def set_flask_app(app):
     global app_instance
     app_instance = app
 
+# Fixes por paquete (texto y binario); el lote binario usa un contador de 8 bits
+MAX_FIXES_PER_PACKET = 255
+
+# Formato canónico completo en un solo patrón (camino rápido)
+_MESSAGE_RE = re.compile(
+    r'Lat:\s*([-\d.]+)\s*,\s*Lon:\s*([-\d.]+)\s*,\s*Time:\s*([\d/: ]+),\s*UserID:\s*(\d+)'
+)
+# Campos por separado, en cualquier orden (camino lento para variantes del formato)
+_LAT_RE = re.compile(r'Lat:\s*([-\d.]+)')
+_LON_RE = re.compile(r'Lon:\s*([-\d.]+)')
+_TIME_RE = re.compile(r'Time:\s*([\d/: ]+)')
+_USERID_RE = re.compile(r'UserID:\s*(\d+)')
+
+@lru_cache(maxsize=4096)
+def _parse_timestamp(timestamp_str):
+    """
+    Convierte 'DD/MM/YYYY HH:MM:SS' a datetime, o None si no es válido.
+    Cacheado: en cada segundo todos los dispositivos envían el mismo timestamp.
+    """
+    try:
+        t = timestamp_str
+        # int() acepta espacios ('01/02/ 025'): los campos deben ser solo dígitos
+        if (len(t) == 19 and t[2] == '/' and t[5] == '/' and t[10] == ' '
+                and t[13] == ':' and t[16] == ':'
+                and (t[0:2] + t[3:5] + t[6:10] + t[11:13] + t[14:16] + t[17:19]).isdigit()):
+            return datetime(int(t[6:10]), int(t[3:5]), int(t[0:2]),
+                            int(t[11:13]), int(t[14:16]), int(t[17:19]))
+        # Variantes sin ceros a la izquierda, etc.
+        return datetime.strptime(t, '%d/%m/%Y %H:%M:%S')
+    except ValueError:
+        return None
+
 def parse_udp_message(message):
     """
     Parsea el mensaje UDP en formato:
@@ -25,103 +61,347 @@ def parse_udp_message(message):
     Retorna un diccionario con los valores parseados o None si falla.
     """
     try:
-        # Usar regex para extraer los valores
-        lat_match = re.search(r'Lat:\s*([-\d.]+)', message)
-        lon_match = re.search(r'Lon:\s*([-\d.]+)', message)
-        time_match = re.search(r'Time:\s*([\d/: ]+)', message)  # ← CAMBIO AQUÍ
-        userid_match = re.search(r'UserID:\s*(\d+)', message)
-        
-        if not all([lat_match, lon_match, time_match, userid_match]):
-            log.error(f"❌ Formato de mensaje inválido: {message}")
-            return None
+        match = _MESSAGE_RE.match(message)
+        if match:
+            lat_str, lon_str, timestamp_str, user_id = match.groups()
+        else:
+            lat_match = _LAT_RE.search(message)
+            lon_match = _LON_RE.search(message)
+            time_match = _TIME_RE.search(message)
+            userid_match = _USERID_RE.search(message)
+            
+            if not (lat_match and lon_match and time_match and userid_match):
+                log.error(f"❌ Formato de mensaje inválido: {message}")
+                return None
+            
+            lat_str = lat_match.group(1)
+            lon_str = lon_match.group(1)
+            timestamp_str = time_match.group(1)
+            user_id = userid_match.group(1)
         
-        lat = float(lat_match.group(1))
-        lon = float(lon_match.group(1))
-        timestamp_str = time_match.group(1).strip()  # ← Ya viene en formato DD/MM/YYYY HH:MM:SS
-        user_id = userid_match.group(1)
+        lat = float(lat_str)
+        lon = float(lon_str)
+        timestamp_str = timestamp_str.strip()  # ← Ya viene en formato DD/MM/YYYY HH:MM:SS
         
         # Validar que el formato sea correcto
-        from datetime import datetime
-        try:
-            dt = datetime.strptime(timestamp_str, '%d/%m/%Y %H:%M:%S')
-            timestamp_formatted = timestamp_str  # Ya está en el formato correcto
-        except ValueError as e:
-            log.error(f"❌ Error parseando timestamp '{timestamp_str}': {e}")
+        if _parse_timestamp(timestamp_str) is None:
+            log.error(f"❌ Error parseando timestamp '{timestamp_str}'")
             return None
         
         return {
             'lat': lat,
             'lon': lon,
-            'timestamp': timestamp_formatted,
+            'timestamp': timestamp_str,
             'user_id': user_id
         }
     except Exception as e:
         log.error(f"❌ Error parseando mensaje: {e}")
         return None
 
+def parse_udp_batch(message):
+    """
+    Parsea un paquete de texto con varios fixes de un mismo usuario, uno por línea:
+
+        UserID: 1044214787
+        Lat: 11.0235867, Lon: -74.8075142, Time: 05/11/2025 15:40:31
+        Lat: 11.0236012, Lon: -74.8074988, Time: 05/11/2025 15:40:32
+
+    La línea de cabecera es opcional si cada línea trae su propio UserID.
+    Un paquete de una sola línea es el mensaje de siempre.
+    Retorna la lista de fixes (en orden) o None si alguna línea es inválida.
+    """
+    lines = [line.strip() for line in message.splitlines()]
+    lines = [line for line in lines if line]
+    if not lines:
+        log.error("❌ Paquete de texto vacío")
+        return None
+    
+    user_id = None
+    header = _USERID_RE.fullmatch(lines[0])
+    if header:
+        user_id = header.group(1)
+        lines = lines[1:]
+    if len(lines) > MAX_FIXES_PER_PACKET:
+        log.error(f"❌ Paquete con {len(lines)} fixes, máximo {MAX_FIXES_PER_PACKET}")
+        return None
+    
+    fixes = []
+    for line in lines:
+        if user_id is not None and 'UserID' not in line:
+            line = f"{line}, UserID: {user_id}"
+        fix = parse_udp_message(line)
+        if fix is None:
+            return None
+        fixes.append(fix)
+    
+    if not fixes:
+        log.error("❌ Paquete sin fixes")
+        return None
+    if any(fix['user_id'] != fixes[0]['user_id'] for fix in fixes):
+        log.error(f"❌ Paquete con fixes de varios usuarios: {message}")
+        return None
+    return fixes
+
+# ===== TRAMA BINARIA =====
+# Formato compacto para enlaces celulares, en orden de red (big-endian):
+#
+#   offset  tamaño  campo
+#   0       1       magic (0xA7, nunca es ASCII: distingue la trama del texto)
+#   1       1       versión (1)
+#   2       1       flags (bit 0: incluye velocidad y rumbo)
+#   3       4       lat, int32 en microgrados
+#   7       4       lon, int32 en microgrados
+#   11      4       hora, uint32 epoch en segundos (UTC)
+#   15      8       user_id, uint64
+#   23      2       velocidad, uint16 en cm/s          (opcional)
+#   25      2       rumbo, uint16 en centésimas de grado (opcional)
+#
+# Versión 2: lote de fixes de un mismo usuario en un solo paquete
+#
+#   0       3       magic, versión (2), flags (como en v1)
+#   3       8       user_id, uint64
+#   11      4       hora base, uint32 epoch en segundos (UTC)
+#   15      1       cantidad de fixes N (1-255)
+#   16      ...     N registros:
+#                     lat int32, lon int32 (microgrados),
+#                     desfase uint16 en segundos desde la hora base,
+#                     [velocidad uint16, rumbo uint16] si flags tiene bit 0
+BINARY_MAGIC = 0xA7
+BINARY_VERSION = 1
+BINARY_BATCH_VERSION = 2
+BINARY_FLAG_MOTION = 0x01
+_BINARY_HEADER = struct.Struct('>BBB')
+_BINARY_FIX = struct.Struct('>iiIQ')
+_BINARY_MOTION = struct.Struct('>HH')
+_BINARY_BATCH_HEADER = struct.Struct('>QIB')
+_BINARY_BATCH_FIX = struct.Struct('>iiH')
+_BINARY_BATCH_FIX_MOTION = struct.Struct('>iiHHH')
+_DEVICE_TZ = timezone(timedelta(hours=DEVICE_UTC_OFFSET_HOURS))
+
+def encode_binary_frame(lat, lon, epoch, user_id, speed=None, heading=None):
+    """
+    Arma una trama binaria v1 (para firmware, simuladores y benchmarks).
+    speed en m/s y heading en grados son opcionales (van juntos).
+    """
+    has_motion = speed is not None and heading is not None
+    frame = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_FLAG_MOTION if has_motion else 0)
+    frame += _BINARY_FIX.pack(round(lat * 1e6), round(lon * 1e6), int(epoch), int(user_id))
+    if has_motion:
+        frame += _BINARY_MOTION.pack(round(speed * 100), round(heading * 100) % 36000)
+    return frame
+
+@lru_cache(maxsize=4096)
+def _format_epoch(epoch):
+    """Epoch UTC → 'DD/MM/YYYY HH:MM:SS' en la hora local de los dispositivos (cacheado)."""
+    return datetime.fromtimestamp(epoch, _DEVICE_TZ).strftime('%d/%m/%Y %H:%M:%S')
+
+def parse_binary_frame(data):
+    """
+    Decodifica una trama binaria. Retorna el mismo diccionario que
+    parse_udp_message (más 'speed' y 'heading' si vienen) o None si falla.
+    """
+    try:
+        if len(data) < _BINARY_HEADER.size + _BINARY_FIX.size:
+            log.error(f"❌ Trama binaria incompleta ({len(data)} bytes)")
+            return None
+        
+        magic, version, flags = _BINARY_HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            log.error(f"❌ Trama binaria no soportada (magic={magic:#x}, versión={version})")
+            return None
+        
+        expected = _BINARY_HEADER.size + _BINARY_FIX.size
+        if flags & BINARY_FLAG_MOTION:
+            expected += _BINARY_MOTION.size
+        if len(data) != expected:
+            log.error(f"❌ Trama binaria de {len(data)} bytes, se esperaban {expected}")
+            return None
+        
+        lat_e6, lon_e6, epoch, user_id = _BINARY_FIX.unpack_from(data, _BINARY_HEADER.size)
+        lat = lat_e6 / 1e6
+        lon = lon_e6 / 1e6
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            log.error(f"❌ Coordenadas fuera de rango en trama binaria: {lat}, {lon}")
+            return None
+        
+        fix = {
+            'lat': lat,
+            'lon': lon,
+            'timestamp': _format_epoch(epoch),
+            'user_id': str(user_id)
+        }
+        if flags & BINARY_FLAG_MOTION:
+            speed_cms, heading_cdeg = _BINARY_MOTION.unpack_from(data, _BINARY_HEADER.size + _BINARY_FIX.size)
+            fix['speed'] = speed_cms / 100
+            fix['heading'] = heading_cdeg / 100
+        return fix
+    except Exception as e:
+        log.error(f"❌ Error decodificando trama binaria: {e}")
+        return None
+
+def encode_binary_batch(user_id, fixes, with_motion=False):
+    """
+    Arma una trama binaria v2 con varios fixes de un usuario.
+    fixes: [(lat, lon, epoch)] o [(lat, lon, epoch, speed, heading)] con with_motion.
+    """
+    if not 1 <= len(fixes) <= MAX_FIXES_PER_PACKET:
+        raise ValueError(f"Un lote lleva entre 1 y {MAX_FIXES_PER_PACKET} fixes")
+    base = min(int(fix[2]) for fix in fixes)
+    frame = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_BATCH_VERSION, BINARY_FLAG_MOTION if with_motion else 0)
+    frame += _BINARY_BATCH_HEADER.pack(int(user_id), base, len(fixes))
+    for fix in fixes:
+        lat_e6, lon_e6, offset = round(fix[0] * 1e6), round(fix[1] * 1e6), int(fix[2]) - base
+        if with_motion:
+            frame += _BINARY_BATCH_FIX_MOTION.pack(lat_e6, lon_e6, offset, round(fix[3] * 100), round(fix[4] * 100) % 36000)
+        else:
+            frame += _BINARY_BATCH_FIX.pack(lat_e6, lon_e6, offset)
+    return frame
+
+def parse_binary_batch(data):
+    """
+    Decodifica una trama binaria v2. Retorna la lista de fixes (mismo
+    diccionario que parse_binary_frame) o None si la trama no es válida.
+    """
+    try:
+        offset = _BINARY_HEADER.size + _BINARY_BATCH_HEADER.size
+        if len(data) < offset:
+            log.error(f"❌ Lote binario incompleto ({len(data)} bytes)")
+            return None
+        
+        _, _, flags = _BINARY_HEADER.unpack_from(data, 0)
+        user_id, base, count = _BINARY_BATCH_HEADER.unpack_from(data, _BINARY_HEADER.size)
+        record = _BINARY_BATCH_FIX_MOTION if flags & BINARY_FLAG_MOTION else _BINARY_BATCH_FIX
+        expected = offset + count * record.size
+        if count == 0 or len(data) != expected:
+            log.error(f"❌ Lote binario de {len(data)} bytes con {count} fixes, se esperaban {expected}")
+            return None
+        
+        user_id = str(user_id)
+        fixes = []
+        for values in record.iter_unpack(memoryview(data)[offset:]):
+            lat = values[0] / 1e6
+            lon = values[1] / 1e6
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                log.error(f"❌ Coordenadas fuera de rango en lote binario: {lat}, {lon}")
+                return None
+            fix = {
+                'lat': lat,
+                'lon': lon,
+                'timestamp': _format_epoch(base + values[2]),
+                'user_id': user_id
+            }
+            if record is _BINARY_BATCH_FIX_MOTION:
+                fix['speed'] = values[3] / 100
+                fix['heading'] = values[4] / 100
+            fixes.append(fix)
+        return fixes
+    except Exception as e:
+        log.error(f"❌ Error decodificando lote binario: {e}")
+        return None
+
+def parse_packet(data):
+    """
+    Decodifica un datagrama en cualquiera de los formatos aceptados
+    (texto de una o varias líneas, trama binaria v1 o lote v2).
+    Retorna la lista de fixes o None si el paquete no es válido.
+    """
+    if data and data[0] == BINARY_MAGIC:
+        if len(data) > 1 and data[1] == BINARY_BATCH_VERSION:
+            return parse_binary_batch(data)
+        fix = parse_binary_frame(data)
+        return [fix] if fix else None
+    
+    message = data.decode('utf-8').strip()
+    if '\n' in message:
+        return parse_udp_batch(message)
+    fix = parse_udp_message(message)
+    return [fix] if fix else None
+
+def receive_fixes(data, addr, received_at, receive_metrics):
+    """
+    Decodifica y parsea un datagrama, detectando el formato (binario o texto).
+    Retorna la lista de fixes del paquete (cada uno con 'source') o None,
+    registrando la latencia o el error en las métricas de recepción.
+    """
+    source_ip = f"{addr[0]}:{addr[1]}"
+    try:
+        fixes = parse_packet(data)
+    except UnicodeDecodeError as e:
+        log.error(f"❌ Error decodificando mensaje desde {source_ip}: {e}")
+        receive_metrics.error()
+        return None
+    
+    if not fixes:
+        log.error(f"❌ No se pudo parsear el paquete de {source_ip} ({len(data)} bytes)")
+        receive_metrics.error()
+        return None
+    
+    for fix in fixes:
+        fix['source'] = source_ip
+    receive_metrics.record(time.monotonic() - received_at)
+    log.info(f"📩 {len(fixes)} fix(es) recibidos desde {source_ip} ({len(data)} bytes)")
+    return fixes
+
+# Tamaño máximo de un datagrama UDP sobre IPv4 (los lotes superan los 4 KB)
+UDP_MAX_DATAGRAM = 65507
+
+def make_udp_socket(reuse_port=False):
+    """
+    Crea el socket UDP de ingesta. Con reuse_port=True varios procesos pueden
+    hacer bind al mismo puerto y el kernel reparte los datagramas (SO_REUSEPORT).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("SO_REUSEPORT no está disponible en este sistema")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((UDP_IP, UDP_PORT))
+    return sock
+
+def serve_udp_socket(sock, should_stop=None):
+    """
+    Etapa de recepción del pipeline de ingesta: lee datagramas, los parsea y
+    entrega cada fix al pool de snap-to-road sin bloquear el socket.
+    Si se pasa should_stop, el socket debe tener timeout para poder revisarlo.
+    """
+    snap_pool = get_snap_pool()
+    receive_metrics = get_receive_metrics()
+    osrm_available = check_osrm_available()
+    log.info(f"🗺️  Snap-to-roads: {'ACTIVO' if osrm_available else 'INACTIVO (OSRM no disponible)'}")
+    
+    while should_stop is None or not should_stop():
+        try:
+            # 1. Recibir paquete UDP
+            data, addr = sock.recvfrom(UDP_MAX_DATAGRAM)
+            received_at = time.monotonic()
+            
+            # 2-3. Decodificar y parsear (uno o varios fixes por paquete)
+            fixes = receive_fixes(data, addr, received_at, receive_metrics)
+            if not fixes:
+                continue
+            
+            last = fixes[-1]
+            log.info(f"✓ Datos parseados: {len(fixes)} fix(es), último Lat={last['lat']}, Lon={last['lon']}, User={last['user_id']}, Time={last['timestamp']}")
+            
+            # 4. Encolar el paquete completo para snap-to-road y escritura en lote (workers aparte)
+            if not snap_pool.submit_batch(fixes):
+                log.warning(f"⚠️ Cola de snap-to-road llena, {len(fixes)} fixes descartados de {last['source']}")
+
+        except socket.timeout:
+            continue
+        except ValueError as e:
+            log.error(f"❌ Error de conversión de datos: {e}")
+        except Exception as e:
+            log.exception(f"❌ Error general en listener UDP: {e}")
+
 def udp_listener():
     while not app_instance:
         log.info("Esperando instancia de Flask en UDP listener...")
-        import time
         time.sleep(1)
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((UDP_IP, UDP_PORT))
+    sock = make_udp_socket()
     log.info(f"🎧 Listening for UDP on {UDP_IP}:{UDP_PORT}")
     
     # ✅ CRÍTICO: Envolver TODO el loop en el contexto de Flask
     with app_instance.app_context():
-        osrm_available = check_osrm_available()
-        log.info(f"🗺️  Snap-to-roads: {'ACTIVO' if osrm_available else 'INACTIVO (OSRM no disponible)'}")
-        
-        while True:
-            try:
-                # 1. Recibir paquete UDP
-                data, addr = sock.recvfrom(4096)
-                source_ip = f"{addr[0]}:{addr[1]}"
-                
-                try:
-                    # 2. Decodificar mensaje
-                    message = data.decode('utf-8').strip()
-                    log.info(f"📩 Mensaje recibido desde {source_ip}: {message}")
-                except UnicodeDecodeError as e:
-                    log.error(f"❌ Error decodificando mensaje desde {source_ip}: {e}")
-                    continue
-                
-                # 3. Parsear mensaje
-                parsed_data = parse_udp_message(message)
-                if not parsed_data:
-                    log.error(f"❌ No se pudo parsear el mensaje: {message}")
-                    continue
-                
-                lat_original = parsed_data['lat']
-                lon_original = parsed_data['lon']
-                timestamp = parsed_data['timestamp']
-                user_id = parsed_data['user_id']
-                
-                log.info(f"✓ Datos parseados: Lat={lat_original}, Lon={lon_original}, User={user_id}, Time={timestamp}")
-                
-                # 4. Aplicar snap-to-road si OSRM está disponible
-                lat_final, lon_final, segment_info = snap_to_road(lat_original, lon_original)
-                
-                # 5. Guardar en BD con manejo de errores explícito
-                try:
-                    insert_coordinate(
-                        lat=lat_final,
-                        lon=lon_final,
-                        timestamp=timestamp,
-                        source=source_ip,
-                        user_id=user_id,
-                        segment_id=segment_info['segment_id'] if segment_info else None,
-                        street_name=segment_info['street_name'] if segment_info else None,
-                        segment_length=segment_info['segment_length'] if segment_info else None
-                    )
-                    log.info(f"✅ Coordenada guardada: ({lat_final:.6f}, {lon_final:.6f}) | Segmento: {segment_info['segment_id'] if segment_info else 'N/A'}")
-                except Exception as db_error:
-                    log.exception(f"❌ Error guardando en BD: {db_error}")
-                    continue
-
-            except ValueError as e:
-                log.error(f"❌ Error de conversión de datos: {e}")
-            except Exception as e:
-                log.exception(f"❌ Error general en listener UDP: {e}")
\ No newline at end of file
+        serve_udp_socket(sock)
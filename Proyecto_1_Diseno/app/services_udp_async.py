@@ -0,0 +1,178 @@
+# app/services_udp_async.py
+import asyncio
+import atexit
+import threading
+import time
+from app.config import UDP_IP, UDP_PORT, ASYNC_MAX_IN_FLIGHT, ASYNC_OSRM_CONNECTIONS, SNAP_MODE
+from app.services_ingest import (
+    get_coordinate_buffer, get_receive_metrics, coordinate_row, StageMetrics
+)
+from app.services_osrm import snap_to_road, snap_to_road_async, check_osrm_available
+from app import services_udp
+import logging
+
+try:
+    import aiohttp
+except ImportError:  # Opcional: sin aiohttp el snap se hace en el executor por defecto
+    aiohttp = None
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+class UDPIngestProtocol(asyncio.DatagramProtocol):
+    """Protocolo asyncio que entrega cada datagrama al servidor."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        log.warning(f"⚠️ Error en socket UDP: {exc}")
+
+
+class AsyncUDPIngestServer:
+    """
+    Servidor UDP asyncio: parsea cada datagrama en el event loop y lanza una
+    tarea que hace el snap-to-road (aiohttp con keep-alive) y encola la fila
+    en el buffer de escritura en lote. Como máximo `max_in_flight` paquetes se
+    procesan a la vez; los que llegan por encima se descartan y se cuentan.
+    """
+
+    def __init__(self, host=UDP_IP, port=UDP_PORT, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+        self.host = host
+        self.port = port
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        self.snap = StageMetrics()
+        self._buffer = get_coordinate_buffer()
+        self._receive_metrics = get_receive_metrics()
+        self._tasks = set()
+        self._session = None
+        self._loop = None
+        self._stop_event = None
+        self._stopped = threading.Event()
+
+    def handle_datagram(self, data, addr):
+        received_at = time.monotonic()
+        try:
+            fixes = services_udp.receive_fixes(data, addr, received_at, self._receive_metrics)
+        except Exception as e:
+            log.exception(f"❌ Error general en listener UDP: {e}")
+            return
+        if not fixes:
+            return
+
+        if self.in_flight >= self.max_in_flight:
+            self.snap.drop(len(fixes))
+            log.warning(f"⚠️ {self.in_flight} paquetes en proceso, {len(fixes)} fixes descartados de {fixes[0]['source']}")
+            return
+
+        self.in_flight += 1
+        task = self._loop.create_task(self._process(fixes, received_at))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    async def _snap(self, fix):
+        try:
+            if self._session is not None:
+                return await snap_to_road_async(self._session, fix['lat'], fix['lon'])
+            return await self._loop.run_in_executor(None, snap_to_road, fix['lat'], fix['lon'])
+        except Exception as e:
+            log.error(f"❌ Error en snap-to-road para {fix['user_id']}: {e}")
+            self.snap.error()
+            return fix['lat'], fix['lon'], None
+
+    async def _process(self, fixes, received_at):
+        start = time.monotonic()
+        if len(fixes) == 1:
+            results = [await self._snap(fixes[0])]
+        else:
+            results = await asyncio.gather(*(self._snap(fix) for fix in fixes))
+        self.snap.record(time.monotonic() - start)
+
+        rows = [coordinate_row(fix, *result) for fix, result in zip(fixes, results)]
+        # Sin esperar: el límite de paquetes en proceso ya hace de backpressure
+        if not self._buffer.add_many(rows, timeout=0):
+            log.warning(f"⚠️ Buffer de ingesta lleno, {len(rows)} coordenadas descartadas de {fixes[0]['source']}")
+
+    def _task_done(self, task):
+        self.in_flight -= 1
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"❌ Error procesando paquete UDP: {task.exception()}")
+
+    async def serve(self):
+        """Atiende el puerto UDP hasta que se llame stop()."""
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        if aiohttp is not None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ASYNC_OSRM_CONNECTIONS, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=2)
+            )
+        else:
+            log.warning("⚠️ aiohttp no está instalado: snap-to-road se ejecutará en threads del executor")
+
+        transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: UDPIngestProtocol(self),
+            local_addr=(self.host, self.port)
+        )
+        log.info(f"🎧 Listening for UDP (asyncio) on {self.host}:{self.port} | máx. en proceso: {self.max_in_flight}")
+
+        try:
+            await self._stop_event.wait()
+        finally:
+            transport.close()
+            if self._tasks:
+                log.info(f"🛑 Esperando {len(self._tasks)} paquetes en proceso")
+                await asyncio.wait(list(self._tasks), timeout=5)
+            if self._session is not None:
+                await self._session.close()
+            self._stopped.set()
+
+    def stop(self, timeout=10):
+        """Detiene el servidor desde otro thread y espera a que termine lo que está en proceso."""
+        if self._loop is None or self._stopped.is_set():
+            return
+        self._loop.call_soon_threadsafe(self._stop_event.set)
+        self._stopped.wait(timeout)
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'http_client': 'aiohttp' if aiohttp is not None else 'executor',
+            'snap': self.snap.snapshot()
+        }
+
+
+_server = None
+
+
+def async_udp_listener():
+    """Punto de entrada para el thread del servidor asyncio (equivalente a udp_listener)."""
+    global _server
+    while not services_udp.app_instance:
+        log.info("Esperando instancia de Flask en UDP listener...")
+        time.sleep(1)
+
+    with services_udp.app_instance.app_context():
+        _server = AsyncUDPIngestServer()
+        # Registrado después del buffer: atexit (LIFO) detiene el servidor antes de vaciarlo
+        atexit.register(_server.stop)
+        osrm_available = check_osrm_available()
+        log.info(f"🗺️  Snap-to-roads: {'ACTIVO' if osrm_available else 'INACTIVO (OSRM no disponible)'}")
+        if SNAP_MODE == 'match':
+            log.warning("⚠️ SNAP_MODE=match no aplica al modo asyncio: cada fix se ajusta con /nearest")
+        asyncio.run(_server.serve())
+
+
+def get_async_ingest_stats():
+    """Estadísticas del servidor asyncio (vacío si no está activo)."""
+    if _server is None:
+        return {}
+    return _server.stats()
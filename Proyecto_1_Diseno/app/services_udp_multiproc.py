@@ -0,0 +1,158 @@
+# app/services_udp_multiproc.py
+import atexit
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from app.config import UDP_IP, UDP_PORT, UDP_WORKER_STATS_INTERVAL
+from app.database import get_pool_stats
+from app.services_ingest import get_snap_pool, get_coordinate_buffer, get_ingest_stats
+from app.services_osrm import get_snap_cache_stats, get_osrm_stats
+from app.services_localsnap import get_local_snap_stats
+from app import services_udp
+import logging
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def _report_stats(worker_id, stats_queue):
+    """Envía al proceso padre las métricas de este worker."""
+    try:
+        stats_queue.put_nowait({
+            'worker_id': worker_id,
+            'pid': os.getpid(),
+            'updated_at': time.time(),
+            'ingest': get_ingest_stats(),
+            'snap_cache': get_snap_cache_stats(),
+            'local_snap': get_local_snap_stats(),
+            'osrm': get_osrm_stats(),
+            'db_pool': get_pool_stats()
+        })
+    except queue.Full:
+        pass
+
+
+def _worker_main(worker_id, stop_event, stats_queue):
+    """
+    Proceso worker: hace bind al puerto UDP con SO_REUSEPORT y corre el mismo
+    pipeline que el listener en thread (parseo → snap → escritura en lote).
+    """
+    # El padre coordina el apagado: Ctrl+C no debe cortar al worker a mitad de un lote
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    sock = services_udp.make_udp_socket(reuse_port=True)
+    sock.settimeout(0.5)
+    log.info(f"🎧 Worker {worker_id} (pid {os.getpid()}) listening for UDP on {UDP_IP}:{UDP_PORT}")
+
+    def report_loop():
+        while not stop_event.wait(UDP_WORKER_STATS_INTERVAL):
+            _report_stats(worker_id, stats_queue)
+
+    threading.Thread(target=report_loop, name='worker-stats', daemon=True).start()
+
+    with services_udp.app_instance.app_context():
+        try:
+            services_udp.serve_udp_socket(sock, should_stop=stop_event.is_set)
+        finally:
+            sock.close()
+            # Vaciar la cola de snap y luego el buffer antes de salir
+            get_snap_pool().stop()
+            get_coordinate_buffer().stop()
+            _report_stats(worker_id, stats_queue)
+            log.info(f"✓ Worker {worker_id} detenido")
+
+
+class UDPWorkerSupervisor:
+    """
+    Lanza N procesos de ingesta UDP sobre el mismo puerto (SO_REUSEPORT),
+    recoge sus métricas y coordina el apagado: activa un evento compartido,
+    espera a que cada worker vacíe sus colas y termina a los que no respondan.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._ctx = multiprocessing.get_context('fork')
+        self._stop_event = self._ctx.Event()
+        self._stats_queue = self._ctx.Queue(maxsize=self.workers * 16)
+        self._processes = {}
+        self._worker_stats = {}
+        self._lock = threading.Lock()
+        self._collector = None
+
+    def start(self):
+        if self._processes:
+            return
+        for worker_id in range(self.workers):
+            process = self._ctx.Process(
+                target=_worker_main,
+                args=(worker_id, self._stop_event, self._stats_queue),
+                name=f'udp-worker-{worker_id}',
+                daemon=True
+            )
+            process.start()
+            self._processes[worker_id] = process
+
+        self._collector = threading.Thread(target=self._collect, name='udp-worker-stats', daemon=True)
+        self._collector.start()
+        atexit.register(self.stop)
+        log.info(f"🎧 {self.workers} workers UDP con SO_REUSEPORT en {UDP_IP}:{UDP_PORT}")
+
+    def _collect(self):
+        while True:
+            try:
+                snapshot = self._stats_queue.get(timeout=1)
+            except queue.Empty:
+                if self._stop_event.is_set() and not any(p.is_alive() for p in self._processes.values()):
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                self._worker_stats[snapshot['worker_id']] = snapshot
+
+    def stop(self, timeout=15):
+        """Apagado coordinado: todos los workers vacían sus colas antes de salir."""
+        if not self._processes or self._stop_event.is_set():
+            return
+        log.info(f"🛑 Deteniendo {len(self._processes)} workers UDP")
+        self._stop_event.set()
+
+        deadline = time.monotonic() + timeout
+        for worker_id, process in self._processes.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.warning(f"⚠️ Worker {worker_id} (pid {process.pid}) no terminó a tiempo, forzando cierre")
+                process.terminate()
+                process.join(1)
+
+    def stats(self):
+        with self._lock:
+            snapshots = dict(self._worker_stats)
+        workers = {}
+        for worker_id, process in self._processes.items():
+            worker = {'pid': process.pid, 'alive': process.is_alive(), 'exitcode': process.exitcode}
+            worker.update(snapshots.get(worker_id, {}))
+            workers[str(worker_id)] = worker
+        return workers
+
+
+_supervisor = None
+
+
+def start_udp_workers(workers):
+    """Inicia el modo multiproceso (llamar antes de arrancar Flask)."""
+    global _supervisor
+    _supervisor = UDPWorkerSupervisor(workers)
+    _supervisor.start()
+    return _supervisor
+
+
+def get_udp_worker_stats():
+    """Métricas por worker del modo multiproceso (vacío si no está activo)."""
+    if _supervisor is None:
+        return {}
+    return _supervisor.stats()
@@ -0,0 +1,103 @@
+# benchmarks/bench_historical_export.py
+"""
+Mide la memoria de exportar históricos: la respuesta en streaming de
+/historico/rango (cursor del lado del servidor) contra traer todo con
+fetchall() y serializarlo de una vez, como se hacía antes.
+
+Inserta filas sintéticas (source='bench') en un rango de fechas de 2001
+que no choca con datos reales, y las borra al terminar. Requiere la BD
+configurada (DB_HOST, DB_NAME, ...).
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.bench_historical_export [--rows 200000]
+"""
+import argparse
+import json
+import logging
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from psycopg2.extras import execute_values
+
+from app import create_app
+from app.database import get_db, device_datetime
+
+START = datetime(2001, 1, 1)
+
+
+def insert_rows(n):
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for offset in range(0, n, 20000):
+            values = []
+            for i in range(offset, min(n, offset + 20000)):
+                local = START + timedelta(seconds=i)
+                values.append((10.9 + (i % 1000) * 1e-4, -74.8, local.strftime('%d/%m/%Y %H:%M:%S'),
+                               'bench', str(i % 50), device_datetime(local).astimezone(timezone.utc)))
+            execute_values(cursor, "INSERT INTO coordinates (lat, lon, timestamp, source, user_id, ts) VALUES %s",
+                           values, page_size=5000)
+        conn.commit()
+
+
+def delete_rows():
+    with get_db() as conn:
+        conn.cursor().execute("DELETE FROM coordinates WHERE source = 'bench'")
+        conn.commit()
+
+
+def materialized(n):
+    """Como antes: fetchall(), lista de dicts y un solo json.dumps."""
+    end = START + timedelta(seconds=n)
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT lat, lon, timestamp, user_id, ts FROM coordinates
+            WHERE ts BETWEEN %s AND %s ORDER BY ts
+        """, (device_datetime(START), device_datetime(end)))
+        rows = cursor.fetchall()
+    body = json.dumps([{'lat': float(r[0]), 'lon': float(r[1]), 'timestamp': r[2], 'user_id': r[3]} for r in rows])
+    return len(body)
+
+
+def streamed(client, n):
+    end = START + timedelta(seconds=n)
+    response = client.get(f"/historico/rango?inicio={START:%Y-%m-%d}&hora_inicio=00:00"
+                          f"&fin={end:%Y-%m-%d}&hora_fin={end:%H:%M}", buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return size
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, elapsed, peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Memoria de la exportación de históricos')
+    arg_parser.add_argument('--rows', type=int, default=200000)
+    args = arg_parser.parse_args()
+
+    logging.disable(logging.INFO)
+    client = create_app().test_client()
+    delete_rows()
+    insert_rows(args.rows)
+    try:
+        for n in (args.rows // 10, args.rows):
+            for label, fn, fn_args in (('fetchall + json', materialized, (n,)),
+                                       ('streaming', streamed, (client, n))):
+                size, elapsed, peak = measure(fn, *fn_args)
+                print(f"{n:8,} filas | {label:16s} | {size / 1e6:7.1f} MB enviados | "
+                      f"pico {peak / 1e6:7.1f} MB | {elapsed:5.2f}s")
+    finally:
+        delete_rows()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# benchmarks/bench_local_snap.py
+"""
+Mide el motor de snap local (services_localsnap) contra snap_to_road vía
+HTTP al stub de OSRM, sobre una cuadrícula sintética de calles en formato
+.osm (cuadras de ~80 m con nodos intermedios, calles en diagonal).
+
+Verifica que el tramo elegido sea el mismo que una búsqueda exhaustiva
+sobre todos los tramos. Si numpy está instalado compara también la
+proyección vectorizada con el bucle en una celda densa.
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.bench_local_snap [--fixes 20000] [--streets 60]
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+
+from app import services_localsnap, services_osrm
+from app.cache import LRUCache
+from benchmarks.osrm_stub import start_stub
+
+LAT0, LON0 = 10.96, -74.82
+BLOCK_DEG = 0.00072  # ~80 m
+
+
+def write_grid_osm(path, streets):
+    """Cuadrícula de `streets` calles por `streets` carreras, con un nodo cada cuarto de cuadra."""
+    steps = streets * 4
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for i in range(steps + 1):
+            for j in range(steps + 1):
+                lat = LAT0 + i * BLOCK_DEG / 4 + j * 1e-6
+                lon = LON0 + j * BLOCK_DEG / 4 + i * 1e-6
+                f.write(f'  <node id="{i * (steps + 1) + j + 1}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n')
+        way_id = 1
+        for i in range(0, steps + 1, 4):
+            for kind, refs in (('Calle', [i * (steps + 1) + j + 1 for j in range(steps + 1)]),
+                               ('Carrera', [j * (steps + 1) + i + 1 for j in range(steps + 1)])):
+                f.write(f'  <way id="{way_id}">\n')
+                f.writelines(f'    <nd ref="{ref}"/>\n' for ref in refs)
+                f.write(f'    <tag k="highway" v="residential"/>\n    <tag k="name" v="{kind} {i // 4}"/>\n  </way>\n')
+                way_id += 1
+        f.write('  <way id="999999"><nd ref="1"/><nd ref="2"/><tag k="highway" v="footway"/></way>\n')
+        f.write('</osm>\n')
+
+
+def build_fixes(n, streets, seed=42):
+    """Fixes sobre las calles con ~8 m de ruido de GPS."""
+    rng = random.Random(seed)
+    span = streets * BLOCK_DEG
+    fixes = []
+    for _ in range(n):
+        k = rng.randint(0, streets) * BLOCK_DEG
+        t = rng.uniform(0, span)
+        lat, lon = (LAT0 + k, LON0 + t) if rng.random() < 0.5 else (LAT0 + t, LON0 + k)
+        fixes.append((lat + rng.gauss(0, 5e-5), lon + rng.gauss(0, 5e-5)))
+    return fixes
+
+
+def brute_force(engine, lat, lon):
+    """Índice del tramo más cercano revisando todos (referencia de exactitud)."""
+    px, py = lon * engine._kx, lat * engine._ky
+    return engine._nearest(px, py, list(range(len(engine._info))))
+
+
+def measure(engine, fixes):
+    start = time.perf_counter()
+    results = [engine.snap(lat, lon) for lat, lon in fixes]
+    return results, (time.perf_counter() - start) / len(fixes) * 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Snap local vs OSRM por HTTP')
+    arg_parser.add_argument('--fixes', type=int, default=20000)
+    arg_parser.add_argument('--streets', type=int, default=60)
+    args = arg_parser.parse_args()
+
+    logging.getLogger('app.services_osrm').setLevel(logging.ERROR)
+    path = os.path.join(tempfile.mkdtemp(), 'grid.osm')
+    write_grid_osm(path, args.streets)
+    fixes = build_fixes(args.fixes, args.streets)
+
+    start = time.perf_counter()
+    engine = services_localsnap.LocalSnapEngine.from_file(path)
+    load_s = time.perf_counter() - start
+    print(f"Extracto: {len(engine._info):,} tramos, carga en {load_s:.2f}s")
+
+    results, local_us = measure(engine, fixes)
+    mismatches = 0
+    for (lat, lon), result in zip(fixes[:2000], results):
+        expected = brute_force(engine, lat, lon)
+        if result is None and expected[1] > engine.max_distance ** 2:
+            continue
+        if result is None or engine._info[expected[0]][0] != result[2]['segment_id']:
+            # Empates exactos (punto equidistante de dos tramos) no cuentan
+            distance = math.hypot((result[1] - lon) * engine._kx, (result[0] - lat) * engine._ky) if result else None
+            if distance is None or abs(distance - math.sqrt(expected[1])) > 1e-6:
+                mismatches += 1
+    misses = sum(1 for r in results if r is None)
+    if mismatches:
+        print(f"❌ {mismatches} fixes con un tramo distinto al de la búsqueda exhaustiva")
+        raise SystemExit(1)
+    print(f"✓ Mismo tramo que la búsqueda exhaustiva (2000 fixes), {misses} sin calle a menos de "
+          f"{engine.max_distance:.0f} m")
+
+    print(f"Local:               {local_us:6.2f} µs/fix | {1e6 / local_us:12,.0f} fixes/s")
+    np = services_localsnap.np
+    if np is not None:
+        # Denso: una celda con muchos tramos (p. ej. un nudo vial), vectorizado vs bucle
+        px, py = fixes[0][1] * engine._kx, fixes[0][0] * engine._ky
+        dense = np.arange(min(256, len(engine._info)), dtype=np.int32)
+        for label, candidates in (('numpy', dense), ('bucle', dense.tolist())):
+            start = time.perf_counter()
+            for _ in range(2000):
+                engine._nearest(px, py, candidates)
+            dense_us = (time.perf_counter() - start) / 2000 * 1e6
+            print(f"Celda de {len(dense)} tramos ({label}): {dense_us:6.2f} µs/fix")
+
+    server, url = start_stub(latency_ms=0)
+    services_osrm.get_osrm_client().base_url = url
+    services_osrm._snap_cache = LRUCache(0)
+    sample = fixes[:2000]
+    start = time.perf_counter()
+    for lat, lon in sample:
+        services_osrm.snap_to_road(lat, lon)
+    osrm_us = (time.perf_counter() - start) / len(sample) * 1e6
+    server.shutdown()
+    print(f"OSRM HTTP (stub):    {osrm_us:6.0f} µs/fix | {1e6 / osrm_us:12,.0f} fixes/s")
+
+
+if __name__ == '__main__':
+    main()
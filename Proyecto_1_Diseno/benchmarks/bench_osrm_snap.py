@@ -0,0 +1,67 @@
+# benchmarks/bench_osrm_snap.py
+"""
+Cuenta las llamadas a OSRM por fix de snap_to_road contra el stub local.
+
+Escenarios (caché por celda desactivada, para medir solo las llamadas):
+  - nearest con nodos: una llamada por fix, más un /route por arista nueva
+  - nearest sin nodos: el comportamiento anterior, /nearest + /route por fix
+
+También verifica que ambos caminos den el mismo segment_id y nombre de calle.
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.bench_osrm_snap [--fixes 2000] [--latency-ms 1]
+"""
+import argparse
+import logging
+import random
+import time
+
+from app import services_osrm
+from app.cache import LRUCache
+from benchmarks.osrm_stub import start_stub
+
+
+def build_fixes(n, seed=42):
+    """Vehículos recorriendo ~200 aristas, con ruido de GPS."""
+    rng = random.Random(seed)
+    return [(10.98 + rng.randint(0, 200) * 1e-4 + rng.uniform(-2e-5, 2e-5),
+             -74.80 + rng.uniform(-0.01, 0.01)) for _ in range(n)]
+
+
+def run(fixes, nodes, latency_ms):
+    server, url = start_stub(latency_ms=latency_ms, nodes=nodes)
+    services_osrm.get_osrm_client().base_url = url
+    services_osrm._snap_cache = LRUCache(0)
+    services_osrm._edge_cache = LRUCache(100000)
+    start = time.perf_counter()
+    results = [services_osrm.snap_to_road(lat, lon) for lat, lon in fixes]
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    return results, sum(server.counts.values()) / len(fixes), len(fixes) / elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Llamadas a OSRM por fix')
+    arg_parser.add_argument('--fixes', type=int, default=2000)
+    arg_parser.add_argument('--latency-ms', type=float, default=1)
+    args = arg_parser.parse_args()
+
+    logging.getLogger('app.services_osrm').setLevel(logging.ERROR)
+    fixes = build_fixes(args.fixes)
+
+    single, single_calls, single_rate = run(fixes, True, args.latency_ms)
+    legacy, legacy_calls, legacy_rate = run(fixes, False, args.latency_ms)
+
+    for a, b in zip(single, legacy):
+        if a[2]['segment_id'] != b[2]['segment_id'] or a[2]['street_name'] != b[2]['street_name']:
+            print(f"❌ Segmentos distintos: {a[2]} / {b[2]}")
+            raise SystemExit(1)
+    print(f"✓ Mismo segment_id y calle en {len(fixes)} fixes")
+
+    print(f"/nearest con nodos: {single_calls:5.2f} llamadas/fix | {single_rate:9,.0f} fixes/s")
+    print(f"/nearest + /route:  {legacy_calls:5.2f} llamadas/fix | {legacy_rate:9,.0f} fixes/s")
+
+
+if __name__ == '__main__':
+    main()
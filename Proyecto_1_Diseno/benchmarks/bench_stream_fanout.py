@@ -0,0 +1,93 @@
+# benchmarks/bench_stream_fanout.py
+"""
+Mide el reparto del stream de posiciones (services_stream) con clientes
+que miran cada uno un barrio (viewport de ~1.5 km) contra clientes que
+reciben todo: costo de publicar un lote y bytes que recibe cada cliente.
+También compara el índice por celdas con revisar el viewport de cada
+suscriptor en cada posición.
+
+No usa la BD: el stream se marca en vivo y sin empresas.
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.bench_stream_fanout [--devices 2000] [--clients 200] [--batches 200]
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from app import services_stream
+
+LAT0, LON0 = 10.92, -74.88
+SPAN = 0.12       # ~13 km, el área urbana
+VIEWPORT = 0.014  # ~1.5 km
+
+
+def make_stream(grid_deg):
+    stream = services_stream.PositionStream(replay_size=10, client_queue=10 ** 9, grid_deg=grid_deg)
+    stream._live_pid = os.getpid()
+    stream._warmed = True
+    stream._empresas_at = float('inf')
+    return stream
+
+
+def device(user_id, lat, lon, row_id):
+    return {'id': row_id, 'lat': lat, 'lon': lon, 'timestamp': '17/10/2026 10:00:00',
+            'source': f'user_{user_id}', 'user_id': str(user_id), 'device_id': f'user_{user_id}'}
+
+
+def run(stream, args, viewports, seed=7):
+    rng = random.Random(seed)
+    positions = {u: (LAT0 + rng.uniform(0, SPAN), LON0 + rng.uniform(0, SPAN)) for u in range(args.devices)}
+    subscriptions = [stream.subscribe(bbox=bbox)[0] for bbox in viewports]
+
+    row_id = 0
+    start = time.perf_counter()
+    for _ in range(args.batches):
+        batch = []
+        for user_id in rng.sample(range(args.devices), args.batch_size):
+            lat, lon = positions[user_id]
+            lat, lon = lat + rng.gauss(0, 2e-4), lon + rng.gauss(0, 2e-4)  # ~20 m por fix
+            positions[user_id] = (lat, lon)
+            row_id += 1
+            batch.append(device(user_id, lat, lon, row_id))
+        stream.publish(batch)
+    publish_ms = (time.perf_counter() - start) / args.batches * 1e3
+
+    sent = 0
+    for subscription in subscriptions:
+        for event_id, event, data in subscription.next(0) or []:
+            sent += len(services_stream.format_event(event_id, event, data))
+    return publish_ms, sent / len(subscriptions)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Reparto del stream por viewport')
+    arg_parser.add_argument('--devices', type=int, default=2000)
+    arg_parser.add_argument('--clients', type=int, default=200)
+    arg_parser.add_argument('--batches', type=int, default=200)
+    arg_parser.add_argument('--batch-size', type=int, default=100)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(3)
+    viewports = []
+    for _ in range(args.clients):
+        south, west = LAT0 + rng.uniform(0, SPAN - VIEWPORT), LON0 + rng.uniform(0, SPAN - VIEWPORT)
+        viewports.append((south, west, south + VIEWPORT, west + VIEWPORT))
+
+    print(f"{args.devices} dispositivos, {args.clients} clientes, {args.batches} lotes de {args.batch_size} posiciones")
+    for label, grid_deg, bboxes in (
+        ('Sin viewport (todo)', 0.01, [None] * args.clients),
+        ('Viewport, sin índice', 1e-6, viewports),  # demasiadas celdas: se revisa cada suscriptor
+        ('Viewport + celdas', 0.01, viewports),
+    ):
+        publish_ms, per_client = run(make_stream(grid_deg), args, bboxes)
+        print(f"{label:22s} publicar: {publish_ms:7.2f} ms/lote | por cliente: {per_client / 1024:9.1f} KB")
+
+    sample = json.dumps(device(1, LAT0, LON0, 1))
+    print(f"(una posición serializada ≈ {len(sample)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
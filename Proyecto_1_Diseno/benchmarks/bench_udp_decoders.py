@@ -0,0 +1,80 @@
+# benchmarks/bench_udp_decoders.py
+"""
+Compara el decodificador de texto contra el de trama binaria.
+
+Ambos corpus describen los mismos fixes; se mide bytes → dict (incluye el
+decode UTF-8 del texto) y se reporta el tamaño medio de cada paquete.
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.bench_udp_decoders [--messages 20000] [--repeat 5]
+"""
+import argparse
+import calendar
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+from app.config import DEVICE_UTC_OFFSET_HOURS
+from app.services_udp import parse_udp_message, parse_binary_frame, encode_binary_frame
+
+
+def build_corpus(n, seed=42):
+    """Los mismos fixes en formato texto y en trama binaria."""
+    rng = random.Random(seed)
+    users = [rng.randint(10**9, 2 * 10**9) for _ in range(300)]
+    start = datetime(2025, 11, 5, 15, 0, 0)
+    texts, frames = [], []
+    for i in range(n):
+        lat = round(10.98 + rng.uniform(-0.05, 0.05), 6)
+        lon = round(-74.80 + rng.uniform(-0.05, 0.05), 6)
+        local = start + timedelta(seconds=i // len(users))
+        epoch = calendar.timegm((local - timedelta(hours=DEVICE_UTC_OFFSET_HOURS)).timetuple())
+        user = rng.choice(users)
+        texts.append(f"Lat: {lat:.7f}, Lon: {lon:.7f}, Time: {local.strftime('%d/%m/%Y %H:%M:%S')}, UserID: {user}".encode())
+        frames.append(encode_binary_frame(lat, lon, epoch, user))
+    return texts, frames
+
+
+def run(decoder, corpus, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for packet in corpus:
+            decoder(packet)
+        best = min(best, time.perf_counter() - start)
+    return len(corpus) / best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark de decodificadores UDP')
+    arg_parser.add_argument('--messages', type=int, default=20000)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    logging.getLogger('app.services_udp').setLevel(logging.CRITICAL)
+
+    texts, frames = build_corpus(args.messages)
+
+    def decode_text(packet):
+        return parse_udp_message(packet.decode('utf-8').strip())
+
+    for text, frame in zip(texts, frames):
+        a, b = decode_text(text), parse_binary_frame(frame)
+        if a is None or b is None or a['timestamp'] != b['timestamp'] or a['user_id'] != b['user_id'] \
+                or abs(a['lat'] - b['lat']) > 1e-6 or abs(a['lon'] - b['lon']) > 1e-6:
+            print(f"❌ Los formatos no coinciden: {text!r} → {a} / {b}")
+            raise SystemExit(1)
+    print(f"✓ Ambos formatos decodifican los mismos {len(texts)} fixes")
+
+    text_rate = run(decode_text, texts, args.repeat)
+    binary_rate = run(parse_binary_frame, frames, args.repeat)
+    text_size = sum(len(t) for t in texts) / len(texts)
+    binary_size = sum(len(f) for f in frames) / len(frames)
+    print(f"Texto:   {text_rate:12,.0f} msg/s | {text_size:5.1f} bytes/paquete")
+    print(f"Binario: {binary_rate:12,.0f} msg/s | {binary_size:5.1f} bytes/paquete")
+    print(f"Mejora:  {binary_rate / text_rate:12.2f}x | {text_size / binary_size:5.1f}x menos bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# benchmarks/bench_udp_parser.py
+"""
+Micro-benchmark del parser de mensajes UDP.
+
+Compara parse_udp_message contra la implementación anterior (cuatro
+re.search + strptime por mensaje) sobre un corpus de mensajes reales y
+malformados, y verifica que ambas produzcan exactamente el mismo resultado.
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.bench_udp_parser [--messages 20000] [--repeat 5]
+"""
+import argparse
+import logging
+import random
+import re
+import time
+from datetime import datetime, timedelta
+
+from app.services_udp import parse_udp_message
+
+
+def legacy_parse_udp_message(message):
+    """Implementación original, copiada tal cual como referencia."""
+    try:
+        lat_match = re.search(r'Lat:\s*([-\d.]+)', message)
+        lon_match = re.search(r'Lon:\s*([-\d.]+)', message)
+        time_match = re.search(r'Time:\s*([\d/: ]+)', message)
+        userid_match = re.search(r'UserID:\s*(\d+)', message)
+
+        if not all([lat_match, lon_match, time_match, userid_match]):
+            return None
+
+        lat = float(lat_match.group(1))
+        lon = float(lon_match.group(1))
+        timestamp_str = time_match.group(1).strip()
+        user_id = userid_match.group(1)
+
+        from datetime import datetime
+        try:
+            datetime.strptime(timestamp_str, '%d/%m/%Y %H:%M:%S')
+        except ValueError:
+            return None
+
+        return {'lat': lat, 'lon': lon, 'timestamp': timestamp_str, 'user_id': user_id}
+    except Exception:
+        return None
+
+
+MALFORMED = [
+    '',
+    'hola',
+    'Lat: 11.0235867, Lon: -74.8075142, Time: 05/11/2025 15:40:31',
+    'Lat: 11.0235867, Time: 05/11/2025 15:40:31, UserID: 1044214787',
+    'Lat: 1.2.3, Lon: -74.8075142, Time: 05/11/2025 15:40:31, UserID: 1044214787',
+    'Lat: 11.0235867, Lon: -74.8075142, Time: 32/13/2025 25:61:61, UserID: 1044214787',
+    'Lat: 11.0235867, Lon: -74.8075142, Time: 2025-11-05 15:40:31, UserID: 1044214787',
+    'Lat: 11.0235867, Lon: -74.8075142, Time: 05/11/2025, UserID: 1044214787',
+    'Lat: -, Lon: -74.8075142, Time: 05/11/2025 15:40:31, UserID: 1044214787',
+    'Lat: 11.0235867, Lon: -74.8075142, Time: 05/11/2025 15:40:31, UserID: abc',
+]
+
+
+def build_corpus(n, malformed_ratio=0.05, seed=42):
+    """Mensajes con el formato de los dispositivos más variantes y mensajes inválidos."""
+    rng = random.Random(seed)
+    users = [str(rng.randint(10**9, 2 * 10**9)) for _ in range(300)]
+    start = datetime(2025, 11, 5, 15, 0, 0)
+    corpus = []
+    for i in range(n):
+        if rng.random() < malformed_ratio:
+            corpus.append(rng.choice(MALFORMED))
+            continue
+        lat = 10.98 + rng.uniform(-0.05, 0.05)
+        lon = -74.80 + rng.uniform(-0.05, 0.05)
+        ts = (start + timedelta(seconds=i // len(users))).strftime('%d/%m/%Y %H:%M:%S')
+        user = rng.choice(users)
+        variant = rng.random()
+        if variant < 0.90:
+            corpus.append(f'Lat: {lat:.7f}, Lon: {lon:.7f}, Time: {ts}, UserID: {user}')
+        elif variant < 0.95:
+            # Orden distinto de los campos
+            corpus.append(f'UserID: {user}, Time: {ts}, Lat: {lat:.7f}, Lon: {lon:.7f}')
+        else:
+            # Sin ceros a la izquierda y espacios extra
+            d = start + timedelta(seconds=i // len(users))
+            corpus.append(f'Lat:{lat:.7f} ,  Lon:  {lon:.7f}, Time: {d.day}/{d.month}/{d.year} {d.hour}:{d.minute}:{d.second}, UserID:{user}')
+    return corpus
+
+
+def run(parser, corpus, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in corpus:
+            parser(message)
+        best = min(best, time.perf_counter() - start)
+    return len(corpus) / best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark del parser UDP')
+    arg_parser.add_argument('--messages', type=int, default=20000)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    # Los mensajes malformados generan logs de error; no medir el logging
+    logging.getLogger('app.services_udp').setLevel(logging.CRITICAL)
+
+    corpus = build_corpus(args.messages)
+
+    mismatches = [m for m in corpus if parse_udp_message(m) != legacy_parse_udp_message(m)]
+    if mismatches:
+        print(f"❌ {len(mismatches)} mensajes con resultado distinto, p. ej.: {mismatches[0]!r}")
+        raise SystemExit(1)
+    print(f"✓ Resultados idénticos en {len(corpus)} mensajes")
+
+    legacy = run(legacy_parse_udp_message, corpus, args.repeat)
+    current = run(parse_udp_message, corpus, args.repeat)
+    print(f"Parser anterior: {legacy:12,.0f} msg/s")
+    print(f"Parser actual:   {current:12,.0f} msg/s")
+    print(f"Mejora:          {current / legacy:12.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# benchmarks/osrm_stub.py
+"""
+Sustituto local de OSRM para desarrollo y benchmarks (sin mapa ni Docker).
+
+Simula una cuadrícula de calles: cada punto se ajusta redondeando a 4
+decimales (~11 m) y la arista se identifica por la latitud ajustada. Responde
+/nearest, /route y /match con la misma forma que OSRM (solo los campos que
+usa la app) y cuenta las llamadas por servicio en /counts.
+
+Uso (desde Proyecto_1_Diseno/):
+    python -m benchmarks.osrm_stub [--port 5001] [--latency-ms 0] [--no-nodes]
+
+    OSRM_HOST=http://localhost:5001 python run.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+
+def _edge(lat, lon):
+    """Punto ajustado y nodos de la arista simulada para (lat, lon)."""
+    snapped_lat, snapped_lon = round(lat, 4), round(lon, 4)
+    node = int(abs(snapped_lat) * 10000)
+    return snapped_lat, snapped_lon, [node, node + 1], f'Calle {node}'
+
+
+class OSRMStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=0, nodes=True):
+        super().__init__(address, _Handler)
+        self.latency = latency_ms / 1000.0
+        self.nodes = nodes
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, service):
+        with self._lock:
+            self.counts[service] = self.counts.get(service, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Cabeceras y cuerpo van en escrituras separadas: sin esto, con keep-alive,
+    # Nagle + delayed ACK agregan ~40 ms a cada respuesta
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        service = path.split('/')[1]
+        if service == 'counts':
+            with server._lock:
+                return self._send(dict(server.counts))
+
+        server.count(service)
+        if server.latency:
+            time.sleep(server.latency)
+        try:
+            coords = [tuple(map(float, c.split(','))) for c in path.split('/')[-1].split(';')]
+        except ValueError:
+            return self._send({'code': 'InvalidQuery'}, 400)
+
+        if service == 'nearest':
+            lon, lat = coords[0]
+            snapped_lat, snapped_lon, nodes, name = _edge(lat, lon)
+            waypoint = {'location': [snapped_lon, snapped_lat], 'distance': 3.2, 'name': name, 'hint': 'stub'}
+            if server.nodes:
+                waypoint['nodes'] = nodes
+            body = {'code': 'Ok', 'waypoints': [waypoint]}
+        elif service == 'route' and len(coords) == 3:
+            # Ruta de sondeo de una arista nueva: A → U → P → V → B, con U y V los nodos de la arista de P
+            (a_lon, a_lat), (lon, lat), (b_lon, b_lat) = coords
+            snapped_lat, snapped_lon, nodes, name = _edge(lat, lon)
+            u, p, v = [snapped_lon - 0.001, snapped_lat], [snapped_lon, snapped_lat], [snapped_lon + 0.001, snapped_lat]
+            body = {
+                'code': 'Ok',
+                'waypoints': [{'location': [a_lon, a_lat]}, {'location': p, 'name': name}, {'location': [b_lon, b_lat]}],
+                'routes': [{
+                    'geometry': {'type': 'LineString', 'coordinates': [[a_lon, a_lat], u, p, v, [b_lon, b_lat]]},
+                    'legs': [{'annotation': {'nodes': [1, nodes[0], nodes[1]]}},
+                             {'annotation': {'nodes': [nodes[0], nodes[1], 2]}}]
+                }]
+            }
+        elif service == 'route':
+            lon, lat = coords[0]
+            snapped_lat, snapped_lon, nodes, name = _edge(lat, lon)
+            body = {
+                'code': 'Ok',
+                'waypoints': [{'location': [snapped_lon, snapped_lat], 'name': name}] * len(coords),
+                'routes': [{
+                    'distance': 0,
+                    'geometry': {'type': 'LineString', 'coordinates': [[snapped_lon, snapped_lat]] * 2},
+                    'legs': [{
+                        'distance': 0,
+                        'annotation': {'nodes': nodes},
+                        'steps': [{'name': name, 'intersections': [{'bearings': [90]}]}]
+                    }]
+                }]
+            }
+        elif service == 'match':
+            tracepoints, legs = [], []
+            for i, (lon, lat) in enumerate(coords):
+                snapped_lat, snapped_lon, nodes, name = _edge(lat, lon)
+                tracepoints.append({
+                    'location': [snapped_lon, snapped_lat], 'name': name, 'distance': 3.2,
+                    'matchings_index': 0, 'waypoint_index': i
+                })
+                if i < len(coords) - 1:
+                    legs.append({'distance': 5, 'annotation': {'nodes': nodes}, 'steps': []})
+            body = {'code': 'Ok', 'tracepoints': tracepoints, 'matchings': [{'confidence': 0.9, 'legs': legs}]}
+        else:
+            return self._send({'code': 'InvalidService'}, 400)
+        self._send(body)
+
+    def _send(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub(port=0, latency_ms=0, nodes=True):
+    """Inicia el stub en un thread. Retorna (servidor, url_base)."""
+    server = OSRMStub(('127.0.0.1', port), latency_ms=latency_ms, nodes=nodes)
+    threading.Thread(target=server.serve_forever, name='osrm-stub', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Sustituto local de OSRM')
+    arg_parser.add_argument('--port', type=int, default=5001)
+    arg_parser.add_argument('--latency-ms', type=float, default=0)
+    arg_parser.add_argument('--no-nodes', action='store_true', help='/nearest sin nodos (fuerza el fallback a /route)')
+    args = arg_parser.parse_args()
+
+    server = OSRMStub(('127.0.0.1', args.port), latency_ms=args.latency_ms, nodes=not args.no_nodes)
+    print(f"🗺️  OSRM stub en http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
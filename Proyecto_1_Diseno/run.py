@@ -1,7 +1,12 @@
+import os
 import threading
 import argparse
+import signal
+import sys
 from app import create_app
 from app.services_udp import udp_listener, set_flask_app
+from app.services_udp_async import async_udp_listener
+from app.services_udp_multiproc import start_udp_workers
 from app.config import IS_TEST_MODE, BRANCH_NAME, NAME
 
 # Crear la instancia de la aplicación Flask
@@ -14,11 +19,23 @@ if __name__ == "__main__":
     # Configurar argumentos de línea de comandos
     parser = argparse.ArgumentParser(description='Flask UDP Server')
     parser.add_argument('--port', type=int, default=5000, help='Port to run the web server on')
+    parser.add_argument('--udp-mode', choices=['thread', 'async', 'multiprocess'], default='thread',
+                        help='UDP ingestion server: blocking thread (default), asyncio, or N processes with SO_REUSEPORT')
+    parser.add_argument('--udp-workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of UDP worker processes in multiprocess mode')
     args = parser.parse_args()
 
-    # Iniciar el listener UDP para COORDENADAS en un thread separado (puerto 5049)
-    udp_thread = threading.Thread(target=udp_listener, daemon=True)
-    udp_thread.start()
+    # SIGTERM termina como Ctrl+C para que atexit vacíe el buffer de ingesta
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Iniciar el listener UDP para COORDENADAS (puerto 5049)
+    if args.udp_mode == 'multiprocess':
+        # Procesos aparte que comparten el puerto; se crean antes de que Flask arranque threads
+        start_udp_workers(args.udp_workers)
+    else:
+        listener = async_udp_listener if args.udp_mode == 'async' else udp_listener
+        udp_thread = threading.Thread(target=listener, daemon=True)
+        udp_thread.start()
     
     # Determinar el modo de ejecución
     mode = 'TEST' if IS_TEST_MODE else 'PRODUCTION'
@@ -30,7 +47,8 @@ if __name__ == "__main__":
     
     # Mostrar servicios activos
     print("🎧 Services:")
-    print("   📍 GPS Coordinates: UDP port 5049")
+    udp_mode = f"{args.udp_mode} x{args.udp_workers}" if args.udp_mode == 'multiprocess' else args.udp_mode
+    print(f"   📍 GPS Coordinates: UDP port 5049 ({udp_mode})")
     print("   👤 User Registration: HTTPS /api/users/register")
     print("   🌐 Web Dashboard: HTTPS port", args.port)
     
@@ -7,6 +7,8 @@ let selectedDeviceId = null;
 let selectedDestination = null;
 let activeDevices = [];
 let deviceLocationUpdateInterval = null;
+let deviceLocationStream = null;
+let lastRouteVisualizationUpdate = 0;
 let activeSegments = new Map();
 
 // ✅ CRÍTICO: Variables separadas para ruta original y ruta actualizada
@@ -135,10 +137,7 @@ function showDevicesError() {
 
 async function selectDevice(userId, cardElement) {
   if (selectedDeviceId && selectedDeviceId !== userId) {
-    if (deviceLocationUpdateInterval) {
-      clearInterval(deviceLocationUpdateInterval);
-      deviceLocationUpdateInterval = null;
-    }
+    stopDeviceLocationUpdates();
 
     controlMap.clearDeviceMarker();
     clearDestination();
@@ -339,9 +338,62 @@ function drawSimpleCongestionLine(segment) {
 //  congestionMarkers = [];
 //}
 
-function startDeviceLocationUpdates(userId) {
+function stopDeviceLocationUpdates() {
   if (deviceLocationUpdateInterval) {
     clearInterval(deviceLocationUpdateInterval);
+    deviceLocationUpdateInterval = null;
+  }
+  if (deviceLocationStream) {
+    deviceLocationStream.close();
+    deviceLocationStream = null;
+  }
+}
+
+/**
+ * Aplica una nueva ubicación del dispositivo seleccionado: el marcador se
+ * mueve con cada posición, la ruta se recalcula como máximo cada 10 segundos.
+ */
+async function handleDeviceLocation(userId, lat, lon) {
+  if (selectedDeviceId !== userId) {
+    return;
+  }
+  controlMap.updateDeviceLocation(lat, lon, userId);
+
+  // ✅ CRÍTICO: Verificar desviación usando la ruta ORIGINAL
+  if (selectedDestination && originalRouteCoordinates) {
+    checkIfOffRoute(lat, lon);
+  }
+
+  // ✅ CAMBIO: Solo actualizar visualmente la ruta, NO la ruta de referencia
+  if (selectedDestination && Date.now() - lastRouteVisualizationUpdate >= 10000) {
+    lastRouteVisualizationUpdate = Date.now();
+    await updateRouteVisualization(
+      lat,
+      lon,
+      selectedDestination.lat,
+      selectedDestination.lng
+    );
+  }
+}
+
+function startDeviceLocationUpdates(userId) {
+  stopDeviceLocationUpdates();
+
+  // Stream SSE filtrado por usuario: llega cada posición nueva sin sondear
+  if (typeof EventSource !== "undefined") {
+    deviceLocationStream = new EventSource(
+      `/test/api/stream/positions?user_id=${encodeURIComponent(userId)}`
+    );
+    const onPositions = async (event) => {
+      const positions = JSON.parse(event.data);
+      const latest = positions[positions.length - 1];
+      if (latest) {
+        await handleDeviceLocation(userId, latest.lat, latest.lon);
+      }
+    };
+    deviceLocationStream.addEventListener("snapshot", onPositions);
+    deviceLocationStream.addEventListener("positions", onPositions);
+    return;
   }
 
   deviceLocationUpdateInterval = setInterval(async () => {
@@ -355,22 +407,7 @@ function startDeviceLocationUpdates(userId) {
       const data = await response.json();
 
       if (data.success) {
-        controlMap.updateDeviceLocation(data.lat, data.lon, userId);
-
-        // ✅ CRÍTICO: Verificar desviación usando la ruta ORIGINAL
-        if (selectedDestination && originalRouteCoordinates) {
-          checkIfOffRoute(data.lat, data.lon);
-        }
-
-        // ✅ CAMBIO: Solo actualizar visualmente la ruta, NO la ruta de referencia
-        if (selectedDestination) {
-          await updateRouteVisualization(
-            data.lat,
-            data.lon,
-            selectedDestination.lat,
-            selectedDestination.lng
-          );
-        }
+        await handleDeviceLocation(userId, data.lat, data.lon);
       }
     } catch (error) {
       console.error("Error actualizando ubicación del dispositivo:", error);
@@ -738,10 +775,7 @@ function handleSendError(errorMessage, btn, originalText) {
 }
 
 function resetSelection() {
-  if (deviceLocationUpdateInterval) {
-    clearInterval(deviceLocationUpdateInterval);
-    deviceLocationUpdateInterval = null;
-  }
+  stopDeviceLocationUpdates();
 
   clearDestination();
   selectedDeviceId = null;
@@ -657,4 +657,12 @@ export function getDevicesInfo() {
     hasDestination: !!activeDestinations[deviceId],
     destination: activeDestinations[deviceId] || null,
   }));
-}
\ No newline at end of file
+}
+/**
+ * Quita el marcador de un dispositivo que salió de la vista (la trayectoria se conserva).
+ */
+export function removeMarker(deviceId) {
+  if (!map || !markers[deviceId]) return;
+  map.removeLayer(markers[deviceId]);
+  delete markers[deviceId];
+}
@@ -155,10 +155,8 @@ export async function drawCompleteRoute(segmentIds) {
     }
     
     try {
-        // Obtener detalles de cada segmento
-        const segmentDetails = await Promise.all(
-            segmentIds.map(id => getSegmentById(id))
-        );
+        // Obtener los detalles de todos los segmentos en una sola petición
+        const segmentDetails = await getSegmentsBatch(segmentIds);
         
         console.log("📦 Detalles de segmentos obtenidos:", segmentDetails.length);
         
@@ -288,26 +286,34 @@ async function getSegmentFromClick(lat, lng) {
     }
 }
 
-// --- NUEVA FUNCIÓN: Obtener segmento por ID ---
-async function getSegmentById(segmentId) {
-    console.log(`🌐 Obteniendo segmento por ID: ${segmentId}`);
+// --- Obtener varios segmentos en una sola petición ---
+// Retorna un arreglo alineado con segmentIds (null para los que no se encontraron)
+async function getSegmentsBatch(segmentIds) {
+    console.log(`🌐 Obteniendo ${segmentIds.length} segmentos en lote`);
     const basePath = window.getBasePath ? window.getBasePath() : '';
-    const url = `${basePath}/api/segment/${segmentId}`;
+    const url = `${basePath}/api/segments/batch`;
     
     try {
-        const response = await fetch(url);
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ segment_ids: segmentIds })
+        });
         const data = await response.json();
         
         if (data.success) {
-            console.log(`✅ Segmento ${segmentId} obtenido`);
-            return data.segment;
+            if (data.missing.length > 0) {
+                console.warn(`⚠️ Segmentos sin datos: ${data.missing.join(', ')}`);
+            }
+            console.log(`✅ ${data.count} de ${segmentIds.length} segmentos obtenidos`);
+            return data.segments;
         } else {
-            console.error(`❌ Error obteniendo segmento ${segmentId}:`, data.error);
-            return null;
+            console.error("❌ Error obteniendo segmentos:", data.error);
+            return segmentIds.map(() => null);
         }
     } catch (error) {
-        console.error(`❌ Error en petición para segmento ${segmentId}:`, error);
-        return null;
+        console.error("❌ Error en petición de segmentos:", error);
+        return segmentIds.map(() => null);
     }
 }
 
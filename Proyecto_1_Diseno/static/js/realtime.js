@@ -9,6 +9,13 @@ let latitudeElement, longitudeElement, deviceIdElement, timestampElement;
 // --- Estado en Memoria ---
 // Almacena datos de todos los dispositivos que hemos visto en esta sesión
 const devicesData = {};
+// Un dispositivo sin posiciones nuevas en este tiempo deja de contar como activo
+const ACTIVE_WINDOW_MS = 30000;
+// Conexión SSE actual (se reemplaza al cambiar el viewport)
+let positionStream = null;
+// Sondeo sin EventSource: cursor y ETag de la última respuesta de /coordenadas/all
+let pollCursor = "";
+let pollEtag = null;
 
 // --- Colores ---
 // Colores fijos por user_id (para consistencia)
@@ -184,91 +191,192 @@ function updateDevicesList() {
 // --- Lógica Principal ---
 
 /**
- * Función principal que se ejecuta en bucle.
- * Obtiene las coordenadas de TODOS los dispositivos activos.
+ * Aplica posiciones recibidas (foto completa o solo las nuevas) al mapa y a la UI.
+ * @param {Array} devicesArray - Posiciones en el formato de /coordenadas/all
+ */
+async function procesarDispositivos(devicesArray) {
+  for (const data of devicesArray) {
+    // Validar datos
+    if (!data || !data.lat || !data.lon) {
+      console.warn("Datos inválidos para dispositivo:", data);
+      continue;
+    }
+
+    // Extraer datos y crear ID único
+    const userId = data.user_id || 1;
+    const deviceId = `user_${userId}`;
+    const lat = data.lat;
+    const lon = data.lon;
+    const color = getColorByUserId(userId);
+
+    // Actualizar el mapa (marcador y trayectoria)
+    map.updateMarkerPosition(lat, lon, deviceId, color);
+    const numPuntos = await map.agregarPuntoTrayectoria(
+      lat,
+      lon,
+      deviceId,
+      color
+    );
+
+    // Almacenar/Actualizar datos de este dispositivo en la memoria
+    devicesData[deviceId] = {
+      lat,
+      lon,
+      timestamp: data.timestamp,
+      user_id: userId,
+      source: data.source,
+      color: color,
+      puntos: numPuntos,
+      lastSeen: Date.now(),
+    };
+
+    console.log(`✓ Dispositivo ${deviceId}: ${lat.toFixed(6)}, ${lon.toFixed(6)}`);
+  }
+
+  // Dispositivos activos: con datos en los últimos 30 segundos
+  const activos = Object.values(devicesData).filter(
+    (d) => Date.now() - d.lastSeen < ACTIVE_WINDOW_MS
+  );
+  setOnlineStatus(activos.length > 0);
+
+  // Actualizar el panel de "Posición Actual"
+  if (activos.length === 1) {
+    updateDisplay(activos[0], 1);
+  } else {
+    updateDisplay(null, activos.length);
+  }
+
+  // Actualizar contadores y listas de la UI
+  puntosTrayectoriaHiddenElement.textContent = Object.values(devicesData).reduce(
+    (total, d) => total + (d.puntos || 0),
+    0
+  );
+  updateRealtimeModalInfo();
+  updateDevicesList();
+}
+
+/**
+ * Quita de la vista los dispositivos que salieron del viewport o de los filtros.
+ * @param {Array} userIds - user_ids recibidos en un evento `leave`
+ */
+function quitarDispositivos(userIds) {
+  for (const userId of userIds) {
+    const deviceId = `user_${userId}`;
+    map.removeMarker(deviceId);
+    delete devicesData[deviceId];
+  }
+  updateDevicesList();
+}
+
+/**
+ * Conecta al stream de posiciones (SSE) para el área visible del mapa:
+ * al conectar llega una foto de los dispositivos dentro del viewport y
+ * después solo sus posiciones nuevas. El navegador reconecta solo y envía
+ * Last-Event-ID para recibir lo que se perdió. Filtro opcional por empresa
+ * con ?empresa= en la URL de la página.
+ */
+function conectarStream() {
+  if (positionStream) {
+    positionStream.close();
+  }
+
+  // Viewport con un margen, para no perder vehículos justo en el borde
+  const bounds = map.getMap().getBounds().pad(0.2);
+  const params = new URLSearchParams({
+    bbox: [
+      bounds.getSouth(),
+      bounds.getWest(),
+      bounds.getNorth(),
+      bounds.getEast(),
+    ].map((value) => value.toFixed(5)).join(","),
+  });
+  const empresa = new URLSearchParams(window.location.search).get("empresa");
+  if (empresa) {
+    params.set("empresa", empresa);
+  }
+
+  const basePath = getBasePath();
+  const source = new EventSource(`${basePath}/api/stream/positions?${params}`);
+  positionStream = source;
+
+  source.addEventListener("snapshot", async (event) => {
+    const devicesArray = JSON.parse(event.data);
+    console.log(`📡 Stream conectado: ${devicesArray.length} dispositivos en el área visible`);
+
+    // La foto reemplaza lo que había: fuera de ella están los que quedaron fuera del viewport
+    const enVista = new Set(devicesArray.map((d) => String(d.user_id)));
+    quitarDispositivos(
+      Object.values(devicesData)
+        .map((d) => String(d.user_id))
+        .filter((userId) => !enVista.has(userId))
+    );
+    await procesarDispositivos(devicesArray);
+    await checkActiveDestinations(devicesArray);
+  });
+
+  source.addEventListener("positions", async (event) => {
+    await procesarDispositivos(JSON.parse(event.data));
+  });
+
+  source.addEventListener("leave", (event) => {
+    quitarDispositivos(JSON.parse(event.data));
+  });
+
+  source.onerror = () => {
+    console.warn("Stream de posiciones desconectado, reconectando...");
+    setOnlineStatus(false);
+    updateRealtimeModalInfo();
+  };
+}
+
+/**
+ * Sondeo de /coordenadas/all (navegadores sin EventSource). Pide solo los
+ * cambios desde el último cursor; si nada cambió el servidor responde 304.
  */
 async function actualizarPosicion() {
   const basePath = getBasePath();
 
   try {
-    // Usar /coordenadas/all para obtener TODOS los dispositivos activos
-    const response = await fetch(`${basePath}/coordenadas/all`);
-
-    if (!response.ok) {
-      console.error("Error al obtener coordenadas:", response.status);
-      setOnlineStatus(false);
-      updateRealtimeModalInfo();
+    const headers = pollEtag ? { "If-None-Match": pollEtag } : {};
+    const response = await fetch(
+      `${basePath}/coordenadas/all?since=${encodeURIComponent(pollCursor)}`,
+      { headers }
+    );
+
+    if (response.status === 304) {
+      await revisarDispositivosActivos();
       return;
     }
 
-    const devicesArray = await response.json();
-
-    // Verificar que hay dispositivos activos
-    if (!Array.isArray(devicesArray) || devicesArray.length === 0) {
-      console.warn("No hay dispositivos activos en este momento");
+    if (!response.ok) {
+      console.error("Error al obtener coordenadas:", response.status);
       setOnlineStatus(false);
-      updateDisplay(null, 0);
       updateRealtimeModalInfo();
       return;
     }
 
-    // Hay dispositivos activos
-    setOnlineStatus(true);
-    console.log(`📡 Recibidos ${devicesArray.length} dispositivos activos`);
-
-    // Procesar CADA dispositivo
-    let totalPuntos = 0;
-    for (const data of devicesArray) {
-      // Validar datos
-      if (!data || !data.lat || !data.lon) {
-        console.warn("Datos inválidos para dispositivo:", data);
-        continue;
-      }
-
-      // Extraer datos y crear ID único
-      const userId = data.user_id || 1;
-      const deviceId = `user_${userId}`;
-      const lat = data.lat;
-      const lon = data.lon;
-      const color = getColorByUserId(userId);
-
-      // Almacenar/Actualizar datos de este dispositivo en la memoria
-      devicesData[deviceId] = {
-        lat,
-        lon,
-        timestamp: data.timestamp,
-        user_id: userId,
-        source: data.source,
-        color: color,
-      };
-
-      // Actualizar el mapa (marcador y trayectoria)
-      map.updateMarkerPosition(lat, lon, deviceId, color);
-      const numPuntos = await map.agregarPuntoTrayectoria(
-        lat,
-        lon,
-        deviceId,
-        color
+    const changes = await response.json();
+    pollCursor = changes.cursor;
+    pollEtag = response.headers.get("ETag");
+
+    // Foto completa: los que no vienen ya no están activos
+    if (changes.full) {
+      const activos = new Set(changes.devices.map((d) => String(d.user_id)));
+      quitarDispositivos(
+        Object.values(devicesData)
+          .map((d) => String(d.user_id))
+          .filter((userId) => !activos.has(userId))
       );
-      totalPuntos += numPuntos;
-
-      console.log(`✓ Dispositivo ${deviceId}: ${lat.toFixed(6)}, ${lon.toFixed(6)}`);
     }
-
-    // Actualizar el panel de "Posición Actual"
-    if (devicesArray.length === 1) {
-      updateDisplay(devicesArray[0], 1);
-    } else {
-      updateDisplay(null, devicesArray.length);
+    if (changes.removed.length > 0) {
+      quitarDispositivos(changes.removed);
     }
 
-    // Actualizar contadores y listas de la UI
-    puntosTrayectoriaHiddenElement.textContent = totalPuntos;
-    updateRealtimeModalInfo();
-    updateDevicesList();
+    console.log(`📡 Cambios: ${changes.devices.length} posiciones, ${changes.removed.length} inactivos`);
+    await procesarDispositivos(changes.devices);
 
     // ==================== NUEVO: Verificar destinos activos ====================
-    await checkActiveDestinations(devicesArray);
+    await checkActiveDestinations(changes.devices);
 
   } catch (err) {
     console.error("Error en actualizarPosicion:", err);
@@ -277,6 +385,20 @@ async function actualizarPosicion() {
   }
 }
 
+/**
+ * Revisa destinos y estado de los dispositivos activos (con el stream, las
+ * posiciones ya no llegan en un ciclo fijo).
+ */
+async function revisarDispositivosActivos() {
+  const activos = Object.values(devicesData).filter(
+    (d) => Date.now() - d.lastSeen < ACTIVE_WINDOW_MS
+  );
+  setOnlineStatus(activos.length > 0);
+  updateDisplay(activos.length === 1 ? activos[0] : null, activos.length);
+  updateRealtimeModalInfo();
+  await checkActiveDestinations(activos);
+}
+
 /**
  * ==================== NUEVO: Verifica y muestra destinos activos ====================
  * Consulta los destinos pendientes/enviados para cada dispositivo activo
@@ -492,9 +614,20 @@ document.addEventListener("DOMContentLoaded", () => {
   `;
   document.head.appendChild(style);
 
-  // 5. Iniciar el bucle de actualización
-  actualizarPosicion(); // Llamar una vez al cargar
-  setInterval(actualizarPosicion, 5000); // Cada 5 segundos
+  // 5. Recibir posiciones en vivo (stream SSE, o sondeo si no hay EventSource)
+  if (typeof EventSource !== "undefined") {
+    conectarStream();
+    // Al mover o hacer zoom, suscribirse de nuevo con el área visible
+    let viewportTimer = null;
+    map.getMap().on("moveend", () => {
+      clearTimeout(viewportTimer);
+      viewportTimer = setTimeout(conectarStream, 500);
+    });
+    setInterval(revisarDispositivosActivos, 5000); // Destinos y dispositivos inactivos
+  } else {
+    actualizarPosicion(); // Llamar una vez al cargar
+    setInterval(actualizarPosicion, 5000); // Cada 5 segundos
+  }
 
   // 6. Conectar el actualizador del modal
   if (typeof window.updateModalInfo !== "undefined") {